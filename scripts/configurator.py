@@ -4,13 +4,46 @@
 # This script is used for configuring Zabbix server by using API
 #
 
-import argparse, json, logging, MySQLdb, os, pycurl, re, socket, time
+import argparse, bisect, calendar, copy, cProfile, ctypes, ctypes.util, gc, hashlib, itertools, json, logging, math, multiprocessing, os, pstats, Queue, random, re, resource, select, shutil, socket, struct, tarfile, tempfile, threading, time
+import xml.etree.ElementTree as ElementTree
+from multiprocessing.pool import ThreadPool
 from pyzabbix import ZabbixAPI, ZabbixAPIException
 from StringIO import StringIO
+from zabbix_sender import Sender, SenderError, item_key, value as sender_value
+from zabbix_capacity import format_size, gather, memory_total, parse_size, recommend, render_env
+
+# Steps of phases which can be selected by --only and --skip; login, prefetch and host resolving run when selected steps need them
+PHASES = {
+    "host": ["host_address", "host_status"],
+    "web": ["web", "web_cleanup", "custom_config"],
+    "users": ["guest", "users"],
+    "media": ["mediatype", "admin_email"],
+    "actions": ["report_action", "auto_registration"],
+    "templates": ["templates"],
+    "config": ["config"],
+    "assign-templates": ["assign_templates"]
+}
 
 parser = argparse.ArgumentParser(prog="./configurator.py", description="Zabbix configurator")
 parser.add_argument("--debug", action="store_true", help="Enable debug mode")
-args = parser.parse_args()
+mode = parser.add_mutually_exclusive_group()
+mode.add_argument("--plan", action="store_true", help="Print changes which are required to reach the desired state, without applying them")
+mode.add_argument("--apply", action="store_true", help="Apply only changes which are required to reach the desired state")
+mode.add_argument("--watch", action="store_true", help="Configure the server, then keep running and apply changes of configuration folder and desired state file")
+parser.add_argument("--force-import", action="store_true", help="Import configuration templates even if they were not changed since the last import")
+parser.add_argument("--partitions", action="store_true", help="Partition history and trends tables by clock, create future and drop expired partitions; with --plan only print SQL statements")
+parser.add_argument("--inventory", default=None, help="Create and update hosts from inventory file, one JSON object per line; with --plan only print changes")
+parser.add_argument("--users", default=None, help="Create and update users, their groups and email media from file, one JSON object per line; with --plan only print changes")
+parser.add_argument("--backup", default=None, help="Export templates, hosts and maps into a new compressed archive in folder, chunks which were not changed since the previous backup are not written again")
+parser.add_argument("--full-backup", action="store_true", help="Write all chunks into the new backup archive")
+parser.add_argument("--restore", default=None, help="Import templates, hosts and maps of backup archive with rules of configuration import")
+parser.add_argument("--capacity", action="store_true", help="Recommend caches and pollers of Zabbix server and InnoDB sizes from counts of monitored objects, write them into ZBX_CAPACITY_FILE; with --plan only print them")
+parser.add_argument("--only", action="append", default=[], choices=sorted(PHASES.keys()), help="Run only steps of this phase, it can be used several times")
+parser.add_argument("--skip", action="append", default=[], choices=sorted(PHASES.keys()), help="Do not run steps of this phase, it can be used several times")
+parser.add_argument("--check", action="store_true", help="Validate settings from environment without connecting to Zabbix server and database")
+parser.add_argument("--timing-report", choices=["table", "json"], default=None, help="Print the slowest API methods and SQL statements and durations of steps at exit")
+# Other scripts import API client from this module, they have their own arguments
+args = parser.parse_args() if __name__ == "__main__" else parser.parse_args([])
 options = vars(args)
 
 logging.basicConfig()
@@ -18,7 +51,7 @@ logger = logging.getLogger("Configurator")
 logger.setLevel("DEBUG" if options["debug"] else "INFO")
 
 def check_email(email_address):
-    if re.match(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)", email_address):
+    if EMAIL_PATTERN.match(email_address):
         return 1
     else:
         error("Email address %s is incorrect."%email_address)
@@ -27,6 +60,765 @@ def error(msg=""):
     logger.error(msg)
     exit(1)
 
+def retry(function, timeout, initial_delay=0.05, max_delay=5.0, on_retry=None):
+    """Calls function until it succeeds, sleeping with jittered exponential backoff between attempts.
+    The last exception is raised when timeout is over, on_retry is called before every next attempt."""
+    deadline = time.time() + timeout
+    delay = initial_delay
+    attempt = 1
+    while True:
+        try:
+            return function()
+        except Exception as e:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise
+            pause = min(random.uniform(delay / 2, delay), remaining)
+            logger.debug("Attempt %d failed (%s), next one in %.3f sec."%(attempt, e, pause))
+            if on_retry is not None:
+                on_retry()
+            time.sleep(pause)
+            delay = min(delay * 2, max_delay)
+            attempt += 1
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i+size]
+
+def stream_chunks(iterable, size):
+    """Splits iterable into lists of size items, items are read only when the next chunk is requested."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+def host_list(hosts):
+    """Returns short description of hosts which are changed by one mass call."""
+    names = [host["host"] for host in hosts]
+    return ", ".join(names[:3]) + (" and %d more"%(len(names) - 3) if len(names) > 3 else "")
+
+def add_archive_member(archive, name, data):
+    """Writes data into tar archive as a file."""
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = time.time()
+    archive.addfile(info, StringIO(data))
+
+def index(items, key):
+    return dict((item[key], item) for item in items)
+
+def parse_period(value):
+    """Returns count of seconds in Zabbix time period like 90d."""
+    value = str(value).strip()
+    if value[-1] in PERIOD_UNITS:
+        return int(value[:-1]) * PERIOD_UNITS[value[-1]]
+    return int(value)
+
+def partition_start(clock, period):
+    """Returns start of the day or month which contains clock, partitions are aligned to UTC."""
+    t = time.gmtime(clock)
+    return calendar.timegm((t.tm_year, t.tm_mon, t.tm_mday if period == "day" else 1, 0, 0, 0))
+
+def next_partition(start, period):
+    if period == "day":
+        return start + 86400
+    t = time.gmtime(start)
+    return calendar.timegm((t.tm_year + t.tm_mon // 12, t.tm_mon % 12 + 1, 1, 0, 0, 0))
+
+def partition_name(start, period):
+    return time.strftime("p%Y_%m_%d" if period == "day" else "p%Y_%m", time.gmtime(start))
+
+def sql_method(query):
+    """Returns statement and table of SQL query, e.g. "UPDATE config", it names the query in call statistics."""
+    match = SQL_TABLE_PATTERN.search(query)
+    return ("%s %s"%(query.split(None, 1)[0].upper(), match.group(1) if match is not None else "")).strip()
+
+def profiled(function, mode, path):
+    """Calls function under cProfile ("cpu"), or logs peak memory and counts of live objects after it ("memory")."""
+    if mode == "cpu":
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(function)
+        finally:
+            profiler.dump_stats(path)
+            stream = StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(REPORT_TOP)
+            logger.info("CPU profile is saved into %s.\n%s"%(path, stream.getvalue()))
+    if mode == "memory":
+        try:
+            return function()
+        finally:
+            counts = dict()
+            for item in gc.get_objects():
+                counts[type(item).__name__] = counts.get(type(item).__name__, 0) + 1
+            top = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:REPORT_TOP]
+            logger.info("Peak memory usage is %d KB, live objects: %s."%(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, ", ".join(["%s %d"%(name, count) for name, count in top])))
+    return function()
+
+def partition_ranges(start, end, period):
+    """Returns (name, upper bound) of partitions which cover time from start till end."""
+    result = []
+    start = partition_start(start, period)
+    while start < end:
+        result.append((partition_name(start, period), next_partition(start, period)))
+        start = result[-1][1]
+    return result
+
+# Object types which are resolved by name: (get method, name field, id field, additional parameters of get method)
+RESOLVER_TYPES = {
+    "host": ("host.get", "host", "hostid", {"output": ["hostid", "host", "name", "status"], "selectParentTemplates": ["templateid"]}),
+    "hostgroup": ("hostgroup.get", "name", "groupid", {}),
+    "mediatype": ("mediatype.get", "description", "mediatypeid", {}),
+    "template": ("template.get", "host", "templateid", {}),
+    "user": ("user.get", "alias", "userid", {}),
+    "usergroup": ("usergroup.get", "name", "usrgrpid", {})
+}
+
+class Resolver:
+    """Serves name to id lookups from indexes, which are loaded by one bulk get per object type. Types of names (type -> names)
+    are loaded only for these names, e.g. a server could have thousands of hosts, but configurator looks up a few of them."""
+    def __init__(self, zapi, names=dict()):
+        self.zapi = zapi
+        self.names = dict((kind, set(values)) for kind, values in names.items())
+        self.indexes = dict()
+        self.lock = threading.RLock()
+
+    def params(self, kind, filter=None):
+        method, name_field, id_field, params = RESOLVER_TYPES[kind]
+        params = dict(params)
+        params.setdefault("output", [id_field, name_field])
+        if filter is not None:
+            params["filter"] = filter
+        elif kind in self.names:
+            params["filter"] = {name_field: sorted(self.names[kind])}
+        return method, params
+
+    def prefetch(self, kinds):
+        with self.lock:
+            kinds = [kind for kind in kinds if kind not in self.indexes]
+            calls = [self.params(kind) for kind in kinds]
+            for kind, objects in zip(kinds, self.zapi.batch(calls)):
+                logger.debug("Loaded %d objects of type %s."%(len(objects), kind))
+                self.indexes[kind] = index(objects, RESOLVER_TYPES[kind][1])
+
+    def load(self, kind, filter):
+        """Adds objects, which were not prefetched, to the index of their type."""
+        method, params = self.params(kind, filter)
+        objects = self.zapi.do_request(method, params)["result"]
+        self.indexes[kind].update(index(objects, RESOLVER_TYPES[kind][1]))
+        self.names[kind].update(item[RESOLVER_TYPES[kind][1]] for item in objects)
+        return objects
+
+    def get(self, kind, name):
+        with self.lock:
+            self.prefetch([kind])
+            if name not in self.indexes[kind] and kind in self.names and name not in self.names[kind]:
+                self.load(kind, {RESOLVER_TYPES[kind][1]: [name]})
+                self.names[kind].add(name)
+            return self.indexes[kind].get(name)
+
+    def find(self, kind, object_id):
+        with self.lock:
+            self.prefetch([kind])
+            id_field = RESOLVER_TYPES[kind][2]
+            item = next((item for item in self.indexes[kind].values() if item[id_field] == str(object_id)), None)
+            if item is None and kind in self.names:
+                item = next(iter(self.load(kind, {id_field: [str(object_id)]})), None)
+            return item
+
+    def id(self, kind, name):
+        item = self.get(kind, name)
+        return item[RESOLVER_TYPES[kind][2]] if item is not None else None
+
+    def put(self, kind, name, object_id):
+        """Registers object which was created by configurator."""
+        method, name_field, id_field, params = RESOLVER_TYPES[kind]
+        with self.lock:
+            if kind in self.indexes:
+                self.indexes[kind][name] = {name_field: name, id_field: str(object_id)}
+
+    def invalidate(self, kind):
+        """Drops index of objects which were changed, it is loaded again by the next lookup."""
+        with self.lock:
+            self.indexes.pop(kind, None)
+
+    def reset(self):
+        with self.lock:
+            self.indexes = dict()
+
+PERIOD_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+# Tables which are partitioned by clock: (table, retention kind), retention is hk_history or hk_trends of config table
+PARTITION_TABLES = [
+    ("history", "history"),
+    ("history_uint", "history"),
+    ("history_str", "history"),
+    ("history_text", "history"),
+    ("history_log", "history"),
+    ("trends", "trends"),
+    ("trends_uint", "trends")
+]
+
+# Trapper items of the managed host which receive run metrics of configurator: key -> (name, value type, units)
+METRIC_ITEMS = {
+    "configurator.duration": ("Configurator run duration", 0, "s"),
+    "configurator.api.calls": ("Configurator API calls", 3, ""),
+    "configurator.api.failures": ("Configurator API call failures", 3, ""),
+    "configurator.steps.failed": ("Configurator failed steps", 3, "")
+}
+STEP_METRIC_KEY = "configurator.step.duration[%s]"
+# Debug log shows at most this count of characters of a payload
+PAYLOAD_LOG_LIMIT = 2000
+# Count of the slowest methods in timing report and of functions in CPU profile
+REPORT_TOP = 15
+# In discovery mode web checks are created by prototypes of this template from the URL list file
+WEB_DISCOVERY_TEMPLATE = "Template Web Check"
+# Discovered trapper item which receives response code of URL from zabbix_web.py probe, URL is its quoted parameter
+WEB_PROBE_STATUS_KEY = "web.probe.status"
+# Fields of desired state file: attribute of configurator which is replaced by the field, steps which apply the attribute
+DESIRED_STATE_FIELDS = {
+    "url_list": ("url_list", ["web", "web_cleanup", "custom_config"]),
+    "admin_users": ("admin_users", ["users"]),
+    "config": ("configuration", ["config"]),
+    "additional_templates": ("additional_templates", ["assign_templates"])
+}
+# Steps which apply changes of configuration folder
+CONFIGURATION_STEPS = ["templates", "assign_templates"]
+# Count of points of every web check host on the hash ring, more points give more even distribution of URLs
+WEB_RING_REPLICAS = 160
+# Attributes which are opened on first use and dependencies which have to be ready for them, API transport is opened by ZabbixClient the same way
+LAZY_DEPENDENCIES = {
+    "agent_ip_address": ["Agent address"],
+    # Server creates database schema before it starts listening
+    "db": ["Server", "Database"],
+    "authentication_type": ["Server", "Database"]
+}
+# Settings which are validated by --check
+REQUIRED_SETTINGS = ["ZBX_SERVER_URL", "ZBX_SERVER_HOST", "ZBX_AGENT_HOSTNAME", "SMTP_SERVER", "SMTP_EMAIL", "ADMIN_EMAIL_ADDRESS"]
+INTEGER_SETTINGS = ["ZBX_API_BATCH_SIZE", "ZBX_API_MAX_IN_FLIGHT", "ZBX_API_TIMEOUT", "ZBX_CONFIGURATOR_WORKERS", "ZBX_READY_TIMEOUT", "ZBX_PARTITION_AHEAD", "ZBX_INVENTORY_CHUNK_SIZE", "ZBX_USERS_CHUNK_SIZE", "ZBX_BACKUP_CHUNK_SIZE", "ZBX_CAPACITY_CPUS"]
+CHOICE_SETTINGS = {
+    "ZBX_API_TRANSPORT": ["curl", "session"],
+    "ZBX_WEB_CHECK_MODE": ["api", "discovery"],
+    "ZBX_WEB_MIGRATION": ["disable", "delete"],
+    "ZBX_PARTITION_HISTORY_PERIOD": ["day", "month"],
+    "ZBX_PARTITION_TRENDS_PERIOD": ["day", "month"],
+    "ZBX_DISABLE_GUEST": ["true", "false"],
+    "ZBX_PROFILE": ["cpu", "memory"]
+}
+# Columns of config table of Zabbix 3.4 which can be set by ZBX_CONFIG
+CONFIG_FIELDS = [
+    "refresh_unsupported", "work_period", "alert_usrgrpid", "event_ack_enable", "event_expire", "event_show_max", "default_theme",
+    "authentication_type", "ldap_host", "ldap_port", "ldap_base_dn", "ldap_bind_dn", "ldap_bind_password", "ldap_search_attribute",
+    "dropdown_first_entry", "dropdown_first_remember", "discovery_groupid", "max_in_table", "search_limit",
+    "severity_color_0", "severity_color_1", "severity_color_2", "severity_color_3", "severity_color_4", "severity_color_5",
+    "severity_name_0", "severity_name_1", "severity_name_2", "severity_name_3", "severity_name_4", "severity_name_5",
+    "ok_period", "blink_period", "problem_unack_color", "problem_ack_color", "ok_unack_color", "ok_ack_color",
+    "problem_unack_style", "problem_ack_style", "ok_unack_style", "ok_ack_style", "snmptrap_logging", "server_check_interval",
+    "hk_events_mode", "hk_events_trigger", "hk_events_internal", "hk_events_discovery", "hk_events_autoreg",
+    "hk_services_mode", "hk_services", "hk_audit_mode", "hk_audit", "hk_sessions_mode", "hk_sessions",
+    "hk_history_mode", "hk_history_global", "hk_history", "hk_trends_mode", "hk_trends_global", "hk_trends",
+    "default_inventory_mode", "custom_color"
+]
+EMAIL_PATTERN = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
+SQL_TABLE_PATTERN = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+`?([\w.]+)", re.IGNORECASE)
+
+# Objects which are backed up by configuration.export in import order: (export option, get method, id field, filter, path of objects in export, name field)
+# Discovered hosts are created again by their discovery rules, so only plain hosts are exported
+BACKUP_TYPES = [
+    ("templates", "template.get", "templateid", {}, "./templates/template", "template"),
+    ("hosts", "host.get", "hostid", {"flags": 0}, "./hosts/host", "host"),
+    ("maps", "map.get", "sysmapid", {}, "./maps/map", "name")
+]
+
+# Rules of configuration.import for templates from CONFIGURATION_FOLDER
+IMPORT_RULES = {
+    "applications": {
+        "createMissing": True
+    },
+    "discoveryRules": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+    "graphs": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+    "groups": {
+        "createMissing": True
+    },
+    "hosts": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+    "images": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+    "items": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+    "maps": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+    "screens": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+    "templateLinkage": {
+        "createMissing": True
+    },
+    "templates": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+    "templateScreens": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+    "triggers": {
+        "createMissing": True,
+        "updateExisting": True
+    },
+}
+
+class HashRing:
+    """Consistent hash ring. Key belongs to the node of the next point clockwise, so adding or removing a node
+    moves only keys of that node, and adding or removing a key does not move other keys."""
+    def __init__(self, nodes, replicas=WEB_RING_REPLICAS):
+        self.points = sorted((self.hash("%s#%d"%(node, i)), node) for node in nodes for i in range(0, replicas))
+        self.positions = [position for position, node in self.points]
+
+    def hash(self, value):
+        return int(hashlib.md5(value.encode("utf-8") if isinstance(value, unicode) else value).hexdigest()[:16], 16)
+
+    def get(self, key):
+        return self.points[bisect.bisect(self.positions, self.hash(key)) % len(self.points)][1]
+
+class Ref:
+    """Reference to id of an object, which can be created by the same plan."""
+    def __init__(self, kind, name):
+        self.kind = kind
+        self.name = name
+
+class Change:
+    """Single write operation which is required to bring the server to the desired state."""
+    SIGNS = {"create": "+", "import": "+", "update": "~", "delete": "-"}
+
+    def __init__(self, kind, name, action, method, params, details=""):
+        self.kind = kind
+        self.name = name
+        self.action = action
+        # API method name or function which is called with params
+        self.method = method
+        self.params = params
+        self.details = details
+
+    def batchable(self):
+        return not callable(self.method) and self.method.split(".")[-1] in ("create", "update", "delete")
+
+    def __str__(self):
+        return "%s %s \"%s\"%s"%(self.SIGNS.get(self.action, "~"), self.kind, self.name, " (%s)"%(self.details) if self.details else "")
+
+class StepExecutor:
+    """Runs steps in a thread pool as soon as all their prerequisites are done."""
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.steps = []
+        self.durations = dict()
+
+    def add(self, name, function, requires=[]):
+        self.steps.append((name, function, requires))
+
+    def call(self, name, function):
+        started = time.time()
+        message = None
+        try:
+            function()
+        except SystemExit:
+            # Reason was already logged by error()
+            message = "step was aborted"
+        except Exception as e:
+            logger.debug("Step %s raised an exception."%(name), exc_info=True)
+            message = str(e) or e.__class__.__name__
+        self.durations[name] = time.time()-started
+        logger.debug("Step %s finished in %.3f sec."%(name, self.durations[name]))
+        return name, message
+
+    def run(self):
+        """Runs all steps and returns error messages of failed or skipped steps by step name."""
+        pending = list(self.steps)
+        done, errors = set(), dict()
+        finished = Queue.Queue()
+        running = 0
+        pool = ThreadPool(self.workers)
+        try:
+            while len(pending) > 0 or running > 0:
+                changed = True
+                while changed:
+                    changed = False
+                    for step in list(pending):
+                        name, function, requires = step
+                        failed = [required for required in requires if required in errors]
+                        if len(failed) > 0:
+                            errors[name] = "skipped because of failed step %s"%(", ".join(failed))
+                        elif all(required in done for required in requires):
+                            running += 1
+                            pool.apply_async(self.call, (name, function), callback=finished.put)
+                        else:
+                            continue
+                        pending.remove(step)
+                        changed = True
+                if running == 0:
+                    for name, function, requires in pending:
+                        errors[name] = "unresolved prerequisites %s"%(", ".join(requires))
+                    break
+                # Waiting with timeout keeps the main thread interruptible
+                while True:
+                    try:
+                        name, message = finished.get(True, 1)
+                        break
+                    except Queue.Empty:
+                        pass
+                running -= 1
+                if message is None:
+                    done.add(name)
+                else:
+                    errors[name] = message
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+        return errors
+
+class Payload:
+    """Wraps data for debug log, it is serialized and truncated only when the message is emitted."""
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        text = json.dumps(self.data, sort_keys=True, default=str)
+        if len(text) > PAYLOAD_LOG_LIMIT:
+            return "%s... (%d characters)"%(text[:PAYLOAD_LOG_LIMIT], len(text))
+        return text
+
+class CallStats:
+    """Collects count, latency, request and response size, failures and retries of calls by method.
+    Sizes are bytes for API calls; query length and count of rows for SQL statements."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.methods = dict()
+
+    def entry(self, method):
+        return self.methods.setdefault(method, {"calls": 0, "failures": 0, "retries": 0, "seconds": 0.0, "max_seconds": 0.0, "request_size": 0, "response_size": 0})
+
+    def record(self, method, seconds, request_size=0, response_size=0, failed=False):
+        with self.lock:
+            entry = self.entry(method)
+            entry["calls"] += 1
+            entry["failures"] += 1 if failed else 0
+            entry["seconds"] += seconds
+            entry["max_seconds"] = max(entry["max_seconds"], seconds)
+            entry["request_size"] += request_size
+            entry["response_size"] += response_size
+
+    def retry(self, method):
+        with self.lock:
+            self.entry(method)["retries"] += 1
+
+    def slowest(self, count):
+        """Returns (method, statistics) of methods with the largest total time."""
+        with self.lock:
+            return sorted([(method, dict(entry)) for method, entry in self.methods.items()], key=lambda item: item[1]["seconds"], reverse=True)[:count]
+
+class InstrumentedConnection:
+    """Database connection whose cursors record executed queries into call statistics."""
+    def __init__(self, connection, stats):
+        self.connection = connection
+        self.stats = stats
+
+    def cursor(self):
+        return InstrumentedCursor(self.connection.cursor(), self.stats)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+class InstrumentedCursor:
+    def __init__(self, cursor, stats):
+        self.cursor = cursor
+        self.stats = stats
+
+    def execute(self, query, params=None):
+        method = "sql " + sql_method(query)
+        started = time.time()
+        failed = True
+        try:
+            result = self.cursor.execute(query, params)
+            failed = False
+            return result
+        finally:
+            seconds = time.time() - started
+            rows = max(self.cursor.rowcount, 0)
+            self.stats.record(method, seconds, len(query), rows, failed)
+            logger.debug("SQL %s: %.3f sec, %d rows. %s", method, seconds, rows, Payload(params))
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class Watcher:
+    """Reports which of watched targets (name -> folder or file) were changed. Parent folders of files are watched by inotify,
+    so files which are replaced by rename are noticed too; modification times are polled where inotify is not available."""
+    EVENT = struct.Struct("iIII")
+    # IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_DELETE
+    MASK = 0x8 | 0x40 | 0x80 | 0x200
+
+    def __init__(self, targets, poll_interval=1):
+        self.targets = dict((name, os.path.abspath(path)) for name, path in targets.items())
+        self.poll_interval = poll_interval
+        self.fd = None
+        self.folders = dict()
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init()
+            if fd < 0:
+                # EMFILE is returned when fs.inotify.max_user_instances is reached
+                number = ctypes.get_errno()
+                raise OSError(number, "inotify_init failed: %s"%(os.strerror(number)))
+            for path in set(path if os.path.isdir(path) else os.path.dirname(path) for path in self.targets.values()):
+                descriptor = libc.inotify_add_watch(fd, path, self.MASK)
+                if descriptor < 0:
+                    os.close(fd)
+                    raise OSError(ctypes.get_errno(), "can not watch %s"%(path))
+                self.folders[descriptor] = path
+            self.fd = fd
+        except (AttributeError, OSError) as e:
+            logger.warning("Inotify is not available (%s), changes are detected by polling every %s sec."%(e, poll_interval))
+            self.snapshot = self.state()
+
+    def match(self, path):
+        return set(name for name, target in self.targets.items() if path == target or os.path.dirname(path) == target and os.path.isdir(target))
+
+    def state(self):
+        """Returns modification time and size of every watched file for polling."""
+        result = dict()
+        for name, path in self.targets.items():
+            files = [os.path.join(path, item) for item in sorted(os.listdir(path))] if os.path.isdir(path) else [path]
+            result[name] = []
+            for item in files:
+                try:
+                    stat = os.stat(item)
+                    result[name].append((item, stat.st_mtime, stat.st_size))
+                except OSError:
+                    pass
+        return result
+
+    def poll(self, timeout):
+        deadline = time.time() + timeout if timeout is not None else None
+        while True:
+            state = self.state()
+            changed = set(name for name in state.keys() if state[name] != self.snapshot[name])
+            self.snapshot = state
+            if len(changed) > 0 or (deadline is not None and time.time() >= deadline):
+                return changed
+            time.sleep(self.poll_interval if deadline is None else max(0, min(self.poll_interval, deadline - time.time())))
+
+    def wait(self, timeout=None):
+        """Returns names of targets which were changed within timeout seconds, None waits for the first event."""
+        if self.fd is None:
+            return self.poll(timeout)
+        deadline = time.time() + timeout if timeout is not None else None
+        changed = set()
+        # Events of other files in watched folders do not end waiting
+        while len(changed) == 0:
+            remaining = max(0, deadline - time.time()) if deadline is not None else None
+            if len(select.select([self.fd], [], [], remaining)[0]) == 0:
+                break
+            data, offset = os.read(self.fd, 65536), 0
+            while offset < len(data):
+                descriptor, mask, cookie, length = self.EVENT.unpack_from(data, offset)
+                name = data[offset + self.EVENT.size:offset + self.EVENT.size + length].rstrip("\0")
+                offset += self.EVENT.size + length
+                if descriptor in self.folders:
+                    changed |= self.match(os.path.join(self.folders[descriptor], name))
+        return changed
+
+class CurlTransport:
+    """Sends JSON-RPC payloads through a pool of reused keep-alive curl handles."""
+    def __init__(self, url, max_in_flight=4, timeout=30):
+        # pycurl is imported only when this transport is used, session transport does not need it
+        global pycurl
+        import pycurl
+        self.url = url
+        self.timeout = timeout
+        # Every slot holds an idle handle, or None until the slot is used first time
+        self.handles = Queue.Queue()
+        for i in range(0, max_in_flight):
+            self.handles.put(None)
+
+    def create_handle(self):
+        handle = pycurl.Curl()
+        handle.setopt(pycurl.URL, self.url)
+        handle.setopt(pycurl.POST, 1)
+        handle.setopt(pycurl.ENCODING, "gzip")
+        handle.setopt(pycurl.TCP_KEEPALIVE, 1)
+        handle.setopt(pycurl.TIMEOUT, self.timeout)
+        handle.setopt(pycurl.NOSIGNAL, 1)
+        handle.setopt(pycurl.HTTPHEADER, ["Content-Type: application/json-rpc", "Connection: keep-alive"])
+        return handle
+
+    def send(self, data):
+        # Blocks while all handles are busy, so it limits the count of requests in flight
+        handle = self.handles.get()
+        try:
+            if handle is None:
+                handle = self.create_handle()
+            buffer = StringIO()
+            handle.setopt(pycurl.POSTFIELDS, data)
+            handle.setopt(pycurl.WRITEFUNCTION, buffer.write)
+            try:
+                handle.perform()
+            except pycurl.error as e:
+                handle.close()
+                handle = None
+                raise ZabbixAPIException("Request to %s failed: %s"%(self.url, e.args[-1]))
+            code = handle.getinfo(pycurl.RESPONSE_CODE)
+        finally:
+            self.handles.put(handle)
+        if code != 200:
+            raise ZabbixAPIException("Request to %s failed with HTTP code %d"%(self.url, code))
+        return buffer.getvalue()
+
+class SessionTransport:
+    """Sends JSON-RPC payloads through the requests session of pyzabbix."""
+    def __init__(self, url, session, max_in_flight=4, timeout=30):
+        self.url = url
+        self.session = session
+        self.timeout = timeout
+        self.in_flight = threading.BoundedSemaphore(max_in_flight)
+
+    def send(self, data):
+        with self.in_flight:
+            response = self.session.post(self.url, data=data, timeout=self.timeout)
+        response.raise_for_status()
+        return response.text
+
+class ZabbixClient(ZabbixAPI):
+    """ZabbixAPI with a pluggable transport and JSON-RPC 2.0 batch requests."""
+    def __init__(self, server, transport="curl", max_in_flight=4, timeout=30):
+        ZabbixAPI.__init__(self, server, timeout=timeout)
+        if transport not in ["curl", "session"]:
+            raise ValueError("Unknown API transport: %s"%(transport))
+        # Transport is created by the first request, so runs which do not call API, e.g. --only config, do not import pycurl
+        self.transport_options = (transport, max_in_flight, timeout)
+        self.id_lock = threading.Lock()
+        # Counters of API calls, calls of batch requests are counted one by one
+        self.calls = 0
+        self.failures = 0
+        # Statistics of HTTP requests by method, a batch request is one entry named by its methods
+        self.stats = CallStats()
+
+    def __getattr__(self, name):
+        if name != "transport":
+            return ZabbixAPI.__getattr__(self, name)
+        with self.id_lock:
+            if name not in self.__dict__:
+                transport, max_in_flight, timeout = self.transport_options
+                if transport == "curl":
+                    self.transport = CurlTransport(self.url, max_in_flight, timeout)
+                else:
+                    self.transport = SessionTransport(self.url, self.session, max_in_flight, timeout)
+        return self.__dict__[name]
+
+    def count(self, calls, failures=0):
+        with self.id_lock:
+            self.calls += calls
+            self.failures += failures
+
+    def build_request(self, method, params=None):
+        with self.id_lock:
+            self.id += 1
+            request_id = self.id
+        request = {"jsonrpc": "2.0", "method": method, "params": params or {}, "id": request_id}
+        if method != "apiinfo.version" and self.auth:
+            request["auth"] = self.auth
+        return request
+
+    def decode(self, data):
+        if not len(data):
+            raise ZabbixAPIException("Received empty response")
+        try:
+            return json.loads(data)
+        except ValueError:
+            raise ZabbixAPIException("Unable to parse json: %s"%(data))
+
+    def check(self, response):
+        if "error" in response:
+            error = response["error"]
+            raise ZabbixAPIException("Error %s: %s, %s"%(error["code"], error["message"], error.get("data", "No data")), error["code"])
+        return response
+
+    def record(self, method, started, data, response, failed):
+        seconds = time.time() - started
+        self.stats.record("api " + method, seconds, len(data), len(response), failed)
+        logger.debug("API %s: %.3f sec, %d bytes sent, %d bytes received.", method, seconds, len(data), len(response))
+
+    def do_request(self, method, params=None):
+        data = json.dumps(self.build_request(method, params))
+        self.count(1)
+        started = time.time()
+        response = ""
+        failed = True
+        try:
+            response = self.transport.send(data)
+            result = self.check(self.decode(response))
+            failed = False
+            return result
+        except Exception:
+            self.count(0, 1)
+            raise
+        finally:
+            self.record(method, started, data, response, failed)
+
+    def batch(self, calls, strict=True):
+        """Sends (method, params) calls as one batch request and returns their results in the same order.
+        The first failed call raises an exception, or exceptions of failed calls are returned instead of results if strict is False."""
+        if len(calls) == 0:
+            return []
+        requests = [self.build_request(method, params) for (method, params) in calls]
+        data = json.dumps(requests)
+        name = "batch[%s]"%(",".join(sorted(set(method for (method, params) in calls))))
+        self.count(len(calls))
+        started = time.time()
+        response = ""
+        try:
+            response = self.transport.send(data)
+            responses = self.decode(response)
+        except Exception:
+            self.count(0, len(calls))
+            self.record(name, started, data, response, True)
+            raise
+        if not isinstance(responses, list):
+            # Whole batch was rejected, e.g. because of invalid request
+            self.count(0, len(calls))
+            self.record(name, started, data, response, True)
+            self.check(responses)
+        responses = dict((item["id"], item) for item in responses)
+        failures = len([item for item in responses.values() if "error" in item])
+        self.count(0, failures)
+        self.record(name, started, data, response, failures > 0)
+        results = []
+        for request in requests:
+            try:
+                results.append(self.check(responses[request["id"]])["result"])
+            except ZabbixAPIException as e:
+                if strict:
+                    raise
+                results.append(e)
+        return results
+
 class Configurator:
     def __init__(self):
         self.url = os.environ["ZBX_SERVER_URL"]
@@ -39,12 +831,10 @@ class Configurator:
         self.uid = ""
         self.hostname = "Zabbix server"
         self.agent_dns_name = os.environ["ZBX_AGENT_HOSTNAME"]
-        self.agent_ip_address = socket.gethostbyname(self.agent_dns_name)
         self.default_agent_port = 10050
         self.default_server_port = 10051
-        # If server is unreachable than try to reconnect self.attempts_max_count times after wait timeout
-        self.connect_attempt_wait_timeout = 5
-        self.connect_attempts_max_count = 30
+        # Dependencies have to become ready and login has to succeed within this count of seconds
+        self.ready_timeout = int(os.environ["ZBX_READY_TIMEOUT"]) if "ZBX_READY_TIMEOUT" in os.environ and os.environ["ZBX_READY_TIMEOUT"].strip() != "" else 150
         # SMTP settings
         self.smtp_server = os.environ["SMTP_SERVER"]
         self.smtp_email = os.environ["SMTP_EMAIL"]
@@ -63,60 +853,153 @@ class Configurator:
         # Custom config structure: examples/custom.json.example
         self.zabbix_custom_config = self.zabbix_config_folder + "/" + os.environ["ZBX_CUSTOM_CONFIG"] if "ZBX_CUSTOM_CONFIG" in os.environ else "custom.json"
         self.custom_config_json = dict()
+        # Fingerprints of imported configuration templates, they allow to skip import of unchanged files
+        self.import_fingerprints_file = self.zabbix_config_folder + "/configuration_fingerprints.json"
+        self.import_fingerprints = None
+        self.import_lock = threading.Lock()
+        # Database connection is shared by steps which run in parallel
+        self.db_lock = threading.Lock()
+        # Database connection, agent address and authentication type are opened by the first step which needs them, see __getattr__
+        self.dependency_lock = threading.RLock()
         # Auto registration
         self.host_metadata = "Linux "+os.environ["DEFAULT_HOST_SECRET"] if "DEFAULT_HOST_SECRET" in os.environ and os.environ["DEFAULT_HOST_SECRET"].strip() != "" else ""
         # Web scenario list
         self.url_list = json.loads(os.environ["URL_LIST"]) if "URL_LIST" in os.environ and os.environ["URL_LIST"].strip() != "" else []
+        # Web checks are web scenarios created through API ("api"), or they are discovered from the URL list file by template ("discovery")
+        self.web_check_mode = os.environ["ZBX_WEB_CHECK_MODE"] if "ZBX_WEB_CHECK_MODE" in os.environ and os.environ["ZBX_WEB_CHECK_MODE"].strip() != "" else "api"
+        # In discovery mode web scenarios created through API are disabled, so their history is kept, or deleted ("delete")
+        self.web_migration = os.environ["ZBX_WEB_MIGRATION"] if "ZBX_WEB_MIGRATION" in os.environ and os.environ["ZBX_WEB_MIGRATION"].strip() != "" else "disable"
+        # Hosts which run web scenarios instead of the managed host, URLs are spread over them by consistent hashing of their names
+        self.web_check_hosts = [x.strip() for x in os.environ["ZBX_WEB_CHECK_HOSTS"].split(",") if x.strip() != ""] if "ZBX_WEB_CHECK_HOSTS" in os.environ else []
+        # Maximum count of objects which are sent within one create/update/delete API call
+        self.api_batch_size = int(os.environ["ZBX_API_BATCH_SIZE"]) if "ZBX_API_BATCH_SIZE" in os.environ and os.environ["ZBX_API_BATCH_SIZE"].strip() != "" else 500
+        # API client settings: transport is "curl" (keep-alive pycurl handles) or "session" (requests session)
+        self.api_transport = os.environ["ZBX_API_TRANSPORT"] if "ZBX_API_TRANSPORT" in os.environ and os.environ["ZBX_API_TRANSPORT"].strip() != "" else "curl"
+        self.api_max_in_flight = int(os.environ["ZBX_API_MAX_IN_FLIGHT"]) if "ZBX_API_MAX_IN_FLIGHT" in os.environ and os.environ["ZBX_API_MAX_IN_FLIGHT"].strip() != "" else 4
+        self.api_timeout = int(os.environ["ZBX_API_TIMEOUT"]) if "ZBX_API_TIMEOUT" in os.environ and os.environ["ZBX_API_TIMEOUT"].strip() != "" else 30
+        # Count of configuration steps which are executed concurrently
+        self.workers = int(os.environ["ZBX_CONFIGURATOR_WORKERS"]) if "ZBX_CONFIGURATOR_WORKERS" in os.environ and os.environ["ZBX_CONFIGURATOR_WORKERS"].strip() != "" else 4
+        # Partitioning of history and trends tables: "day" or "month" partitions, count of partitions which are created in advance
+        self.partition_periods = {
+            "history": os.environ["ZBX_PARTITION_HISTORY_PERIOD"] if "ZBX_PARTITION_HISTORY_PERIOD" in os.environ and os.environ["ZBX_PARTITION_HISTORY_PERIOD"].strip() != "" else "day",
+            "trends": os.environ["ZBX_PARTITION_TRENDS_PERIOD"] if "ZBX_PARTITION_TRENDS_PERIOD" in os.environ and os.environ["ZBX_PARTITION_TRENDS_PERIOD"].strip() != "" else "month"
+        }
+        # Inventory provisioning: count of hosts which are read, compared and applied together; group of hosts without groups
+        self.inventory_chunk_size = int(os.environ["ZBX_INVENTORY_CHUNK_SIZE"]) if "ZBX_INVENTORY_CHUNK_SIZE" in os.environ and os.environ["ZBX_INVENTORY_CHUNK_SIZE"].strip() != "" else 500
+        self.inventory_default_group = "Linux servers"
+        # Users provisioning: count of users which are read, compared and applied together
+        self.users_chunk_size = int(os.environ["ZBX_USERS_CHUNK_SIZE"]) if "ZBX_USERS_CHUNK_SIZE" in os.environ and os.environ["ZBX_USERS_CHUNK_SIZE"].strip() != "" else 500
+        # Host and user groups of provisioned records are created by one chunk at a time, plan mode remembers groups which were already planned
+        self.groups_lock = threading.Lock()
+        self.planned_groups = dict()
+        # Capacity planning: env file for docker-compose, CPUs and memory of the host where server and database run, this host by default
+        # Backup: count of objects which are exported by one configuration.export call
+        self.backup_chunk_size = int(os.environ["ZBX_BACKUP_CHUNK_SIZE"]) if "ZBX_BACKUP_CHUNK_SIZE" in os.environ and os.environ["ZBX_BACKUP_CHUNK_SIZE"].strip() != "" else 50
+        self.capacity_file = os.environ["ZBX_CAPACITY_FILE"] if "ZBX_CAPACITY_FILE" in os.environ and os.environ["ZBX_CAPACITY_FILE"].strip() != "" else self.zabbix_config_folder + "/capacity.env"
+        self.capacity_cpus = int(os.environ["ZBX_CAPACITY_CPUS"]) if "ZBX_CAPACITY_CPUS" in os.environ and os.environ["ZBX_CAPACITY_CPUS"].strip() != "" else multiprocessing.cpu_count()
+        self.capacity_memory = parse_size(os.environ["ZBX_CAPACITY_MEMORY"]) if "ZBX_CAPACITY_MEMORY" in os.environ and os.environ["ZBX_CAPACITY_MEMORY"].strip() != "" else memory_total()
+        self.partitions_ahead = int(os.environ["ZBX_PARTITION_AHEAD"]) if "ZBX_PARTITION_AHEAD" in os.environ and os.environ["ZBX_PARTITION_AHEAD"].strip() != "" else 7
+        self.host_id = ""
+        # Durations and errors of main() steps for timing report and watch mode
+        self.step_durations = dict()
+        self.step_errors = dict()
+        # Watch mode: JSON file which overrides URL_LIST, ZBX_ADMIN_USERS, ZBX_CONFIG and ZBX_ADDITIONAL_TEMPLATES, seconds of quiet after
+        # the last change before steps are run, and file with state and result of the last run
+        self.desired_state_file = os.environ["ZBX_DESIRED_STATE_FILE"] if "ZBX_DESIRED_STATE_FILE" in os.environ and os.environ["ZBX_DESIRED_STATE_FILE"].strip() != "" else ""
+        self.watch_debounce = float(os.environ["ZBX_WATCH_DEBOUNCE"]) if "ZBX_WATCH_DEBOUNCE" in os.environ and os.environ["ZBX_WATCH_DEBOUNCE"].strip() != "" else 2
+        self.status_file = os.environ["ZBX_STATUS_FILE"] if "ZBX_STATUS_FILE" in os.environ and os.environ["ZBX_STATUS_FILE"].strip() != "" else self.zabbix_config_folder + "/configurator_status.json"
+        self.desired_state_fields = dict()
         #
-        self.zapi = ZabbixAPI(self.url)
-        logger.info("Waiting while Zabbix server will be reachable.")
-        for attempt in range(0,self.connect_attempts_max_count):
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            result = sock.connect_ex((self.server_host,self.default_server_port))
-            if result == 0:
-                logger.debug("Server is reachable.")
-                break
-            else:
-                logger.debug("Waiting for while Zabbix will be reachable %d/%d with %d sec interval."%(attempt+1, self.connect_attempts_max_count, self.connect_attempt_wait_timeout))
-                time.sleep(self.connect_attempt_wait_timeout)
-        logger.info("Connecting to Zabbix database.")
-        try:
-            self.db = MySQLdb.connect(
-                host = os.environ["DB_SERVER_HOST"],
-                user = os.environ["MYSQL_USER"],
-                passwd = os.environ["MYSQL_PASSWORD"],
-                db = os.environ["MYSQL_DATABASE"]
-            )
-        except:
-            error("Could not connect to Zabbix database")
+        self.zapi = ZabbixClient(self.url, transport=self.api_transport, max_in_flight=self.api_max_in_flight, timeout=self.api_timeout)
+        # Only hosts which are configured by this run are loaded
+        self.resolver = Resolver(self.zapi, names={"host": [self.hostname] + self.web_check_hosts})
         self.default_authentication_type = 0
-        self.authentication_type = self.get_configuration()["authentication_type"]
         self.configuration = json.loads(os.environ["ZBX_CONFIG"]) if "ZBX_CONFIG" in os.environ and os.environ["ZBX_CONFIG"].strip() != "" else []
         self.admin_users = json.loads(os.environ["ZBX_ADMIN_USERS"]) if "ZBX_ADMIN_USERS" in os.environ and os.environ["ZBX_ADMIN_USERS"].strip() != "" else []
         self.additional_templates = [x.strip() for x in os.environ["ZBX_ADDITIONAL_TEMPLATES"].split(",")] if "ZBX_ADDITIONAL_TEMPLATES" in os.environ else []
+        if self.web_check_mode not in ["api", "discovery"] or self.web_migration not in ["disable", "delete"]:
+            error("Unknown web check mode %s or migration %s."%(self.web_check_mode, self.web_migration))
+        if self.web_check_mode == "discovery" and WEB_DISCOVERY_TEMPLATE not in self.additional_templates:
+            self.additional_templates.append(WEB_DISCOVERY_TEMPLATE)
+        if self.desired_state_file != "" and os.path.isfile(self.desired_state_file):
+            try:
+                self.load_desired_state()
+            except (IOError, ValueError) as e:
+                error("Can not load desired state from %s: %s."%(self.desired_state_file, e))
+
+    def __getattr__(self, name):
+        """Opens database connection, resolves agent address and reads authentication type when they are used first time,
+        so steps which do not need them do not wait for them."""
+        if name not in LAZY_DEPENDENCIES:
+            raise AttributeError(name)
+        with self.dependency_lock:
+            if name not in self.__dict__:
+                if name == "authentication_type":
+                    self.authentication_type = self.get_configuration()["authentication_type"]
+                else:
+                    self.wait_for_dependencies(LAZY_DEPENDENCIES[name])
+        return self.__dict__[name]
+
+    def connect_database(self):
+        # Runs which do not touch database do not need the client library
+        import MySQLdb
+        return MySQLdb.connect(
+            host = os.environ["DB_SERVER_HOST"],
+            user = os.environ["MYSQL_USER"],
+            passwd = os.environ["MYSQL_PASSWORD"],
+            db = os.environ["MYSQL_DATABASE"]
+        )
+
+    def probe_server(self):
+        socket.create_connection((self.server_host, self.default_server_port), 1).close()
+
+    def wait_for(self, probe):
+        name, function = probe
+        started = time.time()
+        try:
+            result = retry(function, self.ready_timeout, on_retry=lambda: self.zapi.stats.retry("probe " + name))
+        except Exception as e:
+            return name, None, "%s is not ready after %d sec: %s."%(name, self.ready_timeout, e)
+        logger.info("%s is ready in %.3f sec."%(name, time.time() - started))
+        return name, result, None
+
+    def wait_for_dependencies(self, names=None):
+        """Waits concurrently while named dependencies, all of them by default, become ready and keeps agent address and database connection."""
+        probes = [(name, function) for name, function in [
+            ("Agent address", lambda: socket.gethostbyname(self.agent_dns_name)),
+            ("Server", self.probe_server),
+            ("Frontend", self.zapi.api_version),
+            ("Database", self.connect_database)
+        ] if names is None or name in names]
+        logger.info("Waiting while %s will be reachable."%(", ".join([name.lower() for name, function in probes])))
+        pool = ThreadPool(len(probes))
+        try:
+            results = pool.map(self.wait_for, probes)
+        finally:
+            pool.close()
+        errors = [message for name, result, message in results if message is not None]
+        if len(errors) > 0:
+            error(" ".join(errors))
+        results = dict((name, result) for name, result, message in results)
+        if "Agent address" in results:
+            self.agent_ip_address = results["Agent address"]
+        if "Database" in results:
+            self.db = InstrumentedConnection(results["Database"], self.zapi.stats)
+
+    def try_login(self):
+        try:
+            self.zapi.login(self.default_admin_username, self.default_admin_password)
+        except:
+            self.zapi.login(self.default_admin_username, self.admin_password)
+            self.default_admin_password=self.admin_password
 
     def login(self):
         logger.debug("Login into Zabbix server (%s)."%(self.url))
-        login_error = False
-        for attempt in range(0,self.connect_attempts_max_count):
-            if login_error:
-                logger.info("Login attemtp %d/%d with %d sec inteval."%(attempt+1, self.connect_attempts_max_count, self.connect_attempt_wait_timeout))
-                time.sleep(self.connect_attempt_wait_timeout)
-            try:
-                self.zapi.login(self.default_admin_username, self.default_admin_password)
-                login_error = False
-                break
-            except:
-                try:
-                    self.zapi.login(self.default_admin_username, self.admin_password)
-                    self.default_admin_password=self.admin_password
-                    login_error = False
-                    break
-                except:
-                    login_error = True
-        if login_error:
-            error("Can not login into Zabbix server after %d attemtps."%(attempt))
-        self.uid = self.zapi.user.get(filter={"alias": self.default_admin_username})[0]["userid"]
+        try:
+            retry(self.try_login, self.ready_timeout, on_retry=lambda: self.zapi.stats.retry("api user.login"))
+        except Exception as e:
+            error("Can not login into Zabbix server within %d sec: %s."%(self.ready_timeout, e))
+        self.uid = self.resolver.id("user", self.default_admin_username)
 
     def logout(self):
         logger.debug("Logout from Zabbix server.")
@@ -136,20 +1019,22 @@ class Configurator:
             return 0
 
     def create_group(self, group_name):
-        group = self.zapi.usergroup.get(filter={"name": group_name})
-        if len(group)>0:
+        group_id = self.resolver.id("usergroup", group_name)
+        if group_id is not None:
             logger.debug("Group with name %s is already exist."%(group_name))
-            return group[0]["usrgrpid"]
+            return group_id
         else:
             logger.debug("Creating group with name: %s."%(group_name))
-            return self.zapi.usergroup.create({
+            group_id = self.zapi.usergroup.create({
                 "name": group_name,
                 "gui_access": 0,
                 "users_status": 0
             })["usrgrpids"][0]
+            self.resolver.put("usergroup", group_name, group_id)
+            return group_id
 
     def add_user_to_group(self, username, group_name):
-        uid=self.zapi.user.get(filter={"alias": username})[0]["userid"]
+        uid=self.resolver.id("user", username)
         logger.debug("Check user is already in group %s."%(group_name))
         try:
             group = self.zapi.usergroup.get(filter={"name": group_name},selectUsers=group_name)[0]
@@ -179,14 +1064,15 @@ class Configurator:
 
     def get_host_info(self, hostname="", host_id=""):
         logger.debug("Retrieving information about host %s."%(hostname))
-        rule = {"host": hostname} if hostname != "" else {"hostid": host_id}
-        return self.zapi.host.get(filter=rule, selectParentTemplates=[])
+        host = self.resolver.get("host", hostname) if hostname != "" else self.resolver.find("host", host_id)
+        return [host] if host is not None else []
 
     def enable_host(self, host_id):
         host = self.get_host_info(host_id=host_id)
         if host[0]["status"] != "0":
             logger.debug("Enabling host with id %s."%(host_id))
             self.zapi.host.update(hostid=host_id, status=0)
+            self.resolver.invalidate("host")
             return 1
         logger.debug("Host with id %s is already enabled."%(host_id))
         return 0
@@ -203,33 +1089,36 @@ class Configurator:
 
     def update_mediatype(self, name, data=dict()):
         try:
-            media=self.zapi.mediatype.get(filter={"description": name})[0]
-            data["mediatypeid"] = media["mediatypeid"]
-            logger.debug("Updating media with next data:")
-            logger.debug(data)
+            data["mediatypeid"] = self.resolver.id("mediatype", name)
+            if data["mediatypeid"] is None:
+                raise ZabbixAPIException("Media type %s does not exist."%(name))
+            logger.debug("Updating media with next data: %s", Payload(data))
             self.zapi.mediatype.update(data)
         except:
             error("Could not update mediatype with name: %s."%(name))
         return 1
 
-    def update_user_email_settings(self, username, email):
-        uid = self.zapi.user.get(filter={"alias": username})[0]["userid"]
+    def email_medias(self, email):
         medias = []
+        delimiter = ","
+        for email_address in email.split(delimiter):
+            if check_email(email_address):
+                logger.debug("Adding email address: %s"%(email_address))
+                medias.append({
+                    "mediatypeid": 1,
+                    "sendto": email_address,
+                    "active": 0,
+                    "severity": self.default_severity,
+                    "period": self.default_notify_period
+                })
+        return medias
+
+    def update_user_email_settings(self, username, email):
+        uid = self.resolver.id("user", username)
         if email.strip() != "":
             logger.debug("Adding new email setting for user %s (uid: %s)."%(username,uid))
-            delimiter = ","
-            for email_address in email.split(delimiter):
-                if check_email(email_address):
-                    logger.debug("Adding email address: %s"%(email_address))
-                    medias.append({
-                        "mediatypeid": 1,
-                        "sendto": email_address,
-                        "active": 0,
-                        "severity": self.default_severity,
-                        "period": self.default_notify_period
-                    })
-            logger.debug("Cleanup current media for user.")
-            self.zapi.user.updatemedia(users=[{"userid": uid}], medias=[])
+            medias = self.email_medias(email)
+            # Media of user are replaced by the call, so they do not need a cleanup before it
             self.zapi.user.updatemedia(
                 users=[{"userid": uid}],
                 medias=medias
@@ -260,121 +1149,204 @@ class Configurator:
         # Check if exist current action or no
         action = self.zapi.action.get(filter={"name": data["name"]})
         if len(action)>0:
-            logger.debug("Action is updated with next data:")
             #  Could not be updated with below element in dict
             del data["eventsource"]
             data["actionid"] = int(action[0]["actionid"])
-            logger.debug(data)
+            logger.debug("Action is updated with next data: %s", Payload(data))
             return self.zapi.action.update(data)
         else:
             logger.debug("Action is created.")
             return self.zapi.action.create(data)
 
-    def add_auto_discovery_action(self, metadata=""):
-        if metadata != "":
-            logger.debug("Generating conditions from metadate elements.")
-            conditions = [ { "conditiontype": 24, "operator": 2, "value": data} for data in metadata.split(" ") ]
-            logger.debug("Adding auto registration action for hosts with metadata: %s."%(metadata if metadata != "" else "not defined" ))
-            data = {
-                "name": "Auto registration rules for Linux servers",
-                "eventsource": 2,
-                "status": 0,
-                "operations": [
-                    { "operationtype": 2 },
-                    { "operationtype": 4, "opgroup": [ self.zapi.hostgroup.get(filter={"name": "Linux servers"})[0]["groupid"] ] },
-                    { "operationtype": 6, "optemplate": [ { "templateid": self.zapi.template.get(filter={"name": "Template OS Linux"})[0]["templateid"] } ] },
-                    {
-                        "operationtype": 0,
-                        "opmessage_grp": [{ "usrgrpid": self.zapi.usergroup.get(filter={"name": self.default_admin_group})[0]["usrgrpid"] }],
-                        "opmessage": { "mediatypeid": 0, "default_msg": 1}
-                    }
-                ],
-                "def_shortdata": "Auto registration: {HOST.HOST}",
-                "def_longdata":
+    def auto_discovery_action(self, metadata, group_id, template_id, usrgrp_id):
+        logger.debug("Generating conditions from metadate elements.")
+        conditions = [ { "conditiontype": 24, "operator": 2, "value": data} for data in metadata.split(" ") ]
+        return {
+            "name": "Auto registration rules for Linux servers",
+            "eventsource": 2,
+            "status": 0,
+            "operations": [
+                { "operationtype": 2 },
+                { "operationtype": 4, "opgroup": [ group_id ] },
+                { "operationtype": 6, "optemplate": [ { "templateid": template_id } ] },
+                {
+                    "operationtype": 0,
+                    "opmessage_grp": [{ "usrgrpid": usrgrp_id }],
+                    "opmessage": { "mediatypeid": 0, "default_msg": 1}
+                }
+            ],
+            "def_shortdata": "Auto registration: {HOST.HOST}",
+            "def_longdata":
 '''
 Host name: {HOST.HOST}
 Host IP: {HOST.IP}
 Agent port: {HOST.PORT}''',
-                "filter": {
-                    "evaltype": 1,
-                    "conditions": conditions
-                }
+            "filter": {
+                "evaltype": 1,
+                "conditions": conditions
             }
-            return self.add_action(data)
+        }
+
+    def add_auto_discovery_action(self, metadata=""):
+        if metadata != "":
+            logger.debug("Adding auto registration action for hosts with metadata: %s."%(metadata if metadata != "" else "not defined" ))
+            self.resolver.prefetch(["hostgroup", "template", "usergroup"])
+            return self.add_action(self.auto_discovery_action(metadata, self.resolver.id("hostgroup", "Linux servers"), self.resolver.id("template", "Template OS Linux"), self.resolver.id("usergroup", self.default_admin_group)))
         else:
             logger.debug("Host metadata empty, such action is impossible to add because of security reason.")
             return 0
 
+    def web_shards(self, server, url_list):
+        """Returns (host, URLs) pairs of hosts which run web scenarios. Without ZBX_WEB_CHECK_HOSTS all URLs belong to the server host,
+        otherwise the server host is kept in the list with no URLs, so its scenarios are cleaned up."""
+        if len(self.web_check_hosts) == 0:
+            return [(server, url_list)]
+        ring = HashRing(self.web_check_hosts)
+        shards = dict()
+        for name in self.web_check_hosts:
+            host = self.resolver.get("host", name)
+            if host is None:
+                raise ZabbixAPIException("Web check host %s does not exist."%(name))
+            shards[name] = (host, [])
+        for item in url_list:
+            shards[ring.get(item["name"])][1].append(item)
+        shards.setdefault(server["host"], (server, []))
+        return [shards[name] for name in sorted(shards.keys())]
+
+    def web_state(self, server, url_list):
+        """Returns (host, URLs, web scenarios, triggers) of every host which runs web scenarios."""
+        result = []
+        for host, urls in self.web_shards(server, url_list):
+            http_tests, triggers = self.get_web_scenarios(host["hostid"])
+            result.append((host, urls, http_tests, triggers))
+        return result
+
+    def web_changes(self, state, cleanup=True):
+        """Returns changes of web scenarios of all check hosts, scenarios which moved to another host are deleted first."""
+        stale, changes = [], []
+        for host, urls, http_tests, triggers in state:
+            if cleanup:
+                stale += self.stale_web_scenario_changes(http_tests, urls)
+            changes += self.web_scenario_changes(host["hostid"], host["host"], urls, http_tests, triggers)
+        return stale + changes
+
+    def web_migration_changes(self, state, host_id, url_list):
+        """Returns changes which retire web scenarios created through API in discovery mode. Scenario of a listed URL is retired
+        only after the discovered probe item of the URL on the managed host received data, so monitoring has no gap."""
+        urls = dict((item["name"], item["url"]) for item in url_list)
+        http_tests = [(name, http_test) for host, names, current, triggers in state for name, http_test in sorted(current.items())]
+        if len(http_tests) == 0:
+            return []
+        keys = [item_key(WEB_PROBE_STATUS_KEY, urls[name]) for name, http_test in http_tests if name in urls]
+        probed = set(item["key_"] for item in self.zapi.item.get(hostids=host_id, output=["key_", "lastclock"], filter={"key_": keys}) if int(item["lastclock"]) > 0) if len(keys) > 0 else set()
+        changes = []
+        for name, http_test in http_tests:
+            if name in urls and item_key(WEB_PROBE_STATUS_KEY, urls[name]) not in probed:
+                logger.debug("Discovered probe of %s has no data yet. Web scenario is kept."%(name))
+            elif name not in urls or self.web_migration == "delete":
+                changes.append(Change("httptest", name, "delete", "httptest.delete", http_test["httptestid"]))
+            elif int(http_test["status"]) == 0:
+                # Items of disabled scenario keep their history, its trigger is not evaluated anymore
+                changes.append(Change("httptest", name, "update", "httptest.update", {"httptestid": http_test["httptestid"], "status": 1}, "status"))
+        return changes
+
+    def web_scenario_changes(self, host_id, host_name, url_list, http_tests, triggers):
+        """Returns changes of web scenarios and their triggers, current objects are indexed by name/description."""
+        http_test_changes, trigger_changes = [], []
+        for item in url_list:
+            logger.debug("Web check: %s", Payload(item))
+            priority = item["priority"] if "priority" in item else 1
+            template = {
+                "hostid": host_id,
+                "name": item["name"],
+                "delay": 60,
+                "retries": 3,
+                "steps": [{
+                    "no": 1,
+                    "name": "Step #1",
+                    "url": item["url"],
+                    "status_codes": "200",
+                    "follow_redirects": 1,
+                    "retrieve_mode": 0
+                }]
+            }
+            http_test = http_tests.get(item["name"])
+            if http_test is None:
+                http_test_changes.append(Change("httptest", item["name"], "create", "httptest.create", template))
+            elif len(http_test["steps"]) > 0 and http_test["steps"][0]["url"] == template["steps"][0]["url"]:
+                logger.debug("No changed were detected. Skipped updating the web scenario.")
+            else:
+                template["httptestid"] = http_test["httptestid"]
+                del template["hostid"]
+                http_test_changes.append(Change("httptest", item["name"], "update", "httptest.update", template, "url"))
+
+            trigger = {
+                "description": "Health status of %s"%(item["name"]),
+                "expression": "{"+host_name+":web.test.fail["+item["name"]+"].last(0)} <> 0",
+                "priority": priority,
+                "url": item["url"]
+            }
+            current_trigger = triggers.get(trigger["description"])
+            if current_trigger is None:
+                trigger["type"] = 0
+                trigger_changes.append(Change("trigger", trigger["description"], "create", "trigger.create", trigger))
+            # Server stores expression in normalized form, without spaces around operators
+            elif current_trigger["expression"].replace(" ", "") != trigger["expression"].replace(" ", "") or int(current_trigger["priority"]) != int(priority) or current_trigger["url"] != trigger["url"]:
+                trigger["triggerid"] = current_trigger["triggerid"]
+                trigger_changes.append(Change("trigger", trigger["description"], "update", "trigger.update", trigger))
+            else:
+                logger.debug("No changed were detected. Skipped updating the trigger.")
+        # Triggers refer to web.test.fail items, so web scenarios have to be saved first
+        return http_test_changes + trigger_changes
+
+    def stale_web_scenario_changes(self, http_tests, url_list):
+        names = set(item["name"] for item in url_list)
+        return [Change("httptest", name, "delete", "httptest.delete", item["httptestid"]) for name, item in sorted(http_tests.items()) if name not in names]
+
+    def get_web_scenarios(self, host_id):
+        logger.debug("Retrieving current web scenarios and triggers of host with id %s."%(host_id))
+        http_tests, triggers = self.zapi.batch([
+            ("httptest.get", {"hostids": host_id, "output": ["httptestid", "name", "status"], "selectSteps": ["url"]}),
+            ("trigger.get", {"hostids": host_id, "output": ["triggerid", "description", "expression", "priority", "url"], "expandExpression": True})
+        ])
+        return index(http_tests, "name"), index(triggers, "description")
+
     def add_web_scenario(self, host_id, url_list):
         logger.debug("Processing adding urls for monitoring.")
-        self.custom_config_json["web"] = list()
+        self.custom_config_json["web"] = self.web_config(url_list)
+        if self.web_check_mode == "discovery":
+            logger.debug("Web checks are discovered by %s from the URL list file."%(WEB_DISCOVERY_TEMPLATE))
+            return 0
         if len(url_list)>0:
-            host_name = self.get_host_info(host_id=host_id)[0]["name"]
-            for item in url_list:
-                logger.debug(item)
-                priority = item["priority"] if "priority" in item else 1
-                http_test = self.zapi.httptest.get(filter={"name": item["name"]}, hostids=host_id, selectSteps="extend")
-                self.custom_config_json["web"].append({"name": item["name"], "url": item["url"], "priority": priority})
-                template = {
-                    "hostid": host_id,
-                    "name": item["name"],
-                    "delay": 60,
-                    "retries": 3,
-                    "steps": [{
-                        "no": 1,
-                        "name": "Step #1",
-                        "url": item["url"],
-                        "status_codes": "200",
-                        "follow_redirects": 1,
-                        "retrieve_mode": 0
-                    }]
-                }
-                if len(http_test) > 0:
-                    if http_test[0]["name"] == template["name"] and http_test[0]["steps"][0]["url"] == template["steps"][0]["url"]:
-                        logger.debug("No changed were detected. Skipped updating the web scenario.")
-                    else:
-                        template["httptestid"] = http_test[0]["httptestid"]
-                        del template["hostid"]
-                        self.zapi.httptest.update(template)
-                else:
-                    self.zapi.httptest.create(template)
-
-                trigger = {
-                    "description": "Health status of %s"%(item["name"]),
-                    "expression": "{"+host_name+":web.test.fail["+item["name"]+"].last(0)} <> 0",
-                    "priority": priority,
-                    "url": item["url"]
-                }
-
-                current_trigger = self.zapi.trigger.get(filter={"description": trigger["description"]})
-                if len(current_trigger)>0:
-                    trigger["triggerid"] = current_trigger[0]["triggerid"]
-                    try:
-                        self.update_trigger(trigger)
-                    except:
-                        error("Can not update the trigger with id %s."%(trigger["triggerid"]))
-                else:
-                    try:
-                        self.create_trigger(trigger)
-                    except:
-                        error("Can not create the trigger.")
+            try:
+                changes = self.web_changes(self.web_state(self.get_host_info(host_id=host_id)[0], url_list), cleanup=False)
+                logger.debug("Web scenarios and triggers to create or update: %d."%(len(changes)))
+                self.apply(changes)
+            except ZabbixAPIException as e:
+                error("Can not save the web scenarios: %s."%(e))
             return 1
         else:
             return 0
 
     def cleanup_undefined_web_scenario(self, host_id, url_list):
-        http_test = self.zapi.httptest.get(hostids=host_id)
-        cleanup = False
-        for item in http_test:
-            key = next((index for (index, d) in enumerate(url_list) if d["name"] == item["name"]), None)
-            if (key is None):
-                logger.debug("Removing web check for item with name: %s."%(item["name"]))
-                self.zapi.httptest.delete(int(item["httptestid"]))
-                cleanup = True
-        if (cleanup):
+        if self.web_check_mode == "discovery":
+            changes = self.web_migration_changes(self.web_state(self.get_host_info(host_id=host_id)[0], url_list), host_id, url_list)
+            self.apply(changes)
+            return 1 if len(changes) > 0 else 0
+        changes = []
+        for host, urls in self.web_shards(self.get_host_info(host_id=host_id)[0], url_list):
+            http_tests = index(self.zapi.httptest.get(hostids=host["hostid"], output=["httptestid", "name"]), "name")
+            changes += self.stale_web_scenario_changes(http_tests, urls)
+        for change in changes:
+            logger.debug("Removing web check for item with name: %s."%(change.name))
+        self.apply(changes)
+        if len(changes)>0:
             return 1
         return 0
 
+    def web_config(self, url_list):
+        return [{"name": item["name"], "url": item["url"], "priority": item["priority"] if "priority" in item else 1} for item in url_list]
+
     def create_item(self, data):
         item = self.zapi.item.get(filter={"name": data["name"]})
         if len(item)==0:
@@ -392,26 +1364,25 @@ Agent port: {HOST.PORT}''',
         data["type"] = 0
         trigger = self.zapi.trigger.get(filter={"description": data["description"]})
         if len(trigger)==0:
-            logger.debug("Creating trigger.")
-            logger.debug(data)
+            logger.debug("Creating trigger: %s", Payload(data))
             return self.zapi.trigger.create(data)
         else:
             data["triggerid"] = trigger[0]["triggerid"]
             return self.update_trigger(data)
 
     def update_trigger(self, data):
-        logger.debug("Updating trigger.")
-        logger.debug(data)
+        logger.debug("Updating trigger: %s", Payload(data))
         return self.zapi.trigger.update(data)
 
     def get_configuration(self):
-        cur = self.db.cursor()
-        cur.execute("SELECT * FROM config")
-        field = [i[0] for i in cur.description]
-        result=dict()
-        for i, row in enumerate(cur.fetchone()):
-              result[field[i]]=row
-        cur.close()
+        with self.db_lock:
+            cur = self.db.cursor()
+            cur.execute("SELECT * FROM config")
+            field = [i[0] for i in cur.description]
+            result=dict()
+            for i, row in enumerate(cur.fetchone()):
+                  result[field[i]]=row
+            cur.close()
         return result
 
     def update_configuration(self, config=dict()):
@@ -422,126 +1393,375 @@ Agent port: {HOST.PORT}''',
                 if current[key] == value:
                     del config[key]
         if len(config)>0:
-            logger.debug("Updating configuration.")
-            logger.debug(config)
-            query = "UPDATE config SET "
-            i = 0
-            length = len(config)
-            for key, value in config.iteritems():
-                i += 1
-                if isinstance(value,int):
-                    query += "%s=%d"%(key,value)
-                else:
-                    query += "%s='%s'"%(key,value)
-                if i<length:
-                    query += ","
+            logger.debug("Updating configuration: %s", Payload(config))
+            self.write_configuration(config)
+            return 1
+        return 0
 
-            logger.debug(query)
+    def write_configuration(self, config):
+        # Column names are known keys of config table, values are passed as query parameters
+        keys = sorted(config.keys())
+        query = "UPDATE config SET " + ",".join(["%s=%%s"%(key) for key in keys])
+        logger.debug(query)
+        with self.db_lock:
             cur = self.db.cursor()
-            cur.execute(query)
+            cur.execute(query, [config[key] for key in keys])
             self.db.commit()
             cur.close()
-            return 1
+
+    def query(self, query, params=None):
+        with self.db_lock:
+            cur = self.db.cursor()
+            cur.execute(query, params)
+            rows = cur.fetchall()
+            cur.close()
+        return rows
+
+    def partition_statements(self, table, period, retention, now):
+        """Returns ALTER TABLE statements which partition the table, add future partitions and drop expired ones."""
+        rows = self.query("SELECT partition_name, partition_description FROM information_schema.partitions WHERE table_schema = DATABASE() AND table_name = %s ORDER BY partition_ordinal_position", [table])
+        if len([name for name, bound in rows if name is not None and not str(bound).isdigit()]) > 0:
+            raise ValueError("Table %s is partitioned not by clock ranges"%(table))
+        partitions = [(name, int(bound)) for name, bound in rows if name is not None]
+        # Current period and partitions_ahead periods after it
+        end = partition_start(now, period)
+        for i in range(0, self.partitions_ahead + 1):
+            end = next_partition(end, period)
+        if len(partitions) == 0:
+            oldest = self.query("SELECT MIN(clock) FROM %s"%(table))[0][0]
+            # Rows which are older than retention get into the first partition, it is dropped when it expires
+            start = max(oldest, now - retention) if oldest is not None else now
+            ranges = ", ".join(["PARTITION %s VALUES LESS THAN (%d)"%(name, bound) for name, bound in partition_ranges(start, end, period)])
+            return ["ALTER TABLE %s PARTITION BY RANGE (clock) (%s)"%(table, ranges)]
+        statements = []
+        future = partition_ranges(partitions[-1][1], end, period)
+        if len(future) > 0:
+            statements.append("ALTER TABLE %s ADD PARTITION (%s)"%(table, ", ".join(["PARTITION %s VALUES LESS THAN (%d)"%(name, bound) for name, bound in future])))
+        # The last partition is kept anyway, table can not lose all partitions by DROP PARTITION
+        expired = [name for name, bound in partitions[:-1] if bound <= now - retention]
+        if len(expired) > 0:
+            statements.append("ALTER TABLE %s DROP PARTITION %s"%(table, ", ".join(expired)))
+        return statements
+
+    def partition(self, dry_run=False):
+        """Manages partitions of history and trends tables, housekeeper does not clean them after that."""
+        for kind, period in self.partition_periods.items():
+            if period not in ["day", "month"]:
+                error("Unknown partition period of %s: %s."%(kind, period))
+        config = self.get_configuration()
+        now = int(time.time())
+        statements = []
+        for table, kind in PARTITION_TABLES:
+            retention = parse_period(config["hk_" + kind])
+            logger.debug("Partitions of %s: %s, retention %d sec."%(table, self.partition_periods[kind], retention))
+            try:
+                statements += self.partition_statements(table, self.partition_periods[kind], retention, now)
+            except ValueError as e:
+                error("Can not manage partitions: %s."%(e))
+        housekeeper = dict((key, 0) for key in ["hk_history_mode", "hk_trends_mode"] if config[key] != 0)
+        if dry_run:
+            for statement in statements:
+                print statement + ";"
+            if len(housekeeper) > 0:
+                print "UPDATE config SET " + ",".join(["%s=0"%(key) for key in sorted(housekeeper)]) + ";"
+            print "Plan: %d statements."%(len(statements) + (1 if len(housekeeper) > 0 else 0))
+            return 0
+        for statement in statements:
+            logger.info("Executing: %s"%(statement if len(statement) < 200 else statement[:200] + "..."))
+            started = time.time()
+            self.query(statement)
+            logger.debug("Executed in %.3f sec."%(time.time() - started))
+        # Dropping of partitions replaces the housekeeper for these tables
+        if self.update_configuration(housekeeper):
+            logger.info("Disabled housekeeper for history and trends.")
+        return 0
+
+    def capacity(self, dry_run=False):
+        """Sizes Zabbix server and InnoDB by enabled objects of monitored hosts and writes them as env file for docker-compose."""
+        started = time.time()
+        with self.db_lock:
+            counts = gather(self.db)
+        database_size = int(self.query("SELECT COALESCE(SUM(data_length + index_length), 0) FROM information_schema.tables WHERE table_schema = DATABASE()")[0][0])
+        logger.info("Gathered %d hosts, %d items, %.2f values per second and %s of data in %.3f sec."%(
+            counts["hosts"], counts["items"], counts["nvps"], format_size(database_size), time.time() - started))
+        settings, warnings = recommend(counts, self.capacity_cpus, self.capacity_memory, database_size)
+        for message in warnings:
+            logger.warning(message)
+        overlay = render_env(settings, counts, self.capacity_cpus, self.capacity_memory)
+        if dry_run:
+            print overlay,
+            return 0
+        with open(self.capacity_file + ".tmp", "w") as f:
+            f.write(overlay)
+        os.rename(self.capacity_file + ".tmp", self.capacity_file)
+        logger.info("Saved recommended settings into %s."%(self.capacity_file))
         return 0
 
     def add_user(self, user=dict(), groups=list(), user_type=1):
         # Check if such user is already exist in database
-        u = self.zapi.user.get(filter={"alias": user["name"]})
-        if len(u) == 0:
+        if self.resolver.id("user", user["name"]) is None:
             logger.debug("Such user does not exist. Adding.")
-            self.zapi.user.create({
+            result = self.zapi.user.create({
                 "alias": user["name"],
                 "passwd": user["password"],
                 "usrgrps": groups,
                 "type": user_type
             })
+            self.resolver.put("user", user["name"], result["userids"][0])
             return 1
         return 0
 
     def import_configuration(self):
-        configuration_format = "xml"
-        files_list = []
-        rules = {
-            "applications": {
-                "createMissing": True
-            },
-            "discoveryRules": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-            "graphs": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-            "groups": {
-                "createMissing": True
-            },
-            "hosts": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-            "images": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-            "items": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-            "maps": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-            "screens": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-            "templateLinkage": {
-                "createMissing": True
-            },
-            "templates": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-            "templateScreens": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-            "triggers": {
-                "createMissing": True,
-                "updateExisting": True
-            },
-        }
         logger.debug("Finding configuration in folder: %s."%(self.configuration_folder))
-        if os.access(self.configuration_folder, os.R_OK):
-            templates_count = 0
-            for filename in os.listdir(self.configuration_folder):
-                if filename.endswith(configuration_format):
-                    files_list.append(filename)
-                    with open(self.configuration_folder+"/"+filename) as f:
-                        source = f.read()
-                        try:
-                            self.zapi.confimport(configuration_format, source, rules)
-                        except ZabbixAPIException as e:
-                            error(e)
-                    logger.debug("Configuration %s was imported/updated."%(filename))
-                    templates_count += 1
-            if templates_count == 0:
-                logger.debug("No configuration was found.")
-                return 0
-            logger.debug("Was found next list of configratuin templates:")
-            logger.debug(files_list)
-        else:
+        if not os.access(self.configuration_folder, os.R_OK):
             error("Could not access to configuration folder.")
-
+        files = self.configuration_files()
+        if len(files) == 0:
+            logger.debug("No configuration was found.")
+            return 0
+        logger.debug("Was found next list of configratuin templates: %s", Payload(sorted(files.keys())))
+        existing = set(template["host"] for template in self.zapi.template.get(filter={"host": sum([item["templates"] for item in files.values()], [])}, output=["host"]))
+        changed = [filename for filename in sorted(files.keys()) if self.import_required(filename, files[filename], existing)]
+        try:
+            self.import_files(changed, files)
+        finally:
+            self.save_import_fingerprints()
         return 1
 
+    def import_files(self, filenames, files, folder=None):
+        """Imports files layer by layer, files of one layer are imported in parallel."""
+        pool = ThreadPool(self.workers)
+        try:
+            for layer in self.import_order(filenames, files):
+                logger.debug("Importing configuration in parallel: %s."%(", ".join(layer)))
+                for filename, e in zip(layer, pool.map(lambda filename: self.try_import_file(filename, folder), layer)):
+                    if e is not None:
+                        error(e)
+                    logger.debug("Configuration %s was imported/updated."%(filename))
+        finally:
+            pool.close()
+
+    def try_import_file(self, filename, folder=None):
+        try:
+            self.import_file(filename, folder)
+        except ZabbixAPIException as e:
+            return e
+        return None
+
+    def import_file(self, filename, folder=None):
+        """Imports file of configuration folder, fingerprints are not remembered for files of another folder."""
+        with open((folder or self.configuration_folder)+"/"+filename) as f:
+            result = self.zapi.confimport("xml", f.read(), IMPORT_RULES)
+        self.resolver.invalidate("template")
+        if folder is None:
+            with self.import_lock:
+                self.load_import_fingerprints()[filename] = self.import_fingerprint(filename)
+        return result
+
+    def import_fingerprint(self, filename):
+        """Returns hash of file content together with rules which are used for its import."""
+        fingerprint = hashlib.sha256()
+        with open(self.configuration_folder+"/"+filename, "rb") as f:
+            for block in iter(lambda: f.read(65536), b""):
+                fingerprint.update(block)
+        fingerprint.update(json.dumps(IMPORT_RULES, sort_keys=True))
+        return fingerprint.hexdigest()
+
+    def load_import_fingerprints(self):
+        if self.import_fingerprints is None:
+            try:
+                with open(self.import_fingerprints_file) as f:
+                    self.import_fingerprints = json.load(f)
+            except (IOError, ValueError):
+                self.import_fingerprints = dict()
+        return self.import_fingerprints
+
+    def save_import_fingerprints(self):
+        with self.import_lock:
+            if self.import_fingerprints is None:
+                return
+            try:
+                with open(self.import_fingerprints_file, "w") as target:
+                    json.dump(self.import_fingerprints, target, indent=4, sort_keys=True)
+            except IOError:
+                logger.error("Fingerprints of imported configuration can not be saved into %s."%(self.import_fingerprints_file))
+
+    def import_required(self, filename, definition, existing_templates):
+        """File is imported if it was changed since the last import or any of its templates is missing on the server."""
+        if options["force_import"]:
+            return True
+        missing = [name for name in definition["templates"] if name not in existing_templates]
+        if len(missing) > 0:
+            logger.debug("Configuration %s defines missing templates: %s."%(filename, ", ".join(missing)))
+            return True
+        if self.load_import_fingerprints().get(filename) != self.import_fingerprint(filename):
+            logger.debug("Configuration %s was changed since the last import."%(filename))
+            return True
+        logger.debug("Configuration %s was not changed. Skipped."%(filename))
+        return False
+
+    def import_order(self, filenames, files):
+        """Splits files into layers, templates which are linked by files of a layer are defined by previous layers."""
+        owners = dict()
+        for filename in filenames:
+            for name in files[filename]["templates"] + files[filename]["hosts"]:
+                owners[name] = filename
+        pending = list(filenames)
+        layers = []
+        while len(pending) > 0:
+            layer = [filename for filename in pending if all(owners.get(name, filename) == filename or owners[name] not in pending for name in files[filename]["links"])]
+            if len(layer) == 0:
+                logger.debug("Templates have circular links, remaining files are imported together.")
+                layer = pending
+            layers.append(layer)
+            pending = [filename for filename in pending if filename not in layer]
+        return layers
+
+    def configuration_files(self, folder=None):
+        """Returns names of templates and hosts which are defined by every xml file in configuration folder,
+        and names of templates and hosts which are linked by its templates, hosts and maps."""
+        result = dict()
+        folder = folder or self.configuration_folder
+        if folder != "" and os.access(folder, os.R_OK):
+            for filename in sorted(os.listdir(folder)):
+                if filename.endswith("xml"):
+                    root = ElementTree.parse(folder+"/"+filename).getroot()
+                    result[filename] = {
+                        "templates": [element.text for element in root.findall("./templates/template/template")],
+                        "hosts": [element.text for element in root.findall("./hosts/host/host")],
+                        "links": [element.text for path in ["./templates/template/templates/template/name", "./hosts/host/templates/template/name",
+                            "./maps/map/selements/selement/elements/element/host"] for element in root.findall(path)]
+                    }
+        return result
+
+    def backup_chunk(self, kind, bucket, ids):
+        """Exports objects of one bucket and returns the bucket, its XML and hashes of its objects by name."""
+        started = time.time()
+        option, method, id_field, condition, path, name_field = [item for item in BACKUP_TYPES if item[0] == kind][0]
+        data = self.zapi.configuration.export(format="xml", options={kind: ids}).encode("utf-8")
+        objects = dict((element.findtext(name_field), hashlib.sha256(ElementTree.tostring(element, encoding="utf-8")).hexdigest())
+            for element in ElementTree.fromstring(data).findall(path))
+        logger.debug("Exported %d %s of %s in %.3f sec."%(len(ids), kind, bucket, time.time() - started))
+        return kind, bucket, data, objects
+
+    def load_backup_manifest(self, folder):
+        try:
+            with open(folder+"/manifest.json") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {"buckets": {}, "members": []}
+
+    def backup_buckets(self, kind, ids, count):
+        """Returns ids by bucket name. Objects are assigned to buckets by consistent hashing of their ids, so creating or deleting
+        an object changes only its own bucket, and adding buckets for a growing count of objects moves only a part of objects."""
+        ring = HashRing(["%s-%03d"%(kind, number) for number in range(0, count)])
+        buckets = dict()
+        for object_id in ids:
+            buckets.setdefault(ring.get(object_id), []).append(object_id)
+        return buckets
+
+    def backup(self, folder, full=False):
+        """Exports templates, hosts and maps by buckets of ids into a new gzip compressed tar archive in folder.
+        Manifest of the archive lists every member with hash of its content and hashes of its objects. Bucket whose objects
+        have the same hashes as in the previous backup is not written again unless full is set, manifest refers to its archive instead.
+        Zabbix does not keep modification time of objects, so all objects are exported to compute their hashes."""
+        switched = self.authentication_type != self.default_authentication_type
+        if switched:
+            self.use_default_authentication()
+        self.login()
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        previous = {"buckets": {}, "members": []} if full else self.load_backup_manifest(folder)
+        members = dict((member["name"], member) for member in previous["members"] if os.path.isfile(folder+"/"+member["archive"]))
+        name = time.strftime("backup-%Y%m%d-%H%M%S.tar.gz", time.gmtime())
+        manifest = {"created": int(time.time()), "archive": name, "buckets": dict(), "members": []}
+        part = folder+"/"+name+".part"
+        archive = tarfile.open(part, "w:gz")
+        pool = ThreadPool(self.workers)
+        try:
+            tasks = []
+            calls = [(method, {"output": [id_field], "filter": condition}) for kind, method, id_field, condition, path, name_field in BACKUP_TYPES]
+            for (kind, method, id_field, condition, path, name_field), objects in zip(BACKUP_TYPES, self.zapi.batch(calls)):
+                ids = [item[id_field] for item in objects]
+                # Count of buckets only grows, so objects stay in their buckets while their count is stable
+                count = max(previous["buckets"].get(kind, 1), int(math.ceil(float(len(ids)) / self.backup_chunk_size)))
+                manifest["buckets"][kind] = count
+                buckets = self.backup_buckets(kind, ids, count)
+                logger.debug("Found %d %s in %d buckets."%(len(ids), kind, len(buckets)))
+                tasks += [(kind, bucket, sorted(buckets[bucket], key=int)) for bucket in sorted(buckets.keys())]
+            # Buckets are exported in parallel and written in their order as soon as they are exported
+            for kind, bucket, data, objects in pool.imap(lambda task: self.backup_chunk(*task), tasks):
+                member = bucket + ".xml"
+                if member in members and members[member]["objects"] == objects:
+                    manifest["members"].append(members[member])
+                    continue
+                add_archive_member(archive, member, data)
+                manifest["members"].append({"kind": kind, "name": member, "archive": name, "sha256": hashlib.sha256(data).hexdigest(), "objects": objects})
+            add_archive_member(archive, "manifest.json", json.dumps(manifest, indent=4, sort_keys=True))
+            archive.close()
+            # Complete archive name marks the backup as finished, manifest of the folder is replaced after it
+            os.rename(part, folder+"/"+name)
+        except ZabbixAPIException as e:
+            error("Backup failed: %s."%(e))
+        finally:
+            pool.terminate()
+            archive.close()
+            if os.path.exists(part):
+                os.remove(part)
+            if switched:
+                self.restore_authentication()
+        with open(folder+"/manifest.json.tmp", "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
+        os.rename(folder+"/manifest.json.tmp", folder+"/manifest.json")
+        written = len([member for member in manifest["members"] if member["archive"] == name])
+        logger.info("Backed up %d objects in %d buckets into %s, %d buckets were not changed."%(
+            sum([len(member["objects"]) for member in manifest["members"]]), len(manifest["members"]), name, len(manifest["members"]) - written))
+        self.logout()
+        return 0
+
+    def restore(self, path):
+        """Imports objects of backup archive, members which were not changed since earlier backups are read from their archives
+        in the same folder. Templates, hosts and maps are imported in order of their links like configuration folder."""
+        try:
+            with tarfile.open(path) as archive:
+                manifest = json.load(archive.extractfile("manifest.json"))
+        except (IOError, KeyError, ValueError, tarfile.TarError) as e:
+            error("Can not read manifest of backup %s: %s."%(path, e))
+        folder = tempfile.mkdtemp(prefix="restore-")
+        try:
+            for name, members in itertools.groupby(sorted(manifest["members"], key=lambda member: member["archive"]), key=lambda member: member["archive"]):
+                try:
+                    with tarfile.open(os.path.join(os.path.dirname(path), name)) as archive:
+                        for member in members:
+                            data = archive.extractfile(member["name"]).read()
+                            if hashlib.sha256(data).hexdigest() != member["sha256"]:
+                                error("Member %s of backup %s is damaged."%(member["name"], name))
+                            with open(folder+"/"+member["name"], "wb") as f:
+                                f.write(data)
+                except (IOError, KeyError, tarfile.TarError) as e:
+                    error("Can not read backup %s: %s."%(name, e))
+            switched = self.authentication_type != self.default_authentication_type
+            if switched:
+                self.use_default_authentication()
+            self.login()
+            try:
+                files = self.configuration_files(folder)
+                self.import_files(sorted(files.keys()), files, folder)
+            finally:
+                if switched:
+                    self.restore_authentication()
+        finally:
+            shutil.rmtree(folder)
+        logger.info("Restored %d objects of %d chunks from %s."%(sum([len(member["objects"]) for member in manifest["members"]]), len(manifest["members"]), path))
+        self.logout()
+        return 0
+
     def save_json_config(self, source_json_object = dict(), target_file = ""):
         logger.debug("Saving json object into %s"%target_file)
         if (len(source_json_object) == 0):
             logger.debug("No elements were found in json object.")
             return 0
-        logger.debug(source_json_object)
+        logger.debug("Custom config: %s", Payload(source_json_object))
         try:
             with open(target_file, "w") as target:
                 json.dump(source_json_object, target, indent=4, sort_keys=True)
@@ -552,14 +1772,14 @@ Agent port: {HOST.PORT}''',
 
     def get_template_info(self, name="", id=""):
         logger.debug("Retrieving information about template {:s}.".format(name))
-        rule = {"host": name} if name != "" else {"id": id}
-        return self.zapi.template.get(filter=rule)
+        template = self.resolver.get("template", name) if name != "" else self.resolver.find("template", id)
+        return [template] if template is not None else []
 
     def assign_template(self, host_id, template_name):
         template_id = self.get_template_info(name=template_name)[0]["templateid"]
         logger.debug("Template id: {:s}".format(template_id))
         logger.debug("Assigning template {:s} with host id {:s}".format(template_name,host_id))
-        current_templates = self.get_host_info(host_id=host_id)[0]["parentTemplates"]
+        current_templates = [{"templateid": item["templateid"]} for item in self.get_host_info(host_id=host_id)[0]["parentTemplates"]]
         data = {
             "hostid": host_id,
             "templates": current_templates
@@ -575,58 +1795,929 @@ Agent port: {HOST.PORT}''',
                 self.zapi.host.update(data)
             except:
                 return 0
+            finally:
+                self.resolver.invalidate("host")
         else:
             logger.debug("Template {:s} was already assigned before. Skipped.".format(template_name))
         return 1
 
-    def main(self):
+    def desired_state(self):
+        """Builds the model of objects which have to exist on the server from the environment."""
+        return {
+            "host": {
+                "host": self.hostname,
+                "dns": self.agent_dns_name,
+                "ip": self.agent_ip_address,
+                "status": 0,
+                "templates": self.additional_templates
+            },
+            "mediatype": {"description": "Email", "smtp_server": self.smtp_server, "smtp_email": self.smtp_email, "smtp_helo": self.smtp_helo},
+            "usergroups": [self.default_user_group],
+            "users": [{"alias": user["name"], "passwd": user["password"], "usrgrps": [self.default_user_group], "type": 3} for user in self.admin_users],
+            "memberships": {"Disabled": [self.guest_username]} if self.disable_guest else {},
+            "medias": {self.default_admin_username: self.email_medias(self.admin_email_address)} if self.admin_email_address.strip() != "" else {},
+            "actions": [self.default_report_action],
+            "auto_registration": self.host_metadata,
+            "web": self.url_list,
+            "imports": self.configuration_files(),
+            "custom_config": {"web": self.web_config(self.url_list)},
+            "config": dict(self.configuration)
+        }
+
+    def snapshot(self, desired):
+        """Reads the current state of managed objects, one bulk read per object type."""
+        logger.debug("Retrieving current state of Zabbix server.")
+        template_names = list(set(desired["host"]["templates"] + sum([item["templates"] for item in desired["imports"].values()], []) + ["Template OS Linux"]))
+        user_aliases = [self.default_admin_username, self.guest_username] + [user["alias"] for user in desired["users"]]
+        group_names = [self.default_admin_group] + desired["usergroups"] + desired["memberships"].keys()
+        hosts, templates, mediatypes, usergroups, users, actions, hostgroups = self.zapi.batch([
+            ("host.get", {"filter": {"host": desired["host"]["host"]}, "output": ["hostid", "host", "name", "status"], "selectInterfaces": ["interfaceid", "ip", "dns", "useip"], "selectParentTemplates": ["templateid", "host"]}),
+            ("template.get", {"filter": {"host": template_names}, "output": ["templateid", "host"]}),
+            ("mediatype.get", {"filter": {"description": desired["mediatype"]["description"]}, "output": ["mediatypeid", "description", "smtp_server", "smtp_email", "smtp_helo"]}),
+            ("usergroup.get", {"filter": {"name": group_names}, "output": ["usrgrpid", "name"], "selectUsers": ["userid"]}),
+            ("user.get", {"filter": {"alias": user_aliases}, "output": ["userid", "alias"], "selectMedias": ["mediatypeid", "sendto", "active", "severity", "period"]}),
+            ("action.get", {"filter": {"name": desired["actions"] + ["Auto registration rules for Linux servers"]}, "output": ["actionid", "name", "status"], "selectFilter": "extend", "selectOperations": "extend"}),
+            ("hostgroup.get", {"filter": {"name": "Linux servers"}, "output": ["groupid", "name"]})
+        ])
+        if len(hosts) == 0:
+            error("Host %s can not be found."%(desired["host"]["host"]))
+        host = hosts[0]
+        web = self.web_state(host, desired["web"])
+        try:
+            with open(self.zabbix_custom_config) as f:
+                custom_config = json.load(f)
+        except (IOError, ValueError):
+            custom_config = None
+        return {
+            "host": host,
+            "templates": index(templates, "host"),
+            "mediatype": mediatypes[0] if len(mediatypes) > 0 else None,
+            "usergroups": index(usergroups, "name"),
+            "users": index(users, "alias"),
+            "actions": index(actions, "name"),
+            "hostgroups": index(hostgroups, "name"),
+            "web": web,
+            "custom_config": custom_config,
+            "config": self.get_configuration()
+        }
+
+    def template_id(self, name, current):
+        return current["templates"][name]["templateid"] if name in current["templates"] else Ref("template", name)
+
+    def plan(self, desired, current):
+        """Returns the minimal list of changes, which brings current state to desired one, in order of execution."""
+        changes = []
+        # Templates have to exist before they are linked with hosts or used by actions
+        changed = [filename for filename in sorted(desired["imports"].keys()) if self.import_required(filename, desired["imports"][filename], current["templates"])]
+        for layer in self.import_order(changed, desired["imports"]):
+            for filename in layer:
+                changes.append(Change("configuration", filename, "import", self.import_file, filename, "templates: %s"%(", ".join(desired["imports"][filename]["templates"]))))
+
+        mediatype = current["mediatype"]
+        if mediatype is None:
+            error("Media type %s can not be found."%(desired["mediatype"]["description"]))
+        data = dict((key, value) for key, value in desired["mediatype"].items() if key != "description" and mediatype[key] != value)
+        if len(data) > 0:
+            details = ", ".join(sorted(data.keys()))
+            data["mediatypeid"] = mediatype["mediatypeid"]
+            changes.append(Change("mediatype", mediatype["description"], "update", "mediatype.update", data, details))
+
+        for name in desired["usergroups"]:
+            if name not in current["usergroups"]:
+                changes.append(Change("usergroup", name, "create", "usergroup.create", {"name": name, "gui_access": 0, "users_status": 0}))
+
+        for user in desired["users"]:
+            if user["alias"] not in current["users"]:
+                data = dict(user)
+                data["usrgrps"] = [{"usrgrpid": current["usergroups"][name]["usrgrpid"] if name in current["usergroups"] else Ref("usergroup", name)} for name in user["usrgrps"]]
+                changes.append(Change("user", user["alias"], "create", "user.create", data))
+
+        for name, aliases in sorted(desired["memberships"].items()):
+            group = current["usergroups"].get(name)
+            if group is None:
+                error("Can not retrieve information from group: %s."%(name))
+            ids = [user["userid"] for user in group["users"]]
+            missing = [current["users"][alias]["userid"] for alias in aliases if alias in current["users"] and current["users"][alias]["userid"] not in ids]
+            if len(missing) > 0:
+                changes.append(Change("usergroup", name, "update", "usergroup.update", {"usrgrpid": group["usrgrpid"], "userids": ids + missing}, "users"))
+
+        for alias, medias in sorted(desired["medias"].items()):
+            user = current["users"].get(alias)
+            fields = ["mediatypeid", "sendto", "active", "severity", "period"]
+            if user is None or sorted([[str(media[field]) for field in fields] for media in user["medias"]]) != sorted([[str(media[field]) for field in fields] for media in medias]):
+                changes.append(Change("user", alias, "update", "user.updatemedia", {"users": [{"userid": user["userid"] if user else Ref("user", alias)}], "medias": medias}, "medias"))
+
+        for name in desired["actions"]:
+            if name in current["actions"] and int(current["actions"][name]["status"]) != 0:
+                changes.append(Change("action", name, "update", "action.update", {"actionid": current["actions"][name]["actionid"], "status": 0}, "status"))
+
+        if desired["auto_registration"] != "":
+            group = current["hostgroups"].get("Linux servers")
+            user_group = current["usergroups"].get(self.default_admin_group)
+            if group is None or user_group is None:
+                error("Host group or user group of auto registration action can not be found.")
+            data = self.auto_discovery_action(desired["auto_registration"], group["groupid"], self.template_id("Template OS Linux", current), user_group["usrgrpid"])
+            action = current["actions"].get(data["name"])
+            if action is None:
+                changes.append(Change("action", data["name"], "create", "action.create", data))
+            elif int(action["status"]) != 0 or sorted([condition["value"] for condition in action["filter"]["conditions"]]) != sorted([condition["value"] for condition in data["filter"]["conditions"]]) \
+                    or sorted([int(operation["operationtype"]) for operation in action["operations"]]) != sorted([operation["operationtype"] for operation in data["operations"]]):
+                # Could not be updated with below element in dict
+                del data["eventsource"]
+                data["actionid"] = action["actionid"]
+                changes.append(Change("action", data["name"], "update", "action.update", data))
+
+        host = current["host"]
+        interface = host["interfaces"][0]
+        if interface["ip"] != desired["host"]["ip"] or interface["dns"] != desired["host"]["dns"]:
+            changes.append(Change("host", host["host"], "update", "hostinterface.update", {"interfaceid": interface["interfaceid"], "ip": desired["host"]["ip"], "dns": desired["host"]["dns"], "port": self.default_agent_port, "useip": 0}, "interface"))
+        if int(host["status"]) != desired["host"]["status"]:
+            changes.append(Change("host", host["host"], "update", "host.update", {"hostid": host["hostid"], "status": desired["host"]["status"]}, "status"))
+        linked = [template["host"] for template in host["parentTemplates"]]
+        missing = [name for name in desired["host"]["templates"] if name not in linked]
+        if len(missing) > 0:
+            changes.append(Change("host", host["host"], "update", "host.massadd", {"hosts": [{"hostid": host["hostid"]}], "templates": [{"templateid": self.template_id(name, current)} for name in missing]}, "templates: %s"%(", ".join(missing))))
+
+        if self.web_check_mode == "discovery":
+            changes += self.web_migration_changes(current["web"], host["hostid"], desired["web"])
+        else:
+            changes += self.web_changes(current["web"])
+        if current["custom_config"] != desired["custom_config"]:
+            changes.append(Change("file", self.zabbix_custom_config, "update", lambda data: self.save_json_config(data, self.zabbix_custom_config), desired["custom_config"]))
+
+        config = dict()
+        for key, value in desired["config"].items():
+            if key not in current["config"]:
+                error("Unknown configuration key: %s."%(key))
+            if current["config"][key] != value:
+                config[key] = value
+        if len(config) > 0:
+            changes.append(Change("config", "config", "update", self.write_configuration, config, ", ".join(sorted(config.keys()))))
+        return changes
+
+    def resolve(self, params):
+        if isinstance(params, Ref):
+            object_id = self.resolver.id(params.kind, params.name)
+            if object_id is None:
+                raise ZabbixAPIException("Can not find %s with name %s."%(params.kind, params.name))
+            return object_id
+        if isinstance(params, dict):
+            return dict((key, self.resolve(value)) for key, value in params.items())
+        if isinstance(params, list):
+            return [self.resolve(value) for value in params]
+        return params
+
+    def apply(self, changes):
+        """Executes changes in their order. Consecutive create/update/delete changes of the same method are sent as array calls."""
+        for key, group in itertools.groupby(changes, key=lambda change: change.method if change.batchable() else id(change)):
+            group = list(group)
+            if not group[0].batchable():
+                change = group[0]
+                logger.debug("Applying change: %s."%(change))
+                if callable(change.method):
+                    change.method(self.resolve(change.params))
+                else:
+                    self.zapi.do_request(change.method, self.resolve(change.params))
+                continue
+            for chunk in chunks(group, self.api_batch_size):
+                logger.debug("Applying %d changes by %s."%(len(chunk), key))
+                result = self.zapi.do_request(key, [self.resolve(change.params) for change in chunk])["result"]
+                if chunk[0].action == "create":
+                    ids = [value for value in result.values() if isinstance(value, list)][0]
+                    for change, object_id in zip(chunk, ids):
+                        if change.kind in RESOLVER_TYPES:
+                            self.resolver.put(change.kind, change.name, object_id)
+        return len(changes)
+
+    def print_plan(self, changes):
+        if len(changes) == 0:
+            print "No changes. Zabbix server configuration is up-to-date."
+            return
+        for change in changes:
+            print str(change)
+        count = lambda actions: len([change for change in changes if change.action in actions])
+        print "Plan: %d to create, %d to update, %d to delete."%(count(["create", "import"]), count(["update"]), count(["delete"]))
+
+    def reconcile(self, dry_run=False):
+        # Writes are not allowed in plan mode, so authentication type is switched only while applying
+        switched = not dry_run and self.authentication_type != self.default_authentication_type
+        if switched:
+            self.use_default_authentication()
 
+        self.login()
+        changes = []
+        if self.default_admin_password != self.admin_password:
+            if dry_run:
+                changes.append(Change("user", self.default_admin_username, "update", "user.update", {"userid": self.uid, "passwd": self.admin_password}, "password"))
+            elif self.change_default_password():
+                self.relogin()
+
+        desired = self.desired_state()
+        current = self.snapshot(desired)
+        current["config"]["authentication_type"] = self.authentication_type
+        changes += self.plan(desired, current)
+        self.print_plan(changes)
+        if not dry_run:
+            logger.info("Applying %d changes."%(len(changes)))
+            try:
+                self.apply(changes)
+            finally:
+                self.save_import_fingerprints()
+            if switched and desired["config"].get("authentication_type", self.authentication_type) == self.authentication_type:
+                self.restore_authentication()
+        return self.logout()
+
+    def read_records(self, path):
+        """Yields line numbers and lines of JSON-lines file, empty lines and lines starting with # are skipped.
+        Records are parsed by workers, so an invalid record fails only itself."""
+        with open(path) as f:
+            for number, line in enumerate(f, 1):
+                line = line.strip()
+                if line != "" and not line.startswith("#"):
+                    yield number, line
+
+    def parse_records(self, records, parse, errors):
+        """Returns records of a chunk parsed by parse(line), records which raise ValueError are reported by their line number."""
+        result = []
+        for line_number, line in records:
+            try:
+                result.append(parse(line))
+            except ValueError as e:
+                errors["line %d"%(line_number)] = str(e)
+        return result
+
+    def create_groups(self, kind, names, params, dry_run):
+        """Returns changes which create missing host or user groups, they are applied at once unless it is plan mode.
+        Groups are created by one chunk at a time, plan mode remembers groups which were already planned by other chunks."""
+        with self.groups_lock:
+            planned = self.planned_groups.setdefault(kind, set())
+            missing = sorted(set(name for name in names if self.resolver.id(kind, name) is None) - planned)
+            changes = [Change(kind, name, "create", kind + ".create", dict(params, name=name)) for name in missing]
+            if dry_run:
+                planned.update(missing)
+            else:
+                self.apply(changes)
+        return changes
+
+    def apply_records(self, changes):
+        """Applies changes like apply(), but records of a failed array call are sent again as a batch of single calls,
+        so an invalid record fails only itself. Returns error messages by name of change."""
+        errors = dict()
+        for key, group in itertools.groupby(changes, key=lambda change: change.method):
+            for chunk in chunks(list(group), self.api_batch_size):
+                if chunk[0].batchable():
+                    try:
+                        self.apply(chunk)
+                        continue
+                    except ZabbixAPIException as e:
+                        logger.debug("%s of %d records failed, they are applied one by one: %s"%(key, len(chunk), e))
+                results = self.zapi.batch([(key, self.resolve(change.params)) for change in chunk], strict=False)
+                for change, result in zip(chunk, results):
+                    if isinstance(result, Exception):
+                        errors[change.name] = result.args[0]
+                    elif change.action == "create" and change.kind in RESOLVER_TYPES:
+                        self.resolver.put(change.kind, change.name, [value for value in result.values() if isinstance(value, list)][0][0])
+        return errors
+
+    def process_chunk(self, process, number, records, dry_run):
+        """Runs process(records, dry_run, changes, errors) on a chunk of records. Returns chunk number, count of records, changes
+        and error messages by record name, exceptions are reported as errors of the chunk."""
+        started = time.time()
+        changes, errors = [], dict()
+        try:
+            process(records, dry_run, changes, errors)
+        except SystemExit:
+            # Reason was already logged by error()
+            errors["chunk"] = "chunk was aborted"
+        except Exception as e:
+            logger.debug("Chunk %d raised an exception."%(number), exc_info=True)
+            errors["chunk"] = str(e) or e.__class__.__name__
+        logger.debug("Chunk %d of %d records is processed in %.3f sec."%(number, len(records), time.time() - started))
+        return number, len(records), changes, errors
+
+    def provision_records(self, path, noun, chunk_size, prepare, process, dry_run=False):
+        """Brings objects to the state of JSON-lines file: prepare() runs after login, then the file is read chunk by chunk
+        and at most workers chunks are processed by process(records, dry_run, changes, errors) at once. Returns 1 if any record failed."""
+        switched = not dry_run and self.authentication_type != self.default_authentication_type
+        if switched:
+            self.use_default_authentication()
+        result = {"chunks": 0, "records": 0, "changes": 0, "failed": 0}
+        slots = threading.BoundedSemaphore(self.workers)
+
+        def finished(outcome):
+            number, count, changes, errors = outcome
+            try:
+                result["chunks"] += 1
+                result["records"] += count
+                result["changes"] += len(changes)
+                if dry_run:
+                    for change in changes:
+                        print str(change)
+                else:
+                    logger.info("Chunk %d: %d %s, %d changes applied, %d failed."%(number, count, noun, len(changes), len(errors)))
+                result["failed"] += len(errors)
+                for name, message in sorted(errors.items()):
+                    logger.error("Chunk %d, %s: %s."%(number, name, message))
+            finally:
+                slots.release()
+
+        try:
+            self.login()
+            self.planned_groups = dict()
+            prepare()
+            pool = ThreadPool(self.workers)
+            try:
+                for number, records in enumerate(stream_chunks(self.read_records(path), chunk_size), 1):
+                    # Next chunk is read only when a worker is free, so the whole file is never kept in memory
+                    slots.acquire()
+                    pool.apply_async(self.process_chunk, (process, number, records, dry_run), callback=finished)
+            except IOError as e:
+                logger.error("Can not read %s %s: %s."%(noun, path, e))
+                result["failed"] += 1
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            if switched:
+                self.restore_authentication()
+        if dry_run:
+            print "Plan: %d changes of %d %s."%(result["changes"], result["records"], noun)
+        logger.info("Processed %d %s in %d chunks, %d records failed."%(result["records"], noun, result["chunks"], result["failed"]))
+        self.logout()
+        return 1 if result["failed"] > 0 else 0
+
+    def inventory_host(self, line):
+        """Returns the desired state of inventory host from a record, agent is reached by DNS name unless only IP address is known.
+        Raises ValueError if the record is invalid."""
+        entry = json.loads(line)
+        if not isinstance(entry, dict) or "host" not in entry or (entry.get("dns", "") == "" and entry.get("ip", "") == ""):
+            raise ValueError("host name and DNS name or IP address are required")
+        return {
+            "host": entry["host"],
+            "name": entry.get("name", entry["host"]),
+            "dns": entry.get("dns", ""),
+            "ip": entry.get("ip", ""),
+            "useip": 1 if entry.get("dns", "") == "" else 0,
+            "groups": sorted(set(entry.get("groups") or [self.inventory_default_group])),
+            "templates": sorted(set(entry.get("templates", []))),
+            "macros": dict(entry.get("macros", {}))
+        }
+
+    def inventory_changes(self, hosts, current):
+        """Returns changes which create new hosts and bring existing ones to the inventory state.
+        Existing hosts which need the same groups, macros or templates are changed by one mass call."""
+        changes, groups, macros, templates = [], dict(), dict(), dict()
+        group_ids = lambda names: [{"groupid": self.resolver.id("hostgroup", name) or Ref("hostgroup", name)} for name in names]
+        macro_list = lambda items: [{"macro": macro, "value": value} for macro, value in sorted(items)]
+        template_ids = lambda names: [{"templateid": self.resolver.id("template", name)} for name in names]
+        for host in hosts:
+            interface = {"ip": host["ip"], "dns": host["dns"], "useip": host["useip"]}
+            existing = current.get(host["host"])
+            if existing is None:
+                interface.update({"type": 1, "main": 1, "port": str(self.default_agent_port)})
+                changes.append(Change("host", host["host"], "create", "host.create", {
+                    "host": host["host"],
+                    "name": host["name"],
+                    "interfaces": [interface],
+                    "groups": group_ids(host["groups"]),
+                    "templates": template_ids(host["templates"]),
+                    "macros": macro_list(host["macros"].items())
+                }))
+                continue
+            if existing["name"] != host["name"]:
+                changes.append(Change("host", host["host"], "update", "host.update", {"hostid": existing["hostid"], "name": host["name"]}, "name"))
+            main = next((item for item in existing["interfaces"] if int(item["type"]) == 1 and int(item["main"]) == 1), None)
+            if main is None:
+                interface.update({"hostid": existing["hostid"], "type": 1, "main": 1, "port": str(self.default_agent_port)})
+                changes.append(Change("hostinterface", host["host"], "create", "hostinterface.create", interface))
+            elif main["ip"] != host["ip"] or main["dns"] != host["dns"] or int(main["useip"]) != host["useip"]:
+                interface["interfaceid"] = main["interfaceid"]
+                changes.append(Change("hostinterface", host["host"], "update", "hostinterface.update", interface))
+            if sorted(group["name"] for group in existing["groups"]) != host["groups"]:
+                groups.setdefault(tuple(host["groups"]), []).append(existing)
+            if dict((macro["macro"], macro["value"]) for macro in existing["macros"]) != host["macros"]:
+                macros.setdefault(tuple(sorted(host["macros"].items())), []).append(existing)
+            # Templates are only linked, templates which were linked by hand are kept
+            linked = set(template["host"] for template in existing["parentTemplates"])
+            missing = tuple(name for name in host["templates"] if name not in linked)
+            if len(missing) > 0:
+                templates.setdefault(missing, []).append(existing)
+        for names, targets in sorted(groups.items()):
+            for part in chunks(targets, self.api_batch_size):
+                changes.append(Change("host", host_list(part), "update", "host.massupdate", {"hosts": [{"hostid": item["hostid"]} for item in part], "groups": group_ids(names)}, "groups: %s"%(", ".join(names))))
+        for items, targets in sorted(macros.items()):
+            for part in chunks(targets, self.api_batch_size):
+                changes.append(Change("host", host_list(part), "update", "host.massupdate", {"hosts": [{"hostid": item["hostid"]} for item in part], "macros": macro_list(items)}, "macros"))
+        for names, targets in sorted(templates.items()):
+            for part in chunks(targets, self.api_batch_size):
+                changes.append(Change("host", host_list(part), "update", "host.massadd", {"hosts": [{"hostid": item["hostid"]} for item in part], "templates": template_ids(names)}, "templates: %s"%(", ".join(names))))
+        return changes
+
+    def inventory_chunk(self, records, dry_run, changes, errors):
+        """Compares chunk of inventory hosts with one bulk host.get and applies the difference."""
+        hosts = []
+        for host in self.parse_records(records, self.inventory_host, errors):
+            unknown = [name for name in host["templates"] if self.resolver.id("template", name) is None]
+            if len(unknown) > 0:
+                errors[host["host"]] = "unknown templates %s"%(", ".join(unknown))
+            else:
+                hosts.append(host)
+        changes += self.create_groups("hostgroup", set(name for host in hosts for name in host["groups"]), {}, dry_run)
+        current = self.zapi.host.get(
+            filter={"host": [host["host"] for host in hosts]},
+            output=["hostid", "host", "name"],
+            selectInterfaces=["interfaceid", "type", "main", "ip", "dns", "useip"],
+            selectGroups=["groupid", "name"],
+            selectMacros=["macro", "value"],
+            selectParentTemplates=["templateid", "host"]
+        ) if len(hosts) > 0 else []
+        host_changes = self.inventory_changes(hosts, index(current, "host"))
+        if not dry_run:
+            errors.update(self.apply_records(host_changes))
+        changes += host_changes
+
+    def provision(self, path, dry_run=False):
+        """Creates and updates hosts of inventory file."""
+        return self.provision_records(path, "hosts", self.inventory_chunk_size, lambda: self.resolver.prefetch(["hostgroup", "template"]), self.inventory_chunk, dry_run)
+
+    def directory_user(self, line):
+        """Returns the desired state of user from a record, fields which are missing in the record are not managed.
+        Raises ValueError if the record is invalid."""
+        entry = json.loads(line)
+        if not isinstance(entry, dict) or not isinstance(entry.get("alias"), basestring) or entry["alias"].strip() == "":
+            raise ValueError("alias is required")
+        emails = entry.get("email", [])
+        emails = [address.strip() for address in emails.split(",") if address.strip() != ""] if isinstance(emails, basestring) else emails
+        invalid = [address for address in emails if not isinstance(address, basestring) or not EMAIL_PATTERN.match(address)]
+        if len(invalid) > 0:
+            raise ValueError("invalid email addresses %s"%(", ".join([str(address) for address in invalid])))
+        if entry.get("type", 1) not in [1, 2, 3]:
+            raise ValueError("type has to be 1 (user), 2 (admin) or 3 (super admin)")
+        if not isinstance(entry.get("groups", []), list) or len(entry.get("groups", [None])) == 0:
+            raise ValueError("groups have to be a non-empty list")
+        return {
+            "alias": entry["alias"],
+            "fields": dict((field, entry[field]) for field in ["name", "surname", "type"] if field in entry),
+            "password": entry.get("password"),
+            "groups": sorted(set(entry["groups"])) if "groups" in entry else None,
+            "emails": sorted(set(emails)) if "email" in entry else None
+        }
+
+    def directory_changes(self, users, current, errors):
+        """Returns changes which create new users and bring existing ones to the desired state, records which can not be applied are added to errors.
+        Groups of user are replaced by one user.update, other media than email are kept when email media are replaced.
+        Changes are ordered by method, so every method is applied by array calls of the whole chunk."""
+        creates, updates, medias = [], [], []
+        email_id = self.resolver.id("mediatype", "Email")
+        group_ids = lambda names: [{"usrgrpid": self.resolver.id("usergroup", name) or Ref("usergroup", name)} for name in names]
+        email_medias = lambda emails: [{"mediatypeid": email_id, "sendto": address, "active": 0, "severity": self.default_severity, "period": self.default_notify_period} for address in emails]
+        for user in users:
+            existing = current.get(user["alias"])
+            if existing is None:
+                if user["password"] is None:
+                    errors[user["alias"]] = "password is required for a new user"
+                    continue
+                data = dict(user["fields"], alias=user["alias"], passwd=user["password"], usrgrps=group_ids(user["groups"] or [self.default_user_group]))
+                if user["emails"]:
+                    data["user_medias"] = email_medias(user["emails"])
+                creates.append(Change("user", user["alias"], "create", "user.create", data))
+                continue
+            data = dict((field, value) for field, value in user["fields"].items() if unicode(existing[field]) != unicode(value))
+            if user["groups"] is not None and sorted(group["name"] for group in existing["usrgrps"]) != user["groups"]:
+                data["usrgrps"] = group_ids(user["groups"])
+            if len(data) > 0:
+                updates.append(Change("user", user["alias"], "update", "user.update", dict(data, userid=existing["userid"]), ", ".join(sorted(data.keys()))))
+            if user["emails"] is not None and sorted(media["sendto"] for media in existing["medias"] if media["mediatypeid"] == email_id) != user["emails"]:
+                fields = ["mediatypeid", "sendto", "active", "severity", "period"]
+                kept = [dict((field, media[field]) for field in fields) for media in existing["medias"] if media["mediatypeid"] != email_id]
+                medias.append(Change("user", user["alias"], "update", "user.updatemedia", {"users": [{"userid": existing["userid"]}], "medias": kept + email_medias(user["emails"])}, "medias"))
+        return creates + updates + medias
+
+    def users_chunk(self, records, dry_run, changes, errors):
+        """Compares chunk of users with one user.get and applies the difference."""
+        users = self.parse_records(records, self.directory_user, errors)
+        changes += self.create_groups("usergroup", set(name for user in users for name in (user["groups"] or [self.default_user_group])), {"gui_access": 0, "users_status": 0}, dry_run)
+        current = self.zapi.user.get(
+            filter={"alias": [user["alias"] for user in users]},
+            output=["userid", "alias", "name", "surname", "type"],
+            selectUsrgrps=["usrgrpid", "name"],
+            selectMedias=["mediatypeid", "sendto", "active", "severity", "period"]
+        ) if len(users) > 0 else []
+        user_changes = self.directory_changes(users, index(current, "alias"), errors)
+        if not dry_run:
+            errors.update(self.apply_records(user_changes))
+        changes += user_changes
+
+    def prepare_users(self):
+        self.resolver.prefetch(["usergroup", "mediatype"])
+        if self.resolver.id("mediatype", "Email") is None:
+            error("Media type Email can not be found.")
+
+    def provision_users(self, path, dry_run=False):
+        """Creates and updates users of users file."""
+        return self.provision_records(path, "users", self.users_chunk_size, self.prepare_users, self.users_chunk, dry_run)
+
+    def use_default_authentication(self):
         if self.authentication_type != self.default_authentication_type:
             logger.debug("Changing authentication_type to default to use api with basic credentials.")
             self.update_configuration(config={"authentication_type":self.default_authentication_type})
 
-        self.login()
+    def restore_authentication(self):
+        if self.authentication_type != self.default_authentication_type:
+            logger.debug("Returned authentication_type to initial state.")
+            self.update_configuration(config={"authentication_type": self.authentication_type})
+
+    def update_admin_password(self):
         if self.change_default_password():
             self.relogin()
 
-        if self.disable_guest:
-            self.disable_user(self.guest_username)
-
-        host_id = self.get_host_info(hostname=self.hostname)[0]["hostid"];
-        logger.debug("%s has such id: %s."%(self.hostname, host_id))
-        logger.info("Associate local agent with %s."%(self.hostname) if self.update_host_addr(host_id, self.agent_dns_name, self.agent_ip_address, 0) else "Skipped address updating %s."%(self.hostname))
-        logger.info("Enabled %s host."%(self.hostname) if self.enable_host(host_id) else "Skipped enabling %s."%(self.hostname))
-        logger.info("Configured default email media type." if self.update_mediatype(name="Email",data={"smtp_server": self.smtp_server, "smtp_email": self.smtp_email, "smtp_helo": self.smtp_helo}) else "Skipped configuring default media type.")
-        logger.info("Updated %s user email settings."%(self.default_admin_username) if self.update_user_email_settings(username=self.default_admin_username, email=self.admin_email_address) else "Skipped updating email settings")
-        logger.info("Enabled default notify action." if self.enable_action(self.default_report_action) else "Skipped activating the default notify action.")
-        logger.info("Added/Updated auto discovery action." if self.add_auto_discovery_action(self.host_metadata) else "Skipped adding auto discovery action.")
-        logger.info("Initialization checking web urls." if self.add_web_scenario(host_id=host_id, url_list=self.url_list) else "Skipped initialization of web urls.")
-        logger.info("Cleanup undefined web urls." if self.cleanup_undefined_web_scenario(host_id=host_id, url_list=self.url_list) else "Skipped cleanup of web urls. Nothing was found.")
-        logger.info("Adding zabbix configuration templates." if self.configuration_folder != "" and self.import_configuration() else "No configuration templates folder was identified.")
+    def resolve_host(self):
+        self.host_id = self.get_host_info(hostname=self.hostname)[0]["hostid"]
+        logger.debug("%s has such id: %s."%(self.hostname, self.host_id))
 
+    def add_admin_users(self):
         logger.info("Creating default user group %s."%(self.default_user_group))
         group_id = self.create_group(self.default_user_group)
-        if len(self.admin_users)>0:
-            for user in self.admin_users:
-                logger.info("Adding user %s as administrator."%(user["name"]))
-                if not self.add_user(user=user, groups = [{ "usrgrpid": group_id }], user_type=3):
-                    logger.info("Skipped.")
+        for user in self.admin_users:
+            logger.info("Adding user %s as administrator."%(user["name"]))
+            if not self.add_user(user=user, groups = [{ "usrgrpid": group_id }], user_type=3):
+                logger.info("Skipped.")
 
-        logger.info("Updating Zabbix configuration" if self.update_configuration(self.configuration) else "Nothing to update. Skipped.")
-        if self.authentication_type != self.default_authentication_type:
-            logger.debug("Returned authentication_type to initial state.")
-            self.update_configuration(config={"authentication_type": self.authentication_type})
-        # This step must be the last, when custom_config_json is already prepared for saving
-        logger.info("Creating custom config." if self.save_json_config(self.custom_config_json, self.zabbix_custom_config) else "Skipped. Nothing to be saved.")
+    def metric_item_changes(self, host_id, keys):
+        """Returns changes which create missing trapper items for run metrics."""
+        current = set(item["key_"] for item in self.zapi.item.get(hostids=host_id, output=["key_"], filter={"key_": keys}))
+        changes = []
+        for key in sorted(keys):
+            if key in current:
+                continue
+            name, value_type, units = METRIC_ITEMS[key] if key in METRIC_ITEMS else ("Configurator step $1 duration", 0, "s")
+            changes.append(Change("item", key, "create", "item.create", {"hostid": host_id, "name": name, "key_": key, "type": 2, "value_type": value_type, "units": units}))
+        return changes
+
+    def report_metrics(self, durations, errors, started):
+        """Sends durations of steps and counters of API calls to trapper items of the managed host."""
+        if self.host_id == "":
+            logger.debug("Host %s was not resolved. Skipped reporting run metrics."%(self.hostname))
+            return 0
+        metrics = {
+            "configurator.duration": "%.6f"%(time.time() - started),
+            "configurator.api.calls": self.zapi.calls,
+            "configurator.api.failures": self.zapi.failures,
+            "configurator.steps.failed": len(errors)
+        }
+        for name, duration in durations.items():
+            metrics[STEP_METRIC_KEY%(name)] = "%.6f"%(duration)
+        clock = int(time.time())
+        sender = Sender(self.server_host, self.default_server_port)
+        try:
+            self.apply(self.metric_item_changes(self.host_id, metrics.keys()))
+            summary = sender.send([sender_value(self.hostname, key, data, clock) for key, data in sorted(metrics.items())])
+        except (ZabbixAPIException, SenderError) as e:
+            logger.error("Can not report run metrics: %s."%(e))
+            return 0
+        finally:
+            sender.close()
+        # Items created by this run accept values only after the next configuration cache update of server
+        logger.info("Reported run metrics: %d of %d values were processed."%(summary["processed"], summary["total"]))
+        return 1
+
+    def assign_templates(self):
         for template_name in self.additional_templates:
-            logger.info("Assigning templates with %s default host."%self.hostname if self.assign_template(host_id, template_name) else "Cannot assign template with host %s."%self.hostname)
+            logger.info("Assigning templates with %s default host."%self.hostname if self.assign_template(self.host_id, template_name) else "Cannot assign template with host %s."%self.hostname)
 
-        return self.logout()
+    def load_desired_state(self):
+        """Reads desired state file and replaces attributes of its fields. Returns steps which have to apply changed fields."""
+        with open(self.desired_state_file) as f:
+            state = json.load(f)
+        if not isinstance(state, dict) or len([key for key in state.keys() if key not in DESIRED_STATE_FIELDS]) > 0:
+            raise ValueError("object with fields %s is expected"%(", ".join(sorted(DESIRED_STATE_FIELDS.keys()))))
+        if "additional_templates" in state and self.web_check_mode == "discovery" and WEB_DISCOVERY_TEMPLATE not in state["additional_templates"]:
+            state["additional_templates"] = state["additional_templates"] + [WEB_DISCOVERY_TEMPLATE]
+        steps = set()
+        for key, value in state.items():
+            if key in self.desired_state_fields and self.desired_state_fields[key] == value:
+                continue
+            attribute, key_steps = DESIRED_STATE_FIELDS[key]
+            # Steps can change their data, e.g. config step drops keys which are up-to-date, so they get a copy
+            setattr(self, attribute, copy.deepcopy(value))
+            steps.update(key_steps)
+        self.desired_state_fields = state
+        return steps
 
-if __name__ == "__main__":
+    def write_status(self, status):
+        """Replaces status file by rename, so readers never see a partially written file."""
+        try:
+            with open(self.status_file + ".tmp", "w") as f:
+                json.dump(status, f, indent=4, sort_keys=True)
+            os.rename(self.status_file + ".tmp", self.status_file)
+        except (IOError, OSError) as e:
+            logger.error("Status can not be saved into %s: %s."%(self.status_file, e))
+
+    def refresh_connections(self):
+        """Logs in again if session of watch mode was terminated and reconnects to database if its connection was closed."""
+        try:
+            self.zapi.user.get(userids=self.uid, output=["userid"])
+        except ZabbixAPIException as e:
+            logger.info("Session is not valid (%s), logging in again."%(e))
+            self.use_default_authentication()
+            try:
+                self.login()
+            finally:
+                self.restore_authentication()
+        if hasattr(self.db, "ping"):
+            with self.db_lock:
+                self.db.ping(True)
+        # Objects could be changed by users since the previous run
+        self.resolver.reset()
+
+    def watch_run(self, status, names, changes):
+        started = time.time()
+        status.update({"state": "running", "updated": int(started)})
+        self.write_status(status)
+        if names is None:
+            self.main(logout=False)
+            durations, errors = self.step_durations, self.step_errors
+        else:
+            logger.info("Applying changes of %s by steps %s."%(", ".join(changes), ", ".join(sorted(names))))
+            self.refresh_connections()
+            durations, errors = self.run_steps(names)
+            self.report_metrics(durations, errors, started)
+            for name, message in sorted(errors.items()):
+                logger.error("Step %s failed: %s."%(name, message))
+        status["runs"] += 1
+        status.update({"state": "watching", "updated": int(time.time()), "last_run": {
+            "started": int(started),
+            "duration": round(time.time() - started, 3),
+            "status": "failed" if len(errors) > 0 else "success",
+            "changes": changes,
+            "steps": sorted(durations.keys()),
+            "errors": errors
+        }})
+        self.write_status(status)
+
+    def watch(self):
+        """Runs all steps, then keeps session and database connection open and reruns only steps which are affected
+        by changes of configuration folder or desired state file. Changes which come within ZBX_WATCH_DEBOUNCE seconds are applied together."""
+        targets = dict((name, path) for name, path in [("configuration", self.configuration_folder), ("desired state", self.desired_state_file)] if path != "")
+        if len(targets) == 0:
+            error("Nothing to watch: CONFIGURATION_FOLDER and ZBX_DESIRED_STATE_FILE are not set.")
+        watcher = Watcher(targets)
+        status = {"pid": os.getpid(), "runs": 0, "last_run": None}
+        self.watch_run(status, None, ["startup"])
+        logger.info("Watching %s."%(", ".join(sorted(targets.values()))))
+        while True:
+            self.watch_changes(watcher, status)
+
+    def watch_changes(self, watcher, status):
+        """Waits for changes of watched targets and reruns steps which are affected by them."""
+        changes = set()
+        while len(changes) == 0:
+            changes = watcher.wait()
+        # Burst of edits is applied at once after the first quiet period
+        while True:
+            more = watcher.wait(self.watch_debounce)
+            if len(more) == 0:
+                break
+            changes |= more
+        names = set()
+        if "configuration" in changes:
+            names.update(CONFIGURATION_STEPS)
+        if "desired state" in changes:
+            try:
+                names.update(self.load_desired_state())
+            except (IOError, ValueError) as e:
+                logger.error("Can not load desired state from %s: %s."%(self.desired_state_file, e))
+        if len(names) == 0:
+            logger.debug("Changes of %s do not require any step."%(", ".join(sorted(changes))))
+            return
+        self.watch_run(status, names, sorted(changes))
+
+    def timing_report(self, fmt="table"):
+        """Prints the slowest API methods and SQL statements and durations of main() steps."""
+        methods = self.zapi.stats.slowest(REPORT_TOP)
+        steps = sorted(self.step_durations.items(), key=lambda item: item[1], reverse=True)
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if fmt == "json":
+            print json.dumps({
+                "methods": [dict(entry, method=method) for method, entry in methods],
+                "steps": [{"step": name, "seconds": duration} for name, duration in steps],
+                "max_rss_kb": max_rss
+            }, indent=2, sort_keys=True)
+            return
+        print "%-48s %6s %6s %7s %9s %9s %10s %10s"%("Method", "Calls", "Failed", "Retries", "Total, s", "Max, s", "Request", "Response")
+        for method, entry in methods:
+            print "%-48s %6d %6d %7d %9.3f %9.3f %10d %10d"%(method[:48], entry["calls"], entry["failures"], entry["retries"], entry["seconds"], entry["max_seconds"], entry["request_size"], entry["response_size"])
+        if len(steps) > 0:
+            print
+            print "%-48s %9s"%("Step", "Total, s")
+            for name, duration in steps:
+                print "%-48s %9.3f"%(name, duration)
+        print
+        print "Peak memory usage: %d KB."%(max_rss)
+
+    def steps(self):
+        """Returns (name, function, prerequisites) of configuration steps."""
+        return [
+            ("authentication", self.use_default_authentication, []),
+            ("login", self.login, ["authentication"]),
+            ("password", self.update_admin_password, ["login"]),
+            # All object types, which are looked up by the next steps, are loaded by one batch request
+            ("prefetch", lambda: self.resolver.prefetch(RESOLVER_TYPES.keys()), ["password"]),
+            ("host", self.resolve_host, ["prefetch"]),
+            ("guest", lambda: self.disable_guest and self.disable_user(self.guest_username), ["prefetch"]),
+            ("host_address", lambda: logger.info("Associate local agent with %s."%(self.hostname) if self.update_host_addr(self.host_id, self.agent_dns_name, self.agent_ip_address, 0) else "Skipped address updating %s."%(self.hostname)), ["host"]),
+            ("host_status", lambda: logger.info("Enabled %s host."%(self.hostname) if self.enable_host(self.host_id) else "Skipped enabling %s."%(self.hostname)), ["host"]),
+            ("mediatype", lambda: logger.info("Configured default email media type." if self.update_mediatype(name="Email",data={"smtp_server": self.smtp_server, "smtp_email": self.smtp_email, "smtp_helo": self.smtp_helo}) else "Skipped configuring default media type."), ["prefetch"]),
+            ("admin_email", lambda: logger.info("Updated %s user email settings."%(self.default_admin_username) if self.update_user_email_settings(username=self.default_admin_username, email=self.admin_email_address) else "Skipped updating email settings"), ["prefetch"]),
+            ("report_action", lambda: logger.info("Enabled default notify action." if self.enable_action(self.default_report_action) else "Skipped activating the default notify action."), ["password"]),
+            ("auto_registration", lambda: logger.info("Added/Updated auto discovery action." if self.add_auto_discovery_action(self.host_metadata) else "Skipped adding auto discovery action."), ["prefetch"]),
+            ("web", lambda: logger.info("Initialization checking web urls." if self.add_web_scenario(host_id=self.host_id, url_list=self.url_list) else "Skipped initialization of web urls."), ["host"]),
+            ("web_cleanup", lambda: logger.info("Cleanup undefined web urls." if self.cleanup_undefined_web_scenario(host_id=self.host_id, url_list=self.url_list) else "Skipped cleanup of web urls. Nothing was found."), ["host"]),
+            ("templates", lambda: logger.info("Adding zabbix configuration templates." if self.configuration_folder != "" and self.import_configuration() else "No configuration templates folder was identified."), ["password"]),
+            ("users", self.add_admin_users, ["prefetch"]),
+            # custom_config_json is prepared by web step
+            ("custom_config", lambda: logger.info("Creating custom config." if self.save_json_config(self.custom_config_json, self.zabbix_custom_config) else "Skipped. Nothing to be saved."), ["web"]),
+            ("assign_templates", self.assign_templates, ["host", "templates"]),
+            # Config table is written when API work is done, so authentication_type of ZBX_CONFIG does not break the session of other steps
+            ("config", lambda: logger.info("Updating Zabbix configuration" if self.update_configuration(self.configuration) else "Nothing to update. Skipped."),
+                ["authentication"] + [name for name in sum(PHASES.values(), []) if name != "config"])
+        ]
+
+    def select_steps(self, only=[], skip=[]):
+        """Returns names of steps of selected phases with steps which prepare them, e.g. login or host resolving, or None if all steps are selected.
+        Steps of other phases are not added, e.g. assign-templates does not import templates."""
+        if len(only) == 0 and len(skip) == 0:
+            return None
+        phase_steps = set(sum(PHASES.values(), []))
+        names = set(sum([PHASES[phase] for phase in (only or PHASES.keys()) if phase not in skip], []))
+        requires = dict((name, required) for name, function, required in self.steps())
+        pending = list(names)
+        while len(pending) > 0:
+            for required in requires[pending.pop()]:
+                if required not in names and required not in phase_steps:
+                    names.add(required)
+                    pending.append(required)
+        return names
+
+    def run_steps(self, names=None):
+        """Runs all steps or only the named ones, prerequisites which are not selected are considered done.
+        Returns durations of steps and error messages of failed or skipped steps."""
+        steps = StepExecutor(self.workers)
+        for name, function, requires in self.steps():
+            if names is None or name in names:
+                steps.add(name, function, [required for required in requires if names is None or required in names])
+        errors = steps.run()
+        return steps.durations, errors
+
+    def main(self, logout=True, names=None):
+        started = time.time()
+        # All dependencies are needed by full run, so they are awaited together, selected steps open only those which they use
+        if names is None:
+            self.wait_for_dependencies()
+        else:
+            logger.info("Running steps %s."%(", ".join(sorted(names))))
+        durations, errors = self.run_steps(names)
+        self.step_durations, self.step_errors = durations, errors
+        self.report_metrics(durations, errors, started)
+
+        # Initial authentication type is returned even if some steps failed
+        if "authentication" in durations and "authentication" not in errors:
+            self.restore_authentication()
+        if logout:
+            self.logout()
+        for name, message in sorted(errors.items()):
+            logger.error("Step %s failed: %s."%(name, message))
+        return 1 if len(errors) > 0 else 0
+
+def url_list_errors(url_list):
+    if not isinstance(url_list, list):
+        return ["list of URLs is expected"]
+    errors, names = [], set()
+    for item in url_list:
+        if not isinstance(item, dict) or not isinstance(item.get("name"), basestring) or not isinstance(item.get("url"), basestring):
+            errors.append("URL %s has no name or url"%(json.dumps(item)))
+            continue
+        if item["name"] in names:
+            errors.append("URL name %s is used twice"%(item["name"]))
+        names.add(item["name"])
+        if not re.match(r"^https?://", item["url"]):
+            errors.append("URL %s of %s is not HTTP or HTTPS"%(item["url"], item["name"]))
+        if item.get("priority", 1) not in range(0, 6):
+            errors.append("priority of URL %s is not between 0 and 5"%(item["name"]))
+    return errors
+
+def admin_users_errors(users):
+    if not isinstance(users, list):
+        return ["list of users is expected"]
+    return ["user %s has no name or password"%(json.dumps(user)) for user in users
+        if not isinstance(user, dict) or not isinstance(user.get("name"), basestring) or not isinstance(user.get("password"), basestring)]
+
+def config_errors(config):
+    if not isinstance(config, dict):
+        return ["object with fields of config table is expected"]
+    return ["value of %s is not a number or string"%(key) for key, value in sorted(config.items()) if not isinstance(value, (int, float, basestring))] + \
+        (["configid can not be changed"] if "configid" in config else [])
+
+def template_list_errors(templates):
+    if not isinstance(templates, list) or len([name for name in templates if not isinstance(name, basestring)]) > 0:
+        return ["list of template names is expected"]
+    return []
+
+def check_environment():
+    """Validates settings from environment and desired state file without network and database, returns 1 if some of them are invalid."""
+    errors, warnings = [], []
+    def setting(name):
+        return os.environ[name].strip() if name in os.environ and os.environ[name].strip() != "" else None
+    for name in REQUIRED_SETTINGS:
+        if setting(name) is None:
+            errors.append("%s is not set"%(name))
+    for name in ["SMTP_EMAIL", "ADMIN_EMAIL_ADDRESS"]:
+        if setting(name) is not None and not EMAIL_PATTERN.match(setting(name)):
+            errors.append("%s is not a valid email address: %s"%(name, setting(name)))
+    for name in INTEGER_SETTINGS:
+        if setting(name) is not None and not setting(name).isdigit():
+            errors.append("%s is not a positive integer: %s"%(name, setting(name)))
+    for name, parse in [("ZBX_WATCH_DEBOUNCE", float), ("ZBX_CAPACITY_MEMORY", parse_size)]:
+        try:
+            if setting(name) is not None:
+                parse(setting(name))
+        except ValueError:
+            errors.append("%s is not valid: %s"%(name, setting(name)))
+    for name, choices in sorted(CHOICE_SETTINGS.items()):
+        value = setting(name).lower() if name == "ZBX_DISABLE_GUEST" and setting(name) is not None else setting(name)
+        if value is not None and value not in choices:
+            errors.append("%s is %s, but one of %s is expected"%(name, value, ", ".join(choices)))
+    states = []
+    for name, field in [("URL_LIST", "url_list"), ("ZBX_ADMIN_USERS", "admin_users"), ("ZBX_CONFIG", "config")]:
+        try:
+            if setting(name) is not None:
+                states.append((name, field, json.loads(setting(name))))
+        except ValueError as e:
+            errors.append("%s is not valid JSON: %s"%(name, e))
+    path = setting("ZBX_DESIRED_STATE_FILE")
+    if path is not None and os.path.isfile(path):
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            if not isinstance(state, dict):
+                raise ValueError("object is expected")
+            for field, value in sorted(state.items()):
+                if field not in DESIRED_STATE_FIELDS:
+                    errors.append("%s has unknown field %s"%(path, field))
+                else:
+                    states.append((path, field, value))
+        except (IOError, ValueError) as e:
+            errors.append("%s is not valid: %s"%(path, e))
+    elif path is not None:
+        warnings.append("Desired state file %s does not exist yet"%(path))
+    validators = {"url_list": url_list_errors, "admin_users": admin_users_errors, "config": config_errors, "additional_templates": template_list_errors}
+    for source, field, value in states:
+        errors += ["%s: %s"%(source, message) for message in validators[field](value)]
+        if field == "config" and isinstance(value, dict):
+            # Columns of config table differ between Zabbix versions, so unknown keys are only reported
+            warnings += ["%s: %s is not a field of config table of Zabbix 3.4"%(source, key) for key in sorted(value.keys()) if key not in CONFIG_FIELDS + ["configid"]]
+    folder = setting("CONFIGURATION_FOLDER")
+    if folder is not None and not os.path.isdir(folder):
+        errors.append("CONFIGURATION_FOLDER %s is not a folder"%(folder))
+    for message in warnings:
+        logger.warning(message + ".")
+    for message in errors:
+        logger.error(message + ".")
+    logger.info("Checked settings: %d errors, %d warnings."%(len(errors), len(warnings)))
+    return 1 if len(errors) > 0 else 0
+
+def run():
+    if options["check"]:
+        return check_environment()
     app = Configurator()
     try:
-        exit(app.main())
+        if options["partitions"]:
+            return app.partition(dry_run=options["plan"])
+        if options["capacity"]:
+            return app.capacity(dry_run=options["plan"])
+        if options["backup"]:
+            return app.backup(options["backup"], full=options["full_backup"])
+        if options["restore"]:
+            return app.restore(options["restore"])
+        if options["users"]:
+            return app.provision_users(options["users"], dry_run=options["plan"])
+        if options["inventory"]:
+            return app.provision(options["inventory"], dry_run=options["plan"])
+        if options["plan"] or options["apply"]:
+            return app.reconcile(dry_run=options["plan"])
+        if options["watch"]:
+            return app.watch()
+        return app.main(names=app.select_steps(options["only"], options["skip"]))
+    finally:
+        if options["timing_report"]:
+            app.timing_report(options["timing_report"])
+
+if __name__ == "__main__":
+    # Profiling of the whole run: "cpu" saves cProfile statistics into ZBX_PROFILE_FILE, "memory" logs peak memory and live objects
+    profile = os.environ["ZBX_PROFILE"] if "ZBX_PROFILE" in os.environ and os.environ["ZBX_PROFILE"].strip() != "" else ""
+    profile_file = os.environ["ZBX_PROFILE_FILE"] if "ZBX_PROFILE_FILE" in os.environ and os.environ["ZBX_PROFILE_FILE"].strip() != "" else "/tmp/configurator.prof"
+    try:
+        exit(profiled(run, profile, profile_file))
     except KeyboardInterrupt:
         error("Interrupted by user.")
     except Exception:
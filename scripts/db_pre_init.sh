@@ -15,4 +15,12 @@ cat << EOF > ${OPT_FILE}
 innodb_strict_mode=0
 EOF
 
+# Sizes recommended by configurator.py --capacity
+if [ ! -z "${INNODB_BUFFER_POOL_SIZE}" ]; then
+    echo "innodb_buffer_pool_size=${INNODB_BUFFER_POOL_SIZE}" >> ${OPT_FILE}
+fi
+if [ ! -z "${INNODB_LOG_FILE_SIZE}" ]; then
+    echo "innodb_log_file_size=${INNODB_LOG_FILE_SIZE}" >> ${OPT_FILE}
+fi
+
 fi
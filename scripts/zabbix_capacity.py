@@ -0,0 +1,185 @@
+#
+# Capacity planner: sizes caches and pollers of Zabbix server and InnoDB of its database from counts of monitored objects
+#
+
+import math, re
+
+MB = 1024 * 1024
+GB = 1024 * MB
+SIZE_UNITS = {"": 1, "K": 1024, "M": MB, "G": GB, "T": 1024 * GB}
+SIZE_PATTERN = re.compile(r"^(\d+)([KMGT]?)B?$", re.IGNORECASE)
+DELAY_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+DELAY_PATTERN = re.compile(r"^(\d+)([smhdw]?)$")
+# Interval of items whose delay is a user macro or which have only flexible or scheduling intervals
+DEFAULT_DELAY = 60
+# Item types which are processed by pollers: agent, SNMP, simple check, internal, external check, database monitor, SSH, telnet, calculated
+POLLED_TYPES = [0, 1, 3, 4, 5, 6, 10, 11, 13, 14, 15]
+# Item types without own interval: trapper, web item, SNMP trap, dependent item; dependent items are counted at interval of their master
+UNSCHEDULED_TYPES = [2, 9, 17, 18]
+DEPENDENT_TYPE = 18
+# Item flags: plain item, LLD rule, discovered item; prototypes do not collect values
+ITEM_FLAGS = {0: "items", 1: "lld_rules", 4: "items"}
+
+HOSTS_QUERY = "SELECT COUNT(*) FROM hosts WHERE status = 0 AND flags IN (0, 4)"
+ITEMS_QUERY = """SELECT i.type, i.delay, i.flags, COUNT(*) FROM items i JOIN hosts h ON h.hostid = i.hostid
+    WHERE i.status = 0 AND h.status = 0 AND i.flags IN (0, 1, 4) GROUP BY i.type, i.delay, i.flags"""
+# Master of dependent item is a dependent item itself in up to 3 levels, values are written at interval of the first scheduled master
+DEPENDENT_ITEMS_QUERY = """SELECT CASE WHEN m1.type <> 18 THEN m1.type WHEN m2.type <> 18 THEN m2.type ELSE m3.type END AS master_type,
+    CASE WHEN m1.type <> 18 THEN m1.delay WHEN m2.type <> 18 THEN m2.delay ELSE m3.delay END AS master_delay, COUNT(*)
+    FROM items i JOIN hosts h ON h.hostid = i.hostid JOIN items m1 ON m1.itemid = i.master_itemid
+    LEFT JOIN items m2 ON m2.itemid = m1.master_itemid LEFT JOIN items m3 ON m3.itemid = m2.master_itemid
+    WHERE i.type = 18 AND i.status = 0 AND h.status = 0 AND i.flags IN (0, 4) GROUP BY master_type, master_delay"""
+TRIGGERS_QUERY = """SELECT COUNT(DISTINCT t.triggerid), COUNT(DISTINCT f.itemid) FROM triggers t
+    JOIN functions f ON f.triggerid = t.triggerid JOIN items i ON i.itemid = f.itemid JOIN hosts h ON h.hostid = i.hostid
+    WHERE t.status = 0 AND t.flags IN (0, 4) AND i.status = 0 AND h.status = 0"""
+HTTPTESTS_QUERY = """SELECT t.delay, COUNT(*) FROM httptest t JOIN hosts h ON h.hostid = t.hostid
+    WHERE t.status = 0 AND h.status = 0 GROUP BY t.delay"""
+
+# Estimated bytes of one object in configuration cache
+CONFIG_CACHE_BYTES = {"hosts": 4096, "items": 1024, "triggers": 768, "httptests": 2048, "lld_rules": 2048}
+# History cache keeps values of this many seconds when database can not keep up, one value takes about this many bytes
+HISTORY_BUFFER_SECONDS = 300
+HISTORY_VALUE_BYTES = 160
+HISTORY_INDEX_BYTES = 128
+# Value cache keeps values of items which are used in triggers, e.g. an hour of values with one minute interval
+VALUE_CACHE_ITEM_BYTES = 4096
+# Values per second which one poller collects when a check takes 10-20 ms, poller processes per CPU before they wait for CPU
+POLLER_NVPS = 50
+POLLERS_PER_CPU = 50
+# Average seconds which one web scenario takes, one HTTP poller checks one scenario at a time
+HTTP_CHECK_SECONDS = 2
+HEADROOM = 1.5
+# Bytes of InnoDB redo log per value: history row, its index and part of trends; log files hold about an hour of writes
+REDO_VALUE_BYTES = 256
+REDO_LOG_SECONDS = 3600
+INNODB_LOG_FILES = 2
+# Part of memory for InnoDB buffer pool and Zabbix caches when server, frontend and database share the host
+MEMORY_SHARE = 0.6
+BUFFER_POOL_CHUNK = 128 * MB
+# Defaults of Zabbix server are lower bounds, maximums are allowed by Zabbix server
+LIMITS = {
+    "CacheSize": (8 * MB, 8 * GB),
+    "HistoryCacheSize": (16 * MB, 2 * GB),
+    "HistoryIndexCacheSize": (4 * MB, 2 * GB),
+    "ValueCacheSize": (8 * MB, 64 * GB),
+    "StartPollers": (5, 1000),
+    "StartHTTPPollers": (1, 1000),
+    "innodb_buffer_pool_size": (BUFFER_POOL_CHUNK, 1024 * GB),
+    "innodb_log_file_size": (48 * MB, 4 * GB)
+}
+# Variables of Zabbix server image and database container which set the parameters
+ENV_NAMES = [
+    ("CacheSize", "ZBX_CACHESIZE"),
+    ("HistoryCacheSize", "ZBX_HISTORYCACHESIZE"),
+    ("HistoryIndexCacheSize", "ZBX_HISTORYINDEXCACHESIZE"),
+    ("ValueCacheSize", "ZBX_VALUECACHESIZE"),
+    ("StartPollers", "ZBX_STARTPOLLERS"),
+    ("StartHTTPPollers", "ZBX_STARTHTTPPOLLERS"),
+    ("innodb_buffer_pool_size", "INNODB_BUFFER_POOL_SIZE"),
+    ("innodb_log_file_size", "INNODB_LOG_FILE_SIZE")
+]
+SIZE_SETTINGS = ["CacheSize", "HistoryCacheSize", "HistoryIndexCacheSize", "ValueCacheSize", "innodb_buffer_pool_size", "innodb_log_file_size"]
+
+def parse_delay(value):
+    """Returns seconds of update interval, e.g. 30, "1m" or "5m;10s/1-5,09:00-18:00"; DEFAULT_DELAY if it is unknown."""
+    match = DELAY_PATTERN.match(str(value).split(";")[0].strip())
+    if match is None or int(match.group(1)) == 0:
+        return DEFAULT_DELAY
+    return int(match.group(1)) * DELAY_UNITS[match.group(2)]
+
+def parse_size(value):
+    """Returns bytes of size like 1048576, "512M" or "16G"."""
+    match = SIZE_PATTERN.match(str(value).strip())
+    if match is None:
+        raise ValueError("Unknown size: %s"%(value))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2).upper()]
+
+def format_size(value):
+    """Returns size in the largest unit which keeps it whole, values are rounded up to megabytes."""
+    value = int(math.ceil(float(value) / MB))
+    return "%dG"%(value / 1024) if value > 0 and value % 1024 == 0 else "%dM"%(value)
+
+def memory_total(path="/proc/meminfo"):
+    """Returns bytes of total memory of the host."""
+    with open(path, "r") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2 and fields[0] == "MemTotal:":
+                return int(fields[1]) * 1024
+    raise ValueError("MemTotal is not found in %s"%(path))
+
+def scalar(cur, query):
+    cur.execute(query)
+    return cur.fetchone()
+
+def gather(db):
+    """Returns counts of enabled objects on monitored hosts and expected values per second from a DB-API connection."""
+    cur = db.cursor()
+    counts = {"hosts": int(scalar(cur, HOSTS_QUERY)[0]), "items": 0, "lld_rules": 0, "nvps": 0.0, "polled_nvps": 0.0}
+    cur.execute(ITEMS_QUERY)
+    for item_type, delay, flags, count in cur.fetchall():
+        counts[ITEM_FLAGS[int(flags)]] += int(count)
+        if int(flags) == 1 or int(item_type) in UNSCHEDULED_TYPES:
+            continue
+        nvps = float(count) / parse_delay(delay)
+        counts["nvps"] += nvps
+        if int(item_type) in POLLED_TYPES:
+            counts["polled_nvps"] += nvps
+    # Dependent items write history at rate of their master, but they are not polled
+    cur.execute(DEPENDENT_ITEMS_QUERY)
+    for master_type, delay, count in cur.fetchall():
+        if master_type is not None and int(master_type) not in UNSCHEDULED_TYPES:
+            counts["nvps"] += float(count) / parse_delay(delay)
+    triggers, trigger_items = scalar(cur, TRIGGERS_QUERY)
+    counts["triggers"], counts["trigger_items"] = int(triggers), int(trigger_items)
+    counts["httptests"], counts["http_rate"] = 0, 0.0
+    cur.execute(HTTPTESTS_QUERY)
+    for delay, count in cur.fetchall():
+        counts["httptests"] += int(count)
+        counts["http_rate"] += float(count) / parse_delay(delay)
+    cur.close()
+    return counts
+
+def bounded(name, value):
+    low, high = LIMITS[name]
+    return int(min(max(value, low), high))
+
+def recommend(counts, cpus, memory, database_size=0):
+    """Returns recommended settings of Zabbix server and InnoDB and warnings about them.
+    Sizes are bytes, database_size is bytes of data and indexes or 0 if it is unknown."""
+    settings, warnings = dict(), []
+    settings["CacheSize"] = bounded("CacheSize", HEADROOM * sum([counts[kind] * size for kind, size in CONFIG_CACHE_BYTES.items()]))
+    settings["HistoryCacheSize"] = bounded("HistoryCacheSize", counts["nvps"] * HISTORY_BUFFER_SECONDS * HISTORY_VALUE_BYTES)
+    settings["HistoryIndexCacheSize"] = bounded("HistoryIndexCacheSize", HEADROOM * counts["items"] * HISTORY_INDEX_BYTES)
+    settings["ValueCacheSize"] = bounded("ValueCacheSize", HEADROOM * counts["trigger_items"] * VALUE_CACHE_ITEM_BYTES)
+    for name, needed in [("StartPollers", counts["polled_nvps"] / POLLER_NVPS), ("StartHTTPPollers", counts["http_rate"] * HTTP_CHECK_SECONDS)]:
+        pollers = bounded(name, math.ceil(HEADROOM * needed))
+        if pollers > cpus * POLLERS_PER_CPU:
+            warnings.append("%s needs %d processes, it is limited to %d by %d CPUs."%(name, pollers, cpus * POLLERS_PER_CPU, cpus))
+            pollers = bounded(name, cpus * POLLERS_PER_CPU)
+        settings[name] = pollers
+    for name in SIZE_SETTINGS[:4]:
+        settings[name] = int(math.ceil(float(settings[name]) / MB)) * MB
+    caches = sum([settings[name] for name in SIZE_SETTINGS[:4]])
+    # Buffer pool holds the whole database if it fits, the rest of memory is left to frontend, agent and page cache
+    available = int((memory * MEMORY_SHARE - caches) / BUFFER_POOL_CHUNK) * BUFFER_POOL_CHUNK
+    needed = int(math.ceil(database_size * HEADROOM / BUFFER_POOL_CHUNK)) * BUFFER_POOL_CHUNK if database_size > 0 else available
+    pool = bounded("innodb_buffer_pool_size", min(needed, available))
+    if caches + pool > memory * MEMORY_SHARE:
+        warnings.append("Zabbix caches and InnoDB buffer pool need %s, it is more than %d%% of %s memory."%(
+            format_size(caches + pool), MEMORY_SHARE * 100, format_size(memory)))
+    settings["innodb_buffer_pool_size"] = pool
+    log_size = bounded("innodb_log_file_size", counts["nvps"] * REDO_VALUE_BYTES * REDO_LOG_SECONDS / INNODB_LOG_FILES)
+    settings["innodb_log_file_size"] = int(math.ceil(float(log_size) / MB)) * MB
+    return settings, warnings
+
+def render_env(settings, counts, cpus, memory):
+    """Returns settings as env file for docker-compose, inputs are kept in comments."""
+    lines = [
+        "# Hosts: %d, items: %d, triggers: %d, web scenarios: %d, LLD rules: %d"%(
+            counts["hosts"], counts["items"], counts["triggers"], counts["httptests"], counts["lld_rules"]),
+        "# Values per second: %.2f, polled: %.2f; CPUs: %d, memory: %s"%(counts["nvps"], counts["polled_nvps"], cpus, format_size(memory))
+    ]
+    for name, variable in ENV_NAMES:
+        lines.append("%s=%s"%(variable, format_size(settings[name]) if name in SIZE_SETTINGS else settings[name]))
+    return "\n".join(lines) + "\n"
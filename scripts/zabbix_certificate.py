@@ -0,0 +1,167 @@
+#!/usr/bin/python
+
+#
+# External script for Zabbix agent, checks TLS certificates of all discovered web urls at once
+#
+
+import argparse, calendar, json, logging, multiprocessing, os, socket, ssl, sys, time
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+CMD_CHECK = "check"
+WEB_LIST_TITLE_NAME = "web"
+DEFAULT_PORT = 443
+# Failed checks are repeated sooner than successful ones
+ERROR_TTL = 300
+
+parser = argparse.ArgumentParser(prog="./%s"%(os.path.basename(sys.argv[0])), description="Certificates checker for Zabbix agent")
+parser.add_argument("command", choices=[CMD_CHECK], help="Check certificates of https urls from config and print them as one JSON document")
+parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+parser.add_argument("--config", default="url_list.json", help="JSON list of web urls")
+parser.add_argument("--cache", default="/tmp/zabbix_certificate.json", help="File for caching results of checks")
+parser.add_argument("--ttl", default=3600, type=int, help="Seconds while cached result of a check is used")
+parser.add_argument("--timeout", default=5, type=int, help="Connection and handshake timeout for every host in seconds")
+parser.add_argument("--concurrency", default=16, type=int, help="Maximum count of hosts which are checked at the same time")
+parser.add_argument("--deadline", default=2.5, type=float, help="Seconds to wait for checks, it has to be less than agent Timeout; unfinished checks are reported from cache")
+
+args = parser.parse_args()
+options = vars(args)
+
+logging.basicConfig()
+logger = logging.getLogger("CertificateExtension")
+logger.setLevel("DEBUG" if options["debug"] else "INFO")
+
+def der_elements(data, offset, end):
+    """Returns (tag, content start, content end) of DER elements between offset and end."""
+    result = []
+    while offset < end:
+        tag = ord(data[offset])
+        length = ord(data[offset+1])
+        offset += 2
+        if length & 0x80:
+            count = length & 0x7f
+            length = int(data[offset:offset+count].encode("hex"), 16)
+            offset += count
+        result.append((tag, offset, offset+length))
+        offset += length
+    return result
+
+def certificate_end_time(der):
+    """Returns notAfter of DER encoded X.509 certificate as unix timestamp."""
+    tag, start, end = der_elements(der, 0, len(der))[0]
+    tag, start, end = der_elements(der, start, end)[0]
+    fields = der_elements(der, start, end)
+    # Version is optional explicitly tagged field
+    if fields[0][0] == 0xa0:
+        fields = fields[1:]
+    # serialNumber, signature, issuer, validity
+    tag, start, end = fields[3]
+    tag, start, end = der_elements(der, start, end)[1]
+    value = der[start:end]
+    if tag == 0x17:
+        # UTCTime has two digits year
+        value = ("19" if int(value[:2]) >= 50 else "20") + value
+    return calendar.timegm(time.strptime(value, "%Y%m%d%H%M%SZ"))
+
+class Certificates:
+    def __init__(self, options=dict()):
+        self.config_file = options["config"]
+        self.cache_file = options["cache"]
+        self.ttl = options["ttl"]
+        self.timeout = options["timeout"]
+        self.concurrency = options["concurrency"]
+        self.deadline = options["deadline"]
+        self.command = options["command"]
+
+    def read_config(self):
+        if os.path.isfile(self.config_file):
+            with open(self.config_file,"r") as config_file:
+                return json.load(config_file)
+        else:
+            logger.error("Config file %s can not be found!"%(self.config_file))
+            exit(1)
+
+    def targets(self):
+        config = self.read_config()
+        result = set()
+        for item in config[WEB_LIST_TITLE_NAME] if WEB_LIST_TITLE_NAME in config else []:
+            url = urlparse(item["url"])
+            if url.scheme == "https" and url.hostname:
+                result.add("%s:%d"%(url.hostname, url.port or DEFAULT_PORT))
+        return sorted(result)
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file, "r") as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+    def save_cache(self, cache):
+        try:
+            with open(self.cache_file + ".%d"%(os.getpid()), "w") as f:
+                json.dump(cache, f)
+            os.rename(self.cache_file + ".%d"%(os.getpid()), self.cache_file)
+        except (IOError, OSError) as e:
+            logger.debug("Cache can not be saved: %s."%(e))
+
+    def fresh(self, result, now):
+        return now - result["checked"] < (min(self.ttl, ERROR_TTL) if "error" in result else self.ttl)
+
+    def probe(self, target):
+        host, port = target.rsplit(":", 1)
+        result = {"checked": int(time.time())}
+        started = time.time()
+        try:
+            sock = socket.create_connection((host, int(port)), self.timeout)
+            try:
+                context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+                context.verify_mode = ssl.CERT_NONE
+                der = context.wrap_socket(sock, server_hostname=host).getpeercert(True)
+            finally:
+                sock.close()
+            end_time = certificate_end_time(der)
+            result["endtimestamp"] = end_time
+            result["enddate"] = time.strftime("%a %b %d %H:%M:%S UTC %Y", time.gmtime(end_time))
+        except (socket.error, ssl.SSLError, ValueError, IndexError) as e:
+            result["error"] = str(e) or e.__class__.__name__
+        logger.debug("Checked %s in %.3f sec."%(target, time.time() - started))
+        return target, result
+
+    def check(self):
+        targets = self.targets()
+        cache = self.load_cache()
+        now = time.time()
+        stale = [target for target in targets if target not in cache or not self.fresh(cache[target], now)]
+        logger.debug("Certificates to check: %d of %d."%(len(stale), len(targets)))
+        if len(stale) > 0:
+            pool = ThreadPool(min(self.concurrency, len(stale)))
+            results = pool.imap_unordered(self.probe, stale)
+            try:
+                for i in range(0, len(stale)):
+                    target, result = results.next(max(0, now + self.deadline - time.time()))
+                    cache[target] = result
+            except multiprocessing.TimeoutError:
+                logger.debug("Deadline is reached, remaining checks are repeated by the next call.")
+            pool.terminate()
+            # Hosts which are not discovered anymore are dropped from cache
+            self.save_cache(dict((target, cache[target]) for target in targets if target in cache))
+        result = dict()
+        for target in targets:
+            if target in cache:
+                result[target] = dict((key, value) for key, value in cache[target].items() if key != "checked")
+        return json.dumps(result, sort_keys=True)
+
+    def main(self):
+        if self.command == CMD_CHECK:
+            print self.check()
+        return 0
+
+if __name__ == "__main__":
+    app = Certificates(options)
+    try:
+        exit(app.main())
+    except KeyboardInterrupt:
+        logger.error("Interrupted by user.")
+    except:
+        raise
@@ -0,0 +1,163 @@
+#!/usr/bin/python
+
+#
+# External script for Zabbix agent, collects metrics of all containers by one pass over cgroup filesystem and Docker API
+#
+
+import argparse, httplib, json, logging, os, re, socket, sys, time
+from urllib import quote
+
+CMD_DISCOVERY = "discovery"
+CMD_STATS = "stats"
+# cpuacct.stat of cgroup v1 counts time in these ticks, values of cgroup v2 are converted to them
+USER_HZ = 100
+CONTAINER_PATTERN = re.compile(r"^(?:docker-)?([0-9a-f]{64})(?:\.scope)?$")
+DANGLING_FILTER = quote(json.dumps({"dangling": ["true"]}))
+
+parser = argparse.ArgumentParser(prog="./%s"%(os.path.basename(sys.argv[0])), description="Docker metrics collector for Zabbix agent")
+parser.add_argument("command", choices=[CMD_DISCOVERY, CMD_STATS], help="Discovery of running containers, or metrics of all containers as one JSON document")
+parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+parser.add_argument("--socket", default="/var/run/docker.sock", help="Unix socket of Docker API")
+parser.add_argument("--cgroup-root", default="/sys/fs/cgroup", help="Mount point of cgroup filesystem")
+parser.add_argument("--timeout", default=5, type=int, help="Timeout of Docker API requests in seconds")
+
+args = parser.parse_args()
+options = vars(args)
+
+logging.basicConfig()
+logger = logging.getLogger("DockerExtension")
+logger.setLevel("DEBUG" if options["debug"] else "INFO")
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    """HTTP connection to Docker API over unix socket, it is kept alive between requests."""
+    def __init__(self, path, timeout):
+        httplib.HTTPConnection.__init__(self, "localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+def read_stat(path):
+    """Returns "key value" lines of cgroup stat file as dict, missing file is empty dict."""
+    result = dict()
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 2:
+                    result[fields[0]] = int(fields[1])
+    except IOError:
+        pass
+    return result
+
+class Docker:
+    def __init__(self, options=dict()):
+        self.socket = options["socket"]
+        self.cgroup_root = options["cgroup_root"]
+        self.timeout = options["timeout"]
+        self.command = options["command"]
+        self.connection = None
+
+    def request(self, path):
+        if self.connection is None:
+            self.connection = UnixHTTPConnection(self.socket, self.timeout)
+        self.connection.request("GET", path)
+        response = self.connection.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise ValueError("Docker API returned %d for %s: %s"%(response.status, path, data.strip()))
+        return json.loads(data)
+
+    def containers(self, all = False):
+        """Returns (id, name) of containers, names are without leading slash like in discovery macros."""
+        return [(item["Id"], item["Names"][0].lstrip("/")) for item in self.request("/containers/json?all=%d"%(1 if all else 0)) if len(item["Names"]) > 0]
+
+    def discovery(self):
+        result = [{"{#FCONTAINERID}": container_id, "{#SCONTAINERID}": container_id[:12], "{#HCONTAINERID}": name} for container_id, name in self.containers()]
+        return json.dumps({"data": result})
+
+    def cgroups(self):
+        """Walks cgroup filesystem once and returns {container id: {controller: path}}, controller is "" on cgroup v2."""
+        if os.path.isfile(os.path.join(self.cgroup_root, "cgroup.controllers")):
+            roots = [("", self.cgroup_root)]
+        else:
+            roots = [(controller, os.path.join(self.cgroup_root, controller)) for controller in ["cpuacct", "memory"]]
+        result = dict()
+        for controller, root in roots:
+            for path, folders, files in os.walk(root):
+                for folder in list(folders):
+                    match = CONTAINER_PATTERN.match(folder)
+                    if match is not None:
+                        result.setdefault(match.group(1), dict())[controller] = os.path.join(path, folder)
+                        # Nested cgroups of a container are not interesting
+                        folders.remove(folder)
+        return result
+
+    def usage(self, paths):
+        """Returns cpu ticks and memory usage of a container from its cgroups."""
+        if "" in paths:
+            cpu = read_stat(os.path.join(paths[""], "cpu.stat"))
+            memory = read_stat(os.path.join(paths[""], "memory.stat"))
+            user = cpu.get("user_usec", 0) * USER_HZ / 1000000.0
+            system = cpu.get("system_usec", 0) * USER_HZ / 1000000.0
+            return {
+                "cpu": {"user": user, "system": system, "total": cpu.get("usage_usec", 0) * USER_HZ / 1000000.0},
+                "mem": {"total_rss": memory.get("anon", 0), "total_cache": memory.get("file", 0)}
+            }
+        cpu = read_stat(os.path.join(paths.get("cpuacct", ""), "cpuacct.stat"))
+        memory = read_stat(os.path.join(paths.get("memory", ""), "memory.stat"))
+        return {
+            "cpu": {"user": cpu.get("user", 0), "system": cpu.get("system", 0), "total": cpu.get("user", 0) + cpu.get("system", 0)},
+            "mem": {"total_rss": memory.get("total_rss", 0), "total_cache": memory.get("total_cache", 0)}
+        }
+
+    def stats(self):
+        started = time.time()
+        cgroups = self.cgroups()
+        containers = dict()
+        for container_id, name in self.containers(all = True):
+            inspect = self.request("/containers/%s/json"%(container_id))
+            container = {
+                "id": container_id,
+                "up": 1 if inspect["State"]["Running"] else 0,
+                "inspect": {
+                    "Created": inspect["Created"],
+                    "RestartCount": inspect["RestartCount"],
+                    "State": {"StartedAt": inspect["State"]["StartedAt"]}
+                }
+            }
+            if container_id in cgroups:
+                container.update(self.usage(cgroups[container_id]))
+            containers[name] = container
+        result = {
+            "containers": containers,
+            "images": {"dangling": len(self.request("/images/json?filters=%s"%(DANGLING_FILTER)))},
+            "volumes": {"dangling": len(self.request("/volumes?filters=%s"%(DANGLING_FILTER))["Volumes"] or [])}
+        }
+        logger.debug("Collected metrics of %d containers in %.3f sec."%(len(containers), time.time() - started))
+        return json.dumps(result, sort_keys=True)
+
+    def main(self):
+        try:
+            if self.command == CMD_DISCOVERY:
+                print self.discovery()
+            elif self.command == CMD_STATS:
+                print self.stats()
+        except (httplib.HTTPException, socket.error, ValueError) as e:
+            logger.error("Docker API is not available: %s."%(e))
+            return 1
+        finally:
+            if self.connection is not None:
+                self.connection.close()
+        return 0
+
+if __name__ == "__main__":
+    app = Docker(options)
+    try:
+        exit(app.main())
+    except KeyboardInterrupt:
+        logger.error("Interrupted by user.")
+    except:
+        raise
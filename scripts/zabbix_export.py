@@ -0,0 +1,198 @@
+#!/usr/bin/python
+
+#
+# This script exports history or trends of selected items into compressed CSV or NDJSON files
+#
+
+import argparse, calendar, csv, gzip, json, logging, MySQLdb, MySQLdb.cursors, os, time
+from multiprocessing import Pool
+from configurator import ZabbixClient, chunks
+
+TABLES = {
+    "history": {0: "history", 1: "history_str", 2: "history_log", 3: "history_uint", 4: "history_text"},
+    "trends": {0: "trends", 3: "trends_uint"}
+}
+COLUMNS = {
+    "history": ["clock", "ns", "value"],
+    "trends": ["clock", "num", "value_min", "value_avg", "value_max"]
+}
+# Count of rows which are fetched from server side cursor and written at once
+FETCH_SIZE = 10000
+# Count of itemids in one query
+ITEMS_PER_QUERY = 1000
+
+parser = argparse.ArgumentParser(prog="./zabbix_export.py", description="Zabbix history exporter")
+parser.add_argument("--debug", action="store_true", help="Enable debug mode")
+parser.add_argument("--host", action="append", default=[], help="Technical name of host, it can be used several times")
+parser.add_argument("--item", action="append", default=[], help="Item key, * is a wildcard; it can be used several times")
+parser.add_argument("--from", dest="time_from", required=True, help="Start of interval: YYYY-MM-DD, YYYY-MM-DD HH:MM or unix time")
+parser.add_argument("--till", dest="time_till", default=None, help="End of interval, the current time by default")
+parser.add_argument("--table", default="history", choices=sorted(TABLES.keys()), help="Export history or trends")
+parser.add_argument("--format", default="csv", choices=["csv", "ndjson"], help="Format of exported files, they are compressed by gzip")
+parser.add_argument("--range", default=86400, type=int, help="Seconds of time range which is exported into one file by one worker")
+parser.add_argument("--workers", default=4, type=int, help="Count of worker processes")
+parser.add_argument("--output", default="export", help="Folder for exported files")
+parser.add_argument("--resume", action="store_true", help="Skip time ranges which were already exported")
+
+logging.basicConfig()
+logger = logging.getLogger("Exporter")
+
+def parse_time(value):
+    """Returns unix time of YYYY-MM-DD[ HH:MM] in UTC, or value itself if it is a number."""
+    if value.isdigit():
+        return int(value)
+    for fmt in ["%Y-%m-%d %H:%M", "%Y-%m-%d"]:
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise ValueError("Unknown time format: %s"%(value))
+
+def time_ranges(time_from, time_till, size):
+    return [(start, min(start + size, time_till)) for start in range(time_from, time_till, size)]
+
+def connect_database():
+    return MySQLdb.connect(
+        host = os.environ["DB_SERVER_HOST"],
+        user = os.environ["MYSQL_USER"],
+        passwd = os.environ["MYSQL_PASSWORD"],
+        db = os.environ["MYSQL_DATABASE"],
+        cursorclass = MySQLdb.cursors.SSCursor
+    )
+
+class Writer:
+    """Writes rows into gzip compressed CSV or NDJSON file."""
+    def __init__(self, path, fmt, columns):
+        self.file = gzip.open(path, "wb")
+        self.fmt = fmt
+        self.columns = columns
+        if fmt == "csv":
+            self.csv = csv.writer(self.file)
+            self.csv.writerow(columns)
+
+    def write(self, rows):
+        if self.fmt == "csv":
+            self.csv.writerows(rows)
+        else:
+            self.file.write("".join([json.dumps(dict(zip(self.columns, row))) + "\n" for row in rows]))
+
+    def close(self):
+        self.file.close()
+
+# Settings of worker processes, they are set by init_worker
+worker = dict()
+
+def init_worker(settings):
+    worker.update(settings)
+
+def export_range(time_range):
+    """Streams rows of one time range from database into its file and returns count of rows."""
+    start, end = time_range
+    path = os.path.join(worker["output"], "%s_%d_%d.%s.gz"%(worker["table"], start, end, worker["format"]))
+    started = time.time()
+    db = connect_database()
+    writer = Writer(path + ".part", worker["format"], ["host", "key"] + COLUMNS[worker["table"]])
+    count = 0
+    try:
+        for table, itemids in sorted(worker["tables"].items()):
+            for part in chunks(itemids, ITEMS_PER_QUERY):
+                cur = db.cursor()
+                cur.execute("SELECT itemid, %s FROM %s WHERE itemid IN (%s) AND clock >= %%s AND clock < %%s"%(
+                    ", ".join(COLUMNS[worker["table"]]), table, ",".join(["%d"%(itemid) for itemid in part])), [start, end])
+                while True:
+                    rows = cur.fetchmany(FETCH_SIZE)
+                    if not rows:
+                        break
+                    writer.write([worker["items"][row[0]] + tuple(row[1:]) for row in rows])
+                    count += len(rows)
+                cur.close()
+    finally:
+        writer.close()
+        db.close()
+    # Complete file name marks the range as exported, so it is skipped by resuming
+    os.rename(path + ".part", path)
+    return start, end, count, time.time() - started
+
+class Exporter:
+    def __init__(self, options=dict()):
+        self.url = os.environ["ZBX_SERVER_URL"]
+        self.username = os.environ["ZBX_EXPORT_USER"] if "ZBX_EXPORT_USER" in os.environ and os.environ["ZBX_EXPORT_USER"].strip() != "" else "admin"
+        self.password = os.environ["ZBX_ADMIN_PASSWORD"] if "ZBX_ADMIN_PASSWORD" in os.environ else "zabbix"
+        self.hosts = options["host"]
+        self.keys = options["item"]
+        self.time_from = parse_time(options["time_from"])
+        self.time_till = parse_time(options["time_till"]) if options["time_till"] else int(time.time())
+        self.table = options["table"]
+        self.format = options["format"]
+        self.range = options["range"]
+        self.workers = options["workers"]
+        self.output = options["output"]
+        self.resume = options["resume"]
+        self.zapi = ZabbixClient(self.url)
+
+    def resolve_items(self):
+        """Returns {itemid: (host, key)} and itemids by table of selected items."""
+        params = {"output": ["itemid", "key_", "value_type"], "selectHosts": ["host"], "webitems": True}
+        if len(self.hosts) > 0:
+            params["hostids"] = [host["hostid"] for host in self.zapi.host.get(output=["hostid"], filter={"host": self.hosts})]
+            if len(params["hostids"]) == 0:
+                return dict(), dict()
+        if len(self.keys) > 0:
+            params["search"] = {"key_": self.keys}
+            params["searchWildcardsEnabled"] = True
+            params["searchByAny"] = True
+        items, tables = dict(), dict()
+        for item in self.zapi.item.get(**params):
+            value_type = int(item["value_type"])
+            if value_type not in TABLES[self.table]:
+                continue
+            items[int(item["itemid"])] = (item["hosts"][0]["host"], item["key_"])
+            tables.setdefault(TABLES[self.table][value_type], []).append(int(item["itemid"]))
+        return items, tables
+
+    def pending_ranges(self):
+        ranges = time_ranges(self.time_from, self.time_till, self.range)
+        if not self.resume:
+            return ranges
+        done = set(os.listdir(self.output))
+        return [(start, end) for start, end in ranges if "%s_%d_%d.%s.gz"%(self.table, start, end, self.format) not in done]
+
+    def main(self):
+        if len(self.hosts) == 0 and len(self.keys) == 0:
+            logger.error("At least one host or item has to be selected.")
+            return 1
+        self.zapi.login(self.username, self.password)
+        items, tables = self.resolve_items()
+        self.zapi.user.logout()
+        logger.info("Selected %d items in %d tables."%(len(items), len(tables)))
+        if len(items) == 0:
+            return 1
+        if not os.path.isdir(self.output):
+            os.makedirs(self.output)
+        ranges = self.pending_ranges()
+        logger.info("Exporting %d time ranges by %d workers."%(len(ranges), self.workers))
+        settings = {"output": self.output, "table": self.table, "format": self.format, "items": items, "tables": tables}
+        pool = Pool(self.workers, init_worker, (settings,))
+        total = 0
+        try:
+            for start, end, count, seconds in pool.imap_unordered(export_range, ranges):
+                total += count
+                logger.debug("Exported %d rows from %d till %d in %.3f sec."%(count, start, end, seconds))
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        pool.close()
+        pool.join()
+        logger.info("Exported %d rows into %s."%(total, self.output))
+        return 0
+
+if __name__ == "__main__":
+    options = vars(parser.parse_args())
+    logger.setLevel("DEBUG" if options["debug"] else "INFO")
+    app = Exporter(options)
+    try:
+        exit(app.main())
+    except KeyboardInterrupt:
+        logger.error("Interrupted by user.")
+    except Exception:
+        raise
@@ -0,0 +1,132 @@
+#
+# Zabbix sender protocol: values are pushed to trapper items of Zabbix server or proxy
+#
+
+import json, logging, Queue, re, socket, struct, time
+from multiprocessing.pool import ThreadPool
+
+ZBX_HEADER = "ZBXD\x01"
+DEFAULT_PORT = 10051
+# Zabbix sender utility does not put more values into one request too
+DEFAULT_CHUNK_SIZE = 250
+INFO_PATTERN = re.compile(r"processed: (\d+); failed: (\d+); total: (\d+); seconds spent: ([\d.]+)")
+
+logger = logging.getLogger("ZabbixSender")
+
+class SenderError(Exception):
+    pass
+
+def pack(payload):
+    """Returns payload with the protocol header: signature, flags and little-endian length."""
+    return ZBX_HEADER + struct.pack("<Q", len(payload)) + payload
+
+def parse_info(info):
+    """Returns processed, failed, total counts and spent seconds from info of server response."""
+    match = INFO_PATTERN.search(info or "")
+    if match is None:
+        raise SenderError("Unexpected response info: %s"%(info))
+    return {"processed": int(match.group(1)), "failed": int(match.group(2)), "total": int(match.group(3)), "seconds": float(match.group(4))}
+
+def item_key(name, *params):
+    """Returns item key with quoted parameters, quotes inside them are escaped as Zabbix does for LLD macros in quoted parameters."""
+    return "%s[%s]"%(name, ",".join('"%s"'%(param.replace('"', '\\"')) for param in params))
+
+def value(host, key, data, clock=None):
+    """Returns one value of sender request, clock is the current time by default."""
+    return {"host": host, "key": key, "value": str(data), "clock": int(clock if clock is not None else time.time())}
+
+class Sender:
+    """Sends values in chunks through a pool of reused connections to trapper port."""
+    def __init__(self, server, port=DEFAULT_PORT, chunk_size=DEFAULT_CHUNK_SIZE, connections=2, timeout=10):
+        self.server = server
+        self.port = port
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.pool_size = connections
+        # Every slot holds an idle connection, or None until the slot is used first time
+        self.connections = Queue.Queue()
+        for i in range(0, connections):
+            self.connections.put(None)
+
+    def connect(self):
+        return socket.create_connection((self.server, self.port), self.timeout)
+
+    def recv(self, sock, size):
+        data = ""
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise SenderError("Connection is closed by %s:%d"%(self.server, self.port))
+            data += chunk
+        return data
+
+    def exchange(self, sock, payload):
+        sock.sendall(pack(payload))
+        header = self.recv(sock, len(ZBX_HEADER) + 8)
+        if not header.startswith(ZBX_HEADER):
+            raise SenderError("Unexpected response header from %s:%d"%(self.server, self.port))
+        return self.recv(sock, struct.unpack("<Q", header[len(ZBX_HEADER):])[0])
+
+    def request(self, payload):
+        """Sends one packet, an idle connection closed by server is replaced once by new one."""
+        sock = self.connections.get()
+        try:
+            reused = sock is not None
+            if not reused:
+                sock = self.connect()
+            try:
+                response = self.exchange(sock, payload)
+            except (SenderError, socket.error):
+                sock.close()
+                sock = None
+                if not reused:
+                    raise
+                # Server closes trapper connections after every request, so only fresh connections fail for real
+                sock = self.connect()
+                response = self.exchange(sock, payload)
+        except:
+            if sock is not None:
+                sock.close()
+            sock = None
+            raise
+        finally:
+            self.connections.put(sock)
+        return response
+
+    def send_chunk(self, values):
+        try:
+            response = json.loads(self.request(json.dumps({"request": "sender data", "data": values, "clock": int(time.time())})))
+        except socket.error as e:
+            raise SenderError("Values can not be sent to %s:%d: %s"%(self.server, self.port, e))
+        except ValueError:
+            raise SenderError("Unable to parse response of %s:%d"%(self.server, self.port))
+        if response.get("response") != "success":
+            raise SenderError("Values are rejected by %s:%d: %s"%(self.server, self.port, response.get("info", "no info")))
+        return parse_info(response.get("info"))
+
+    def send(self, values):
+        """Sends values, created by value(), and returns summary of server responses."""
+        chunks = [values[i:i+self.chunk_size] for i in range(0, len(values), self.chunk_size)]
+        if len(chunks) > 1 and self.pool_size > 1:
+            pool = ThreadPool(min(self.pool_size, len(chunks)))
+            try:
+                results = pool.map(self.send_chunk, chunks, 1)
+            finally:
+                pool.close()
+        else:
+            results = [self.send_chunk(chunk) for chunk in chunks]
+        summary = {"processed": 0, "failed": 0, "total": 0, "seconds": 0.0}
+        for result in results:
+            for key in summary:
+                summary[key] += result[key]
+        logger.debug("Sent %d values in %d requests: %s."%(len(values), len(chunks), summary))
+        return summary
+
+    def close(self):
+        """Closes idle connections, sender stays usable and opens new ones when needed."""
+        for i in range(0, self.pool_size):
+            sock = self.connections.get()
+            if sock is not None:
+                sock.close()
+        for i in range(0, self.pool_size):
+            self.connections.put(None)
@@ -1,19 +1,53 @@
 #!/usr/bin/python
 
-import argparse, json, logging, os, sys
-from urlparse import urlparse
+import argparse, hashlib, httplib, json, logging, marshal, os, socket, SocketServer, ssl, sys, threading, time
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from urlparse import urljoin, urlparse
+from zabbix_sender import Sender, SenderError, item_key, value
 
 CMD_DISCOVERY = "discovery"
+CMD_SERVE = "serve"
+CMD_PROBE = "probe"
 ALL = -1
 WEB_LIST_TITLE_NAME="web"
+# Pre-parsed url list is stored next to the config file, it is rebuilt when config's mtime or size is changed
+INDEX_SUFFIX = ".index"
+INDEX_VERSION = 1
+# Results of probe mode are sent to trapper items web.probe.<metric>["<url>"], metric is status, ttfb or time
+PROBE_KEY = "web.probe.%s"
+MAX_REDIRECTS = 5
 
 parser = argparse.ArgumentParser(prog="./%s"%(os.path.basename(sys.argv[0])), description="External script for Zabbix agent")
-parser.add_argument(CMD_DISCOVERY, help="URL discovery command")
+parser.add_argument("command", choices=[CMD_DISCOVERY, CMD_SERVE, CMD_PROBE], help="URL discovery command, daemon mode which answers discovery queries over unix socket, or checking of all urls with sending results to Zabbix trapper")
 parser.add_argument("--debug", action="store_true", help="Enable debug mode")
 parser.add_argument("--config", default="url_list.json", help="JSON list of web urls")
 parser.add_argument("--protocol", default=str(ALL), choices=[str(ALL),"http","https"], help="Limit url discovery mode by url protocol")
 parser.add_argument("--priority", default=ALL, type=int, help="Limit url discovery mode by url checking priority")
 parser.add_argument("--unique", action="store_true", help="Make distinct selection of server names")
+parser.add_argument("--index-folder", default="/tmp", help="Writable folder for pre-parsed url list, it is shared by all modes")
+parser.add_argument("--socket", default="/var/run/zabbix/zabbix_web.sock", help="Unix socket of daemon mode")
+parser.add_argument("--server", default="127.0.0.1", help="Zabbix server or proxy which receives results of probe mode")
+parser.add_argument("--port", default=10051, type=int, help="Trapper port of Zabbix server or proxy")
+parser.add_argument("--host", default=os.environ["ZBX_WEB_PROBE_HOST"] if "ZBX_WEB_PROBE_HOST" in os.environ and os.environ["ZBX_WEB_PROBE_HOST"].strip() != "" else "Zabbix server",
+    help="Host name in Zabbix with Template Web Check linked, it owns trapper items of probe mode")
+parser.add_argument("--timeout", default=10, type=float, help="Timeout of every url check in probe mode, in seconds")
+parser.add_argument("--concurrency", default=64, type=int, help="Maximum count of urls which are checked at the same time")
+parser.add_argument("--host-concurrency", default=4, type=int, help="Maximum count of connections to the same web server")
+
+class QueryParser(argparse.ArgumentParser):
+    """Parser of daemon queries, errors are raised instead of printing usage into the daemon's stderr and exiting."""
+    def error(self, message):
+        raise ValueError(message)
+
+    def print_help(self, file=None):
+        pass
+
+    def exit(self, status=0, message=None):
+        raise ValueError(message or "help is not available over socket")
+
+# Queries of daemon clients have the same arguments as the command line
+query_parser = QueryParser(prog=parser.prog, parents=[parser], add_help=False)
 
 args = parser.parse_args()
 options = vars(args)
@@ -28,14 +62,23 @@ logger.debug(options)
 class Web:
     def __init__(self, options=dict()):
         self.config_file = options["config"]
+        self.index_folder = options["index_folder"]
         self.debug = options["debug"]
         self.protocol = options["protocol"]
         self.priority = options["priority"]
         self.unique = options["unique"]
-        config = self.read_config()
-        self.url_list = config[WEB_LIST_TITLE_NAME] if WEB_LIST_TITLE_NAME in config else []
-        if CMD_DISCOVERY in options:
-            self.command = CMD_DISCOVERY
+        self.socket = options["socket"]
+        self.server = options["server"]
+        self.port = options["port"]
+        self.host = options["host"]
+        self.timeout = options["timeout"]
+        self.concurrency = options["concurrency"]
+        self.host_concurrency = options["host_concurrency"]
+        self.index = self.load_index()
+        self.command = options["command"]
+        # Daemon mode keeps answers to repeated queries until url list is changed
+        self.answers = dict()
+        self.lock = threading.Lock()
 
     def read_config(self):
         if os.path.isfile(self.config_file):
@@ -45,36 +88,255 @@ class Web:
             logger.error("Config file %s can not be found!"%(self.config_file))
             exit(1)
 
-    def discovery(self, protocol = ALL, priority = ALL):
+    def build_index(self):
+        """Parses url list once: items are (name, url, scheme, netloc, priority), buckets are item positions by (scheme, priority)."""
+        config = self.read_config()
+        items = []
+        buckets = dict()
+        for item in config[WEB_LIST_TITLE_NAME] if WEB_LIST_TITLE_NAME in config else []:
+            url = urlparse(item["url"])
+            # Priority is optional in url list, configurator creates triggers of such urls with priority 1
+            priority = int(item.get("priority", 1))
+            buckets.setdefault((url.scheme, priority), []).append(len(items))
+            items.append((item["name"], item["url"], url.scheme, url.netloc, priority))
+        return {"items": items, "buckets": buckets}
+
+    def index_key(self):
+        stat = os.stat(self.config_file)
+        return (INDEX_VERSION, stat.st_mtime, stat.st_size)
+
+    def load_index(self):
+        if not os.path.isfile(self.config_file):
+            logger.error("Config file %s can not be found!"%(self.config_file))
+            exit(1)
+        key = self.index_key()
+        # Config folder is not writable by agent user, so index is kept in its own folder and named by path of config
+        index_file = os.path.join(self.index_folder, "zabbix_web_%s%s"%(hashlib.md5(os.path.abspath(self.config_file)).hexdigest()[:16], INDEX_SUFFIX))
+        try:
+            with open(index_file, "rb") as f:
+                index = marshal.load(f)
+            if index["key"] == key:
+                logger.debug("Using pre-parsed url list from %s."%(index_file))
+                return index
+        except (IOError, EOFError, ValueError, TypeError, KeyError):
+            pass
+        logger.debug("Building index of url list.")
+        index = self.build_index()
+        index["key"] = key
+        try:
+            # Index is replaced atomically, because several discovery rules can be polled at the same time
+            with open(index_file + ".%d"%(os.getpid()), "wb") as f:
+                marshal.dump(index, f)
+            os.rename(index_file + ".%d"%(os.getpid()), index_file)
+        except (IOError, OSError) as e:
+            logger.warning("Index of url list can not be saved into %s, it is built by every call: %s."%(index_file, e))
+        return index
+
+    def select(self, protocol = ALL, priority = ALL):
+        """Returns positions of url list items with given protocol and priority."""
+        positions = []
+        for (scheme, bucket_priority), bucket in self.index["buckets"].items():
+            if (protocol == str(ALL) or scheme == protocol) and (priority == ALL or bucket_priority == priority):
+                positions.extend(bucket)
+        # Several buckets are merged in order of the url list
+        if len(positions) != 0 and (protocol == str(ALL) or priority == ALL):
+            positions.sort()
+        return positions
+
+    def discovery(self, protocol = ALL, priority = ALL, unique = False):
         logger.debug("Discoverying of url list.")
         logger.debug("Protocol: %s"%(str(protocol)))
         logger.debug("Priority: %d"%(priority))
+        positions = self.select(protocol, priority)
         result = []
-        for item in self.url_list:
-            url = urlparse(item["url"])
-            if protocol != str(ALL) and url.scheme != protocol:
-                continue
-            if priority != ALL and int(item["priority"]) != priority:
-                continue
-            check_url = item["url"] if not self.unique else url.scheme + "://" + url.netloc
+        seen = set()
+        for position in positions:
+            name, check_url, scheme, netloc, item_priority = self.index["items"][position]
+            if unique:
+                check_url = scheme + "://" + netloc
+                if check_url in seen:
+                    logger.debug("Already exists. Skipping.")
+                    continue
+                seen.add(check_url)
             logger.debug(check_url)
-            if self.unique and len(filter(lambda url_list: url_list["{#URL}"] == url.scheme + "://" + url.netloc, result))>0:
-                logger.debug("Already exists. Skipping.")
-                continue
             result.append({
-                "{#DESCRIPTION}": item["name"],
+                "{#DESCRIPTION}": name,
                 "{#URL}": check_url,
-                "{#HOSTNAME}": url.netloc.split(":")[0]
+                "{#HOSTNAME}": netloc.split(":")[0]
             })
         return json.dumps({"data": result})
 
+    def answer(self, args):
+        """Answers discovery query of the daemon client, args are the same as command line arguments.
+        Failed query gets JSON with error instead of data, so discovery rule becomes unsupported, but keeps discovered items."""
+        try:
+            query = vars(query_parser.parse_args(args))
+        except ValueError as e:
+            logger.error("Invalid arguments %s: %s."%(" ".join(args), e))
+            return json.dumps({"error": "Invalid arguments: %s"%(e)})
+        key = (query["protocol"], query["priority"], query["unique"])
+        with self.lock:
+            try:
+                # Checking of config file on every query costs one stat call
+                try:
+                    changed = self.index_key() != self.index["key"]
+                except OSError:
+                    changed = False
+                if changed:
+                    logger.info("Config file %s was changed, reloading url list."%(self.config_file))
+                    self.answers = dict()
+                    self.index = self.load_index()
+                if key not in self.answers:
+                    self.answers[key] = self.discovery(protocol = query["protocol"], priority = query["priority"], unique = query["unique"])
+                return self.answers[key]
+            except Exception as e:
+                logger.exception("Url list can not be loaded from %s."%(self.config_file))
+                return json.dumps({"error": "Url list can not be loaded: %s"%(e)})
+
+    def serve(self):
+        if os.path.exists(self.socket):
+            os.unlink(self.socket)
+        server = SocketServer.ThreadingUnixStreamServer(self.socket, DiscoveryHandler)
+        server.daemon_threads = True
+        server.web = self
+        os.chmod(self.socket, 0o660)
+        logger.info("Answering discovery queries on %s."%(self.socket))
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(self.socket)
+
+    def connect(self, scheme, netloc):
+        if scheme == "https":
+            # Web scenarios do not verify certificates either, expiration is checked by certificate.check item
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout, context=context)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def fetch(self, connections, url):
+        """Requests url over kept alive connection to its host, returns the response with body already read."""
+        key = (url.scheme, url.netloc)
+        path = (url.path or "/") + ("?" + url.query if url.query else "")
+        reused = key in connections
+        if not reused:
+            connections[key] = self.connect(url.scheme, url.netloc)
+        try:
+            connections[key].request("GET", path, headers={"User-Agent": "Zabbix"})
+            response = connections[key].getresponse()
+        except (httplib.HTTPException, socket.error):
+            if not reused:
+                raise
+            # Server could close idle connection between two requests, it is retried once over new connection
+            connections[key].close()
+            connections[key].request("GET", path, headers={"User-Agent": "Zabbix"})
+            response = connections[key].getresponse()
+        response.ttfb = time.time()
+        while response.read(65536):
+            pass
+        return response
+
+    def probe_url(self, connections, item):
+        """Returns (url, status, time to first byte, total time), redirects are followed like web scenarios do."""
+        name, check_url, scheme, netloc, priority = item
+        started = time.time()
+        ttfb = None
+        url = check_url
+        try:
+            for i in range(0, MAX_REDIRECTS + 1):
+                response = self.fetch(connections, urlparse(url))
+                if ttfb is None:
+                    ttfb = response.ttfb - started
+                location = response.getheader("location")
+                if response.status not in (301, 302, 303, 307, 308) or location is None:
+                    break
+                url = urljoin(url, location)
+            logger.debug("%s: %d in %.3f sec."%(check_url, response.status, time.time() - started))
+            return (check_url, response.status, ttfb, time.time() - started)
+        except (httplib.HTTPException, socket.error, ssl.SSLError, ValueError) as e:
+            logger.debug("%s: %s."%(check_url, str(e) or e.__class__.__name__))
+            return (check_url, 0, None, None)
+
+    def probe_host(self, queue):
+        """Checks urls of one web server one by one, connections are kept alive between them."""
+        connections = dict()
+        results = []
+        try:
+            while True:
+                try:
+                    position = queue.popleft()
+                except IndexError:
+                    break
+                results.append(self.probe_url(connections, self.index["items"][position]))
+        finally:
+            for connection in connections.values():
+                connection.close()
+        return results
+
+    def probe_all(self, positions):
+        """Checks urls concurrently, at most host_concurrency of them are checked on the same web server."""
+        queues = dict()
+        for position in positions:
+            name, check_url, scheme, netloc, priority = self.index["items"][position]
+            queues.setdefault((scheme, netloc), deque()).append(position)
+        # Every web server gets its first worker before any server gets the second one
+        tasks = []
+        for i in range(0, self.host_concurrency):
+            tasks.extend(queue for key, queue in sorted(queues.items()) if len(queue) > i)
+        if len(tasks) == 0:
+            return []
+        pool = ThreadPool(min(self.concurrency, len(tasks)))
+        try:
+            return [result for results in pool.map(self.probe_host, tasks, 1) for result in results]
+        finally:
+            pool.close()
+
+    def probe(self):
+        started = time.time()
+        results = self.probe_all(self.select(self.protocol, self.priority))
+        clock = int(time.time())
+        values = []
+        for check_url, status, ttfb, total in results:
+            values.append(value(self.host, item_key(PROBE_KEY%("status"), check_url), status, clock))
+            if ttfb is not None:
+                values.append(value(self.host, item_key(PROBE_KEY%("ttfb"), check_url), "%.6f"%(ttfb), clock))
+                values.append(value(self.host, item_key(PROBE_KEY%("time"), check_url), "%.6f"%(total), clock))
+        logger.debug("Checked %d urls in %.3f sec."%(len(results), time.time() - started))
+        if len(values) == 0:
+            return 0
+        sender = Sender(self.server, self.port, timeout=self.timeout)
+        try:
+            summary = sender.send(values)
+        except SenderError as e:
+            logger.error("Results can not be sent: %s."%(e))
+            return 1
+        finally:
+            sender.close()
+        logger.debug("Server processed %d of %d values."%(summary["processed"], summary["total"]))
+        if summary["failed"] > 0 or summary["processed"] < len(values):
+            # Values of unknown host or of items which were not discovered yet are dropped by server
+            logger.error("Server accepted %d of %d values, host %s must exist and have Template Web Check linked."%(summary["processed"], len(values), self.host))
+            return 1
+        return 0
+
     def main(self):
-        logger.debug("Reading url list from config file.")
-        logger.debug(self.url_list)
+        logger.debug("Url list contains %d items."%(len(self.index["items"])))
         if self.command == CMD_DISCOVERY:
-            print self.discovery(protocol = self.protocol, priority = self.priority)
+            print self.discovery(protocol = self.protocol, priority = self.priority, unique = self.unique)
+        elif self.command == CMD_SERVE:
+            self.serve()
+        elif self.command == CMD_PROBE:
+            return self.probe()
         return 0
 
+class DiscoveryHandler(SocketServer.StreamRequestHandler):
+    """Request is one line of tab separated arguments, response is the discovery JSON."""
+    def handle(self):
+        request = self.rfile.readline().rstrip("\n")
+        self.wfile.write(self.server.web.answer(request.split("\t") if request != "" else []))
+
 if __name__ == "__main__":
     app = Web(options)
     try:
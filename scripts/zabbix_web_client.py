@@ -0,0 +1,31 @@
+#!/usr/bin/python
+
+#
+# Tiny client of zabbix_web.py daemon: forwards command line arguments and prints the response.
+# If the daemon is not running, zabbix_web.py is executed with the same arguments.
+#
+
+import os, socket, sys
+
+SOCKET_PATH = os.environ["ZBX_WEB_SOCKET"] if "ZBX_WEB_SOCKET" in os.environ else "/var/run/zabbix/zabbix_web.sock"
+
+def main(args):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET_PATH)
+    except socket.error:
+        script = os.path.join(os.path.dirname(os.path.realpath(__file__)), "zabbix_web.py")
+        os.execv(sys.executable, [sys.executable, script] + args)
+    sock.sendall("\t".join(args) + "\n")
+    response = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            break
+        response.append(data)
+    sock.close()
+    print "".join(response)
+    return 0
+
+if __name__ == "__main__":
+    exit(main(sys.argv[1:]))
@@ -0,0 +1,386 @@
+#!/usr/bin/python
+
+#
+# Benchmark of configurator against a local fake Zabbix JSON-RPC server and a throwaway config table
+#
+
+import argparse, BaseHTTPServer, copy, json, os, shutil, socket, SocketServer, sqlite3, struct, sys, tempfile, threading, time
+import xml.etree.ElementTree as ElementTree
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import configurator
+
+parser = argparse.ArgumentParser(prog="./benchmark.py", description="Configurator benchmark")
+parser.add_argument("--debug", action="store_true", help="Show configurator log")
+parser.add_argument("--workload", action="append", default=[], help="Name of workload to run, all workloads are run by default")
+parser.add_argument("--latency", default=0.001, type=float, help="Seconds which fake server spends on every API call")
+parser.add_argument("--templates", default=10, type=int, help="Count of template files of templates workload")
+parser.add_argument("--output", default="benchmark.json", help="File for machine-readable results")
+
+# Object types of fake server: (id field, name field)
+OBJECTS = {
+    "action": ("actionid", "name"),
+    "host": ("hostid", "host"),
+    "hostgroup": ("groupid", "name"),
+    "hostinterface": ("interfaceid", "interfaceid"),
+    "httptest": ("httptestid", "name"),
+    "item": ("itemid", "key_"),
+    "map": ("sysmapid", "name"),
+    "mediatype": ("mediatypeid", "description"),
+    "template": ("templateid", "host"),
+    "trigger": ("triggerid", "description"),
+    "user": ("userid", "alias"),
+    "usergroup": ("usrgrpid", "name")
+}
+
+def initial_objects():
+    """Returns objects of freshly installed Zabbix server, which are used by configurator."""
+    return {
+        "action": [{"actionid": "3", "name": "Report problems to Zabbix administrators", "status": "1"}],
+        "host": [{"hostid": "10084", "host": "Zabbix server", "name": "Zabbix server", "status": "1", "flags": 0, "templates": []}],
+        "hostgroup": [{"groupid": "2", "name": "Linux servers"}],
+        "hostinterface": [{"interfaceid": "1", "hostid": "10084", "ip": "127.0.0.1", "dns": ""}],
+        "httptest": [],
+        "item": [],
+        "map": [{"sysmapid": "1", "name": "Local network", "hosts": ["Zabbix server"]}],
+        "mediatype": [{"mediatypeid": "1", "description": "Email", "smtp_server": "localhost", "smtp_email": "zabbix@localhost", "smtp_helo": "localhost"}],
+        "template": [{"templateid": "10001", "host": "Template OS Linux"}],
+        "trigger": [],
+        "user": [{"userid": "1", "alias": "admin", "medias": []}, {"userid": "2", "alias": "guest", "medias": []}],
+        "usergroup": [{"usrgrpid": "7", "name": "Zabbix administrators", "users": [{"userid": "1"}]}, {"usrgrpid": "9", "name": "Disabled", "users": []}]
+    }
+
+class FakeZabbix:
+    """Keeps objects of fake server and executes JSON-RPC calls on them."""
+    def __init__(self, latency):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.objects = initial_objects()
+        # Config table belongs to the server, so the next run finds settings of the previous one
+        self.database = ConfigDatabase()
+        self.next_id = 100000
+        self.calls = dict()
+        self.requests = 0
+
+    def matches(self, item, params):
+        for field, value in params.get("filter", {}).items():
+            values = value if isinstance(value, list) else [value]
+            if item.get(field) not in values:
+                return False
+        hostids = params.get("hostids")
+        if hostids is not None and item.get("hostid") not in (hostids if isinstance(hostids, list) else [hostids]):
+            return False
+        return True
+
+    def get(self, kind, params):
+        result = []
+        for item in self.objects[kind]:
+            if not self.matches(item, params):
+                continue
+            item = copy.deepcopy(item)
+            if kind == "host" and "selectParentTemplates" in params:
+                names = dict((template["templateid"], template["host"]) for template in self.objects["template"])
+                item["parentTemplates"] = [{"templateid": templateid, "host": names.get(templateid)} for templateid in item["templates"]]
+            if kind == "host":
+                item["interfaces"] = [interface for interface in self.objects["hostinterface"] if interface["hostid"] == item["hostid"]]
+            result.append(item)
+        return result
+
+    def create(self, kind, params):
+        id_field = OBJECTS[kind][0]
+        ids = []
+        for item in params if isinstance(params, list) else [params]:
+            item = copy.deepcopy(item)
+            self.next_id += 1
+            item[id_field] = str(self.next_id)
+            if kind in ["action", "host", "httptest", "item", "trigger"]:
+                item.setdefault("status", "0")
+            if kind == "host":
+                item.setdefault("flags", 0)
+            if kind == "usergroup":
+                item["users"] = [{"userid": userid} for userid in item.get("userids", [])]
+            if kind == "trigger":
+                # Trigger belongs to the host of its expression, so it is found by hostids
+                item["hostid"] = next((host["hostid"] for host in self.objects["host"] if item["expression"].startswith("{%s:"%(host["host"]))), None)
+            if kind == "user":
+                item["medias"] = []
+                for group in item.get("usrgrps", []):
+                    for usergroup in self.objects["usergroup"]:
+                        if usergroup["usrgrpid"] == str(group["usrgrpid"]):
+                            usergroup["users"].append({"userid": item[id_field]})
+            self.objects[kind].append(item)
+            ids.append(item[id_field])
+        return {id_field + "s": ids}
+
+    def update(self, kind, params):
+        id_field = OBJECTS[kind][0]
+        ids = []
+        for data in params if isinstance(params, list) else [params]:
+            for item in self.objects[kind]:
+                if item[id_field] == str(data[id_field]):
+                    for field, value in data.items():
+                        if kind == "host" and field == "templates":
+                            item["templates"] = [str(template["templateid"]) for template in value]
+                        elif kind == "usergroup" and field == "userids":
+                            item["users"] = [{"userid": str(userid)} for userid in value]
+                        elif field != id_field:
+                            item[field] = value
+                    ids.append(item[id_field])
+        return {id_field + "s": ids}
+
+    def delete(self, kind, params):
+        id_field = OBJECTS[kind][0]
+        ids = set(str(item) for item in (params if isinstance(params, list) else [params]))
+        self.objects[kind] = [item for item in self.objects[kind] if item[id_field] not in ids]
+        return {id_field + "s": sorted(ids)}
+
+    def configuration_import(self, params):
+        root = ElementTree.fromstring(params["source"])
+        for element in root.findall("./templates/template/template"):
+            if len([item for item in self.objects["template"] if item["host"] == element.text]) == 0:
+                self.create("template", {"host": element.text})
+        return True
+
+    def configuration_export(self, params):
+        """Exports objects of one type like Zabbix 3.4, only fields which identify objects and their links are exported."""
+        (option, ids), = params["options"].items()
+        kind = {"templates": "template", "hosts": "host", "maps": "map"}[option]
+        names = dict((template["templateid"], template["host"]) for template in self.objects["template"])
+        links = lambda templateids: "".join("<template><name>%s</name></template>"%(escape(names[templateid])) for templateid in templateids)
+        elements = []
+        for item in self.objects[kind]:
+            if item[OBJECTS[kind][0]] not in [str(object_id) for object_id in ids]:
+                continue
+            if kind == "template":
+                elements.append("<template><template>%s</template><name>%s</name><templates>%s</templates></template>"%(escape(item["host"]), escape(item.get("name", item["host"])), links(item.get("templates", []))))
+            elif kind == "host":
+                elements.append("<host><host>%s</host><name>%s</name><status>%s</status><templates>%s</templates></host>"%(escape(item["host"]), escape(item.get("name", item["host"])), item["status"], links(item["templates"])))
+            else:
+                elements.append("<map><name>%s</name><selements>%s</selements></map>"%(escape(item["name"]),
+                    "".join("<selement><elements><element><host>%s</host></element></elements></selement>"%(escape(host)) for host in item.get("hosts", []))))
+        return "<?xml version=\"1.0\" encoding=\"UTF-8\"?><zabbix_export><version>3.4</version><%s>%s</%s></zabbix_export>"%(option, "".join(elements), option)
+
+    def call(self, method, params):
+        kind, action = method.split(".", 1)
+        if method == "apiinfo.version":
+            return "3.4.15"
+        if method == "user.login":
+            return "0424bd59b807674191e7d77572075f33"
+        if method == "user.logout":
+            return True
+        if method == "user.updatemedia":
+            for user in self.objects["user"]:
+                if user["userid"] in [str(item["userid"]) for item in params["users"]]:
+                    user["medias"] = params["medias"]
+            return {"userids": [item["userid"] for item in params["users"]]}
+        if method == "host.massadd":
+            hostids = [str(host["hostid"]) for host in params["hosts"]]
+            for host in self.objects["host"]:
+                if host["hostid"] in hostids:
+                    host["templates"] += [str(template["templateid"]) for template in params.get("templates", []) if str(template["templateid"]) not in host["templates"]]
+            return {"hostids": hostids}
+        if method == "configuration.import":
+            return self.configuration_import(params)
+        if method == "configuration.export":
+            return self.configuration_export(params)
+        if kind in OBJECTS and action in ["get", "create", "update", "delete"]:
+            return getattr(self, action)(kind, params)
+        raise ValueError("Method %s is not implemented by fake server"%(method))
+
+    def execute(self, request):
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls[request["method"]] = self.calls.get(request["method"], 0) + 1
+            try:
+                return {"jsonrpc": "2.0", "result": self.call(request["method"], request.get("params", {})), "id": request["id"]}
+            except Exception as e:
+                return {"jsonrpc": "2.0", "error": {"code": -32602, "message": "Invalid params.", "data": str(e)}, "id": request["id"]}
+
+class JsonRpcHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        zabbix = self.server.zabbix
+        data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with zabbix.lock:
+            zabbix.requests += 1
+        body = json.dumps([zabbix.execute(request) for request in data] if isinstance(data, list) else zabbix.execute(data))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TrapperHandler(SocketServer.BaseRequestHandler):
+    """Accepts run metrics of configurator."""
+    def handle(self):
+        header = self.request.recv(13, socket.MSG_WAITALL)
+        data = json.loads(self.request.recv(struct.unpack("<Q", header[5:])[0], socket.MSG_WAITALL))["data"]
+        response = json.dumps({"response": "success", "info": "processed: %d; failed: 0; total: %d; seconds spent: 0.000100"%(len(data), len(data))})
+        self.request.sendall("ZBXD\x01" + struct.pack("<Q", len(response)) + response)
+
+class ConfigDatabase:
+    """Throwaway config table in sqlite, MySQLdb placeholders are translated for it."""
+    def __init__(self):
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        self.connection.execute("CREATE TABLE config (configid INTEGER, authentication_type INTEGER, ok_period TEXT, hk_history_mode INTEGER, hk_history TEXT, hk_trends_mode INTEGER, hk_trends TEXT)")
+        self.connection.execute("INSERT INTO config VALUES (1, 0, '30m', 1, '90d', 1, '365d')")
+
+    def cursor(self):
+        return ConfigCursor(self.connection.cursor())
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+class ConfigCursor:
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, query, params=None):
+        self.cursor.execute(query.replace("%s", "?"), params or [])
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+class BenchmarkConfigurator(configurator.Configurator):
+    """Configurator which uses stand-ins instead of database and Zabbix server port."""
+    zabbix = None
+    trapper_port = None
+
+    def connect_database(self):
+        return self.zabbix.database
+
+    def probe_server(self):
+        self.default_server_port = self.trapper_port
+
+def template_files(folder, count):
+    for i in range(0, count):
+        with open(os.path.join(folder, "template_%d.xml"%(i)), "w") as f:
+            f.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?><zabbix_export><version>3.4</version><templates><template><template>Template Benchmark %d</template><name>Template Benchmark %d</name><templates/></template></templates></zabbix_export>"%(i, i))
+
+def workloads(templates):
+    """Returns (name, urls, admin users, template files) of every workload."""
+    return [("urls_%d"%(count), count, 1, 0) for count in [1, 100, 1000, 10000]] + \
+        [("users_%d"%(count), 1, count, 0) for count in [1, 500]] + \
+        [("templates_%d"%(templates), 1, 1, templates)]
+
+def start(latency):
+    """Starts fake Zabbix server and trapper in background threads, configurator finds the trapper by BenchmarkConfigurator.trapper_port."""
+    zabbix = FakeZabbix(latency)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), JsonRpcHandler)
+    server.zabbix = zabbix
+    trapper = SocketServer.ThreadingTCPServer(("127.0.0.1", 0), TrapperHandler)
+    for item in [server, trapper]:
+        thread = threading.Thread(target=item.serve_forever)
+        thread.daemon = True
+        thread.start()
+    BenchmarkConfigurator.zabbix = zabbix
+    BenchmarkConfigurator.trapper_port = trapper.server_address[1]
+    return zabbix, server, trapper
+
+def environment(server, folder, urls, users, templates):
+    """Sets environment of configurator which configures fake server, template files are written into configuration subfolder."""
+    templates_folder = os.path.join(folder, "configuration")
+    os.makedirs(templates_folder)
+    template_files(templates_folder, templates)
+    os.environ.update({
+        "ZBX_SERVER_URL": "http://127.0.0.1:%d"%(server.server_address[1]),
+        "ZBX_SERVER_HOST": "127.0.0.1",
+        "ZBX_AGENT_HOSTNAME": "localhost",
+        "ZBX_ADMIN_PASSWORD": "benchmark",
+        "ZBX_DISABLE_GUEST": "true",
+        "SMTP_SERVER": "smtp.local",
+        "SMTP_EMAIL": "monitor@smtp.local",
+        "ADMIN_EMAIL_ADDRESS": "admin@smtp.local",
+        "DEFAULT_HOST_SECRET": "secret",
+        "URL_LIST": json.dumps([{"name": "url %d"%(i), "url": "http://host%d.local"%(i), "priority": 3} for i in range(0, urls)]),
+        "ZBX_ADMIN_USERS": json.dumps([{"name": "user%d"%(i), "password": "password"} for i in range(0, users)]),
+        "ZBX_CONFIG": json.dumps({"ok_period": "1d"}),
+        "CONFIGURATION_FOLDER": templates_folder if templates > 0 else "",
+        "ZBX_CONFIG_FOLDER": folder,
+        "ZBX_CUSTOM_CONFIG": "custom.json",
+        "ZBX_ADDITIONAL_TEMPLATES": "Template OS Linux"
+    })
+
+def reconcile(app, dry_run):
+    """Runs plan or apply mode of configurator, the printed plan is discarded."""
+    output, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        return app.reconcile(dry_run=dry_run) or 0
+    finally:
+        sys.stdout.close()
+        sys.stdout = output
+
+# The first run creates objects and the second one finds that everything is up-to-date, then the same is done
+# by plan and apply modes on a fresh server: plan, apply of the plan, and plan which finds no changes
+PHASES = [
+    ("initial", True, lambda app: app.main()),
+    ("repeated", False, lambda app: app.main()),
+    ("plan", True, lambda app: reconcile(app, True)),
+    ("apply", False, lambda app: reconcile(app, False)),
+    ("replan", False, lambda app: reconcile(app, True))
+]
+
+def run(zabbix, server, trapper, name, urls, users, templates):
+    folder = None
+    results = []
+    try:
+        for phase, fresh, function in PHASES:
+            if fresh:
+                # Fresh server comes with a new config folder, so fingerprints of earlier imports are not found
+                if folder is not None:
+                    shutil.rmtree(folder)
+                folder = tempfile.mkdtemp()
+                environment(server, folder, urls, users, templates)
+                zabbix.reset()
+            zabbix.calls, zabbix.requests = dict(), 0
+            started = time.time()
+            app = BenchmarkConfigurator()
+            code = function(app)
+            results.append({
+                "workload": name,
+                "phase": phase,
+                "urls": urls,
+                "users": users,
+                "templates": templates,
+                "exit_code": code,
+                "wall_time": round(time.time() - started, 6),
+                "http_requests": zabbix.requests,
+                "api_calls": sum(zabbix.calls.values()),
+                "api_calls_by_method": dict(zabbix.calls)
+            })
+            print "%-16s %-9s %10.3f sec %6d requests %7d calls%s"%(name, phase, results[-1]["wall_time"], zabbix.requests, results[-1]["api_calls"], "" if code == 0 else " (exit code %d)"%(code))
+    finally:
+        if folder is not None:
+            shutil.rmtree(folder)
+    return results
+
+def main(options):
+    configurator.logger.setLevel("DEBUG" if options["debug"] else "CRITICAL")
+    zabbix, server, trapper = start(options["latency"])
+    selected = [workload for workload in workloads(options["templates"]) if len(options["workload"]) == 0 or workload[0] in options["workload"]]
+    results = []
+    for workload in selected:
+        results += run(zabbix, server, trapper, *workload)
+    with open(options["output"], "w") as f:
+        json.dump({"latency": options["latency"], "results": results}, f, indent=2, sort_keys=True)
+    print "Results are saved into %s."%(options["output"])
+    server.shutdown()
+    trapper.shutdown()
+    return 1 if len([result for result in results if result["exit_code"] != 0]) > 0 else 0
+
+if __name__ == "__main__":
+    sys.exit(main(vars(parser.parse_args())))
@@ -0,0 +1,482 @@
+#!/usr/bin/python
+
+import calendar, json, os, shutil, signal, StringIO, sys, tarfile, tempfile, threading, time, types
+import xml.etree.ElementTree as ElementTree
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import configurator
+from configurator import Configurator, HashRing, Resolver, StepExecutor, Watcher, ZabbixClient, parse_period, partition_ranges
+import benchmark
+
+configurator.logger.setLevel("CRITICAL")
+
+exit_code = 0
+
+def check(title, function):
+    global exit_code
+    print "%s -"%(title),
+    try:
+        function()
+        print "SUCCESS."
+    except (AssertionError, KeyError, TypeError, ValueError) as e:
+        print "FAILED (%s)."%(e)
+        exit_code = 1
+
+def clock(*fields):
+    return calendar.timegm(fields + (0,) * (6 - len(fields)))
+
+def partitioner(rows, oldest=None, ahead=2):
+    """Returns configurator which reads partitions of a table from rows and the oldest clock, it is not connected anywhere."""
+    app = types.InstanceType(Configurator)
+    app.partitions_ahead = ahead
+    app.query = lambda query, params=None: rows if "information_schema" in query else [(oldest,)]
+    return app
+
+def check_parse_period():
+    assert parse_period("90d") == 90 * 86400 and parse_period(" 2h ") == 7200
+    assert parse_period("1w") == 604800 and parse_period("3600") == 3600 and parse_period(86400) == 86400
+
+def check_ranges():
+    # Days across the end of month, months across the end of year; start in the middle of a period is aligned to its start
+    assert partition_ranges(clock(2019, 1, 30, 12), clock(2019, 2, 2), "day") == [
+        ("p2019_01_30", clock(2019, 1, 31)), ("p2019_01_31", clock(2019, 2, 1)), ("p2019_02_01", clock(2019, 2, 2))]
+    assert partition_ranges(clock(2018, 12, 15), clock(2019, 2, 1, 0, 0, 1), "month") == [
+        ("p2018_12", clock(2019, 1, 1)), ("p2019_01", clock(2019, 2, 1)), ("p2019_02", clock(2019, 3, 1))]
+    assert partition_ranges(clock(2019, 2, 1), clock(2019, 2, 1), "day") == []
+
+def check_initial():
+    now = clock(2019, 1, 31, 23, 59, 59)
+    # Table is not partitioned yet, rows older than retention get into the first partition
+    statements = partitioner([(None, None)], oldest=clock(2018, 1, 1)).partition_statements("history", "day", 2 * 86400, now)
+    assert len(statements) == 1, statements
+    assert statements[0] == "ALTER TABLE history PARTITION BY RANGE (clock) (%s)"%(", ".join([
+        "PARTITION p2019_01_29 VALUES LESS THAN (%d)"%(clock(2019, 1, 30)),
+        "PARTITION p2019_01_30 VALUES LESS THAN (%d)"%(clock(2019, 1, 31)),
+        "PARTITION p2019_01_31 VALUES LESS THAN (%d)"%(clock(2019, 2, 1)),
+        "PARTITION p2019_02_01 VALUES LESS THAN (%d)"%(clock(2019, 2, 2)),
+        "PARTITION p2019_02_02 VALUES LESS THAN (%d)"%(clock(2019, 2, 3))])), statements
+    statements = partitioner([(None, None)], oldest=None).partition_statements("trends", "month", 365 * 86400, clock(2019, 12, 31, 23))
+    assert statements == ["ALTER TABLE trends PARTITION BY RANGE (clock) (PARTITION p2019_12 VALUES LESS THAN (%d), PARTITION p2020_01 VALUES LESS THAN (%d), PARTITION p2020_02 VALUES LESS THAN (%d))"%(
+        clock(2020, 1, 1), clock(2020, 2, 1), clock(2020, 3, 1))], statements
+
+def check_retention():
+    rows = [("p2019_01_%02d"%(day), str(clock(2019, 1, day + 1))) for day in range(27, 31)]
+    # The newest row of p2019_01_28 is one second younger than retention, it is kept; a second later it is dropped
+    boundary = clock(2019, 1, 29) + 2 * 86400
+    statements = partitioner(rows).partition_statements("history", "day", 2 * 86400, boundary - 1)
+    assert statements[-1] == "ALTER TABLE history DROP PARTITION p2019_01_27", statements
+    statements = partitioner(rows).partition_statements("history", "day", 2 * 86400, boundary)
+    assert statements[-1] == "ALTER TABLE history DROP PARTITION p2019_01_27, p2019_01_28", statements
+    # Future partitions start at the last bound, current day and 2 days ahead are covered
+    assert statements[0] == "ALTER TABLE history ADD PARTITION (PARTITION p2019_01_31 VALUES LESS THAN (%d), PARTITION p2019_02_01 VALUES LESS THAN (%d), PARTITION p2019_02_02 VALUES LESS THAN (%d))"%(
+        clock(2019, 2, 1), clock(2019, 2, 2), clock(2019, 2, 3)), statements
+
+def check_last_partition():
+    rows = [("p2018_11", str(clock(2018, 12, 1))), ("p2018_12", str(clock(2019, 1, 1)))]
+    # All partitions are expired, the last one is kept, because a table can not drop all of them
+    statements = partitioner(rows, ahead=0).partition_statements("trends", "month", 86400, clock(2019, 3, 10))
+    assert statements == [
+        "ALTER TABLE trends ADD PARTITION (PARTITION p2019_01 VALUES LESS THAN (%d), PARTITION p2019_02 VALUES LESS THAN (%d), PARTITION p2019_03 VALUES LESS THAN (%d))"%(
+            clock(2019, 2, 1), clock(2019, 3, 1), clock(2019, 4, 1)),
+        "ALTER TABLE trends DROP PARTITION p2018_11"], statements
+    try:
+        partitioner([("p0", "MAXVALUE")]).partition_statements("history", "day", 86400, clock(2019, 1, 1))
+        assert False, "error was not raised"
+    except ValueError:
+        pass
+
+def ring_keys():
+    return ["http://site-%d.example.com/"%(number) for number in range(0, 2000)] + [u"http://\u0441\u0430\u0439\u0442.example.com/"]
+
+def check_ring_stable():
+    nodes = ["web-%d"%(number) for number in range(0, 4)]
+    ring, reversed_ring = HashRing(nodes), HashRing(list(reversed(nodes)))
+    assignment = dict((key, ring.get(key)) for key in ring_keys())
+    # Order of nodes does not matter
+    assert assignment == dict((key, reversed_ring.get(key)) for key in ring_keys())
+    counts = dict((node, assignment.values().count(node)) for node in nodes)
+    assert min(counts.values()) > len(assignment) / len(nodes) / 2, counts
+
+def check_ring_remove():
+    nodes = ["web-%d"%(number) for number in range(0, 4)]
+    before, after = HashRing(nodes), HashRing(nodes[:2] + nodes[3:])
+    for key in ring_keys():
+        # Only keys of the removed node move
+        if before.get(key) != "web-2":
+            assert after.get(key) == before.get(key), key
+        else:
+            assert after.get(key) != "web-2", key
+
+def check_ring_add():
+    nodes = ["web-%d"%(number) for number in range(0, 4)]
+    before, after = HashRing(nodes), HashRing(nodes + ["web-4"])
+    moved = 0
+    for key in ring_keys():
+        # Keys move only to the added node
+        if after.get(key) != before.get(key):
+            assert after.get(key) == "web-4", key
+            moved += 1
+    # About a fifth of keys moves, modulo hashing would move four fifths
+    assert 0 < moved < len(ring_keys()) * 0.3, moved
+
+class HostsApi:
+    """Answers host.get by filter of names or ids and records parameters of requests."""
+    def __init__(self, hosts):
+        self.hosts = [{"hostid": str(number), "host": name, "name": name, "status": "0", "parentTemplates": []} for number, name in enumerate(hosts)]
+        self.requests = []
+
+    def do_request(self, method, params):
+        self.requests.append((method, params))
+        field, values = params["filter"].items()[0]
+        return {"result": [host for host in self.hosts if host[field] in values]}
+
+    def batch(self, calls):
+        return [self.do_request(method, params)["result"] for method, params in calls]
+
+def check_resolver_hosts():
+    zapi = HostsApi(["host-%d"%(number) for number in range(0, 1000)] + ["Zabbix server", "web-1"])
+    resolver = Resolver(zapi, names={"host": ["Zabbix server", "web-1", "web-2"]})
+    resolver.prefetch(["host"])
+    assert zapi.requests == [("host.get", {"output": ["hostid", "host", "name", "status"], "selectParentTemplates": ["templateid"],
+        "filter": {"host": ["Zabbix server", "web-1", "web-2"]}})], zapi.requests
+    assert resolver.id("host", "Zabbix server") == "1000" and resolver.get("host", "web-2") is None
+    # Hosts which are not prefetched are loaded by name or id, missing prefetched host is not requested again
+    assert resolver.id("host", "host-7") == "7" and resolver.find("host", 12)["host"] == "host-12"
+    assert resolver.get("host", "web-2") is None and resolver.get("host", "host-7")["hostid"] == "7"
+    assert [params["filter"] for method, params in zapi.requests[1:]] == [{"host": ["host-7"]}, {"hostid": ["12"]}], zapi.requests
+
+def check_lazy_transport():
+    client = ZabbixClient("http://127.0.0.1/", transport="curl")
+    # API objects are still served by ZabbixAPI, transport and pycurl are not loaded until the first request
+    assert client.host.name == "host" and "transport" not in client.__dict__ and "pycurl" not in sys.modules
+    client = ZabbixClient("http://127.0.0.1/", transport="session")
+    assert client.transport is client.transport and client.transport.session is client.session
+    try:
+        ZabbixClient("http://127.0.0.1/", transport="http")
+        assert False, "error was not raised"
+    except ValueError:
+        pass
+
+class ItemsApi:
+    """Answers item.get by keys of items."""
+    def __init__(self, items):
+        self.items = items
+        self.item = self
+
+    def get(self, hostids, output, filter):
+        return [item for item in self.items if item["key_"] in filter["key_"]]
+
+def check_web_migration():
+    app = types.InstanceType(Configurator)
+    app.web_migration = "disable"
+    # Probe escapes quotes of URL in the item key, as Zabbix does when it discovers the item
+    app.zapi = ItemsApi([{"key_": 'web.probe.status["http://quoted.local/?q=\\"a b\\""]', "lastclock": "1500000000"},
+        {"key_": 'web.probe.status["http://waiting.local/"]', "lastclock": "0"}])
+    state = [(None, None, {"quoted": {"httptestid": "1", "status": "0"}, "waiting": {"httptestid": "2", "status": "0"}}, None)]
+    changes = app.web_migration_changes(state, "10084", [{"name": "quoted", "url": 'http://quoted.local/?q="a b"'}, {"name": "waiting", "url": "http://waiting.local/"}])
+    assert [(change.name, change.action, change.params) for change in changes] == [("quoted", "update", {"httptestid": "1", "status": 1})], changes
+
+servers = []
+
+def fake_zabbix(folder, urls=2, users=1, templates=2):
+    """Returns fake Zabbix server with objects of fresh installation and sets environment of configurator which configures it."""
+    if len(servers) == 0:
+        servers.extend(benchmark.start(0))
+    zabbix, server, trapper = servers
+    zabbix.reset()
+    benchmark.environment(server, folder, urls, users, templates)
+    os.environ.update({"ZBX_API_TRANSPORT": "session", "ZBX_DESIRED_STATE_FILE": "", "ZBX_ADMIN_PASSWORD": "zabbix"})
+    return zabbix
+
+def reconcile(dry_run):
+    """Runs plan or apply mode of a new configurator and returns printed lines."""
+    output, sys.stdout = sys.stdout, StringIO.StringIO()
+    try:
+        benchmark.BenchmarkConfigurator().reconcile(dry_run=dry_run)
+        return sys.stdout.getvalue().splitlines()
+    finally:
+        sys.stdout = output
+
+def check_desired_state_plan():
+    folder = tempfile.mkdtemp()
+    try:
+        zabbix = fake_zabbix(folder, urls=1)
+        state = os.path.join(folder, "state.json")
+        with open(state, "w") as f:
+            json.dump({"url_list": [{"name": "watched", "url": "http://watched.local", "priority": 3}]}, f)
+        os.environ["ZBX_DESIRED_STATE_FILE"] = state
+        # Fields of desired state file replace environment, plan mode reads them as watch mode does
+        plan = reconcile(True)
+        assert '+ httptest "watched"' in plan and '+ httptest "url 0"' not in plan, plan
+        assert len([method for method in zabbix.calls if not method.endswith(".get") and method != "user.login"]) == 0, zabbix.calls
+    finally:
+        shutil.rmtree(folder)
+
+def record_calls(zabbix):
+    """Returns list which receives (method, count of objects) of every write call of fake server in order of execution."""
+    calls = []
+    def call(method, params):
+        if not method.endswith(".get"):
+            calls.append((method, len(params) if isinstance(params, list) else 1))
+        return benchmark.FakeZabbix.call(zabbix, method, params)
+    zabbix.call = call
+    return calls
+
+def fresh_plan(folder):
+    return [
+        '+ configuration "template_0.xml" (templates: Template Benchmark 0)',
+        '+ configuration "template_1.xml" (templates: Template Benchmark 1)',
+        '~ mediatype "Email" (smtp_email, smtp_helo, smtp_server)',
+        '+ usergroup "Operation managers"',
+        '+ user "user0"',
+        '~ usergroup "Disabled" (users)',
+        '~ user "admin" (medias)',
+        '~ action "Report problems to Zabbix administrators" (status)',
+        '+ action "Auto registration rules for Linux servers"',
+        '~ host "Zabbix server" (interface)',
+        '~ host "Zabbix server" (status)',
+        '~ host "Zabbix server" (templates: Template OS Linux)',
+        '+ httptest "url 0"',
+        '+ httptest "url 1"',
+        '+ trigger "Health status of url 0"',
+        '+ trigger "Health status of url 1"',
+        '~ file "%s"'%(os.path.join(folder, "custom.json")),
+        '~ config "config" (ok_period)',
+        "Plan: 9 to create, 9 to update, 0 to delete."]
+
+def check_plan():
+    folder = tempfile.mkdtemp()
+    try:
+        zabbix = fake_zabbix(folder)
+        calls = record_calls(zabbix)
+        plan = reconcile(True)
+        assert plan == fresh_plan(folder), plan
+        # Plan mode only reads
+        assert calls == [("user.login", 1)], calls
+    finally:
+        shutil.rmtree(folder)
+
+def check_apply():
+    folder = tempfile.mkdtemp()
+    try:
+        zabbix = fake_zabbix(folder)
+        calls = record_calls(zabbix)
+        assert reconcile(False) == fresh_plan(folder)
+        # Templates are imported before they are linked, user group is created before its user,
+        # consecutive creates of the same method are sent by one array call
+        assert calls == [("user.login", 1), ("configuration.import", 1), ("configuration.import", 1), ("mediatype.update", 1), ("usergroup.create", 1), ("user.create", 1),
+            ("usergroup.update", 1), ("user.updatemedia", 1), ("action.update", 1), ("action.create", 1), ("hostinterface.update", 1), ("host.update", 1),
+            ("host.massadd", 1), ("httptest.create", 2), ("trigger.create", 2)], calls
+        group = next(item for item in zabbix.objects["usergroup"] if item["name"] == "Operation managers")
+        assert {"userid": next(item for item in zabbix.objects["user"] if item["alias"] == "user0")["userid"]} in group["users"], group
+        host = zabbix.objects["host"][0]
+        assert host["status"] == 0 and len(host["templates"]) == 1, host
+        cursor = zabbix.database.cursor()
+        cursor.execute("SELECT ok_period FROM config")
+        assert cursor.fetchall() == [("1d",)]
+        with open(os.path.join(folder, "custom.json")) as f:
+            assert [item["name"] for item in json.load(f)["web"]] == ["url 0", "url 1"]
+        del calls[:]
+        assert reconcile(True) == ["No changes. Zabbix server configuration is up-to-date."]
+        # Removed URL is deleted with its trigger, other objects are up-to-date
+        os.environ["URL_LIST"] = json.dumps(json.loads(os.environ["URL_LIST"])[:1])
+        plan = reconcile(False)
+        assert plan == ['- httptest "url 1"', '~ file "%s"'%(os.path.join(folder, "custom.json")), "Plan: 0 to create, 1 to update, 1 to delete."], plan
+        assert [name for name, count in calls if name != "user.login"] == ["httptest.delete"], calls
+    finally:
+        shutil.rmtree(folder)
+
+def check_step_order():
+    events = []
+    started = dict((name, threading.Event()) for name in ["b", "c"])
+    def step(name, partner=None):
+        def run():
+            events.append(name + " started")
+            if partner is not None:
+                # Steps with the same prerequisites run together, so each one waits for the other
+                started[name].set()
+                assert started[partner].wait(5), "%s was not run together with %s"%(name, partner)
+            events.append(name + " finished")
+        return run
+    executor = StepExecutor(workers=4)
+    executor.add("d", step("d"), ["b", "c"])
+    executor.add("b", step("b", "c"), ["a"])
+    executor.add("c", step("c", "b"), ["a"])
+    executor.add("a", step("a"))
+    errors = executor.run()
+    assert errors == {}, errors
+    assert events[:2] == ["a started", "a finished"] and events[-2:] == ["d started", "d finished"], events
+    assert sorted(events[2:4]) == ["b started", "c started"], events
+
+def check_step_errors():
+    def fail():
+        raise ValueError("broken")
+    ran = []
+    executor = StepExecutor(workers=2)
+    executor.add("broken", fail)
+    executor.add("dependent", lambda: ran.append("dependent"), ["broken"])
+    executor.add("transitive", lambda: ran.append("transitive"), ["dependent"])
+    executor.add("aborted", lambda: sys.exit(1))
+    executor.add("unknown", lambda: ran.append("unknown"), ["missing"])
+    executor.add("independent", lambda: ran.append("independent"))
+    errors = executor.run()
+    assert errors == {"broken": "broken", "dependent": "skipped because of failed step broken", "transitive": "skipped because of failed step dependent",
+        "aborted": "step was aborted", "unknown": "unresolved prerequisites missing"}, errors
+    assert ran == ["independent"], ran
+
+def record_imports(zabbix):
+    """Returns list which receives (kind, names of objects) of every configuration import of fake server in order of execution."""
+    imports = []
+    def call(method, params):
+        if method == "configuration.import":
+            root = ElementTree.fromstring(params["source"].encode("utf-8"))
+            kind = [element.tag for element in root if element.tag != "version"][0]
+            imports.append((kind, [element.text for path in ["./templates/template/template", "./hosts/host/host", "./maps/map/name"] for element in root.findall(path)]))
+        return benchmark.FakeZabbix.call(zabbix, method, params)
+    zabbix.call = call
+    return imports
+
+def check_import_skipped():
+    folder = tempfile.mkdtemp()
+    try:
+        zabbix = fake_zabbix(folder)
+        imports = record_imports(zabbix)
+        assert benchmark.BenchmarkConfigurator().import_configuration() == 1
+        assert imports == [("templates", ["Template Benchmark 0"]), ("templates", ["Template Benchmark 1"])], imports
+        # Fingerprints are kept in config folder, so the next run skips files which were not changed
+        del imports[:]
+        benchmark.BenchmarkConfigurator().import_configuration()
+        assert imports == [], imports
+        with open(os.path.join(folder, "configuration", "template_1.xml"), "a") as f:
+            f.write("\n")
+        benchmark.BenchmarkConfigurator().import_configuration()
+        assert imports == [("templates", ["Template Benchmark 1"])], imports
+        # Template which was deleted on the server is imported again although its file was not changed
+        del imports[:]
+        zabbix.objects["template"] = [item for item in zabbix.objects["template"] if item["host"] != "Template Benchmark 0"]
+        benchmark.BenchmarkConfigurator().import_configuration()
+        assert imports == [("templates", ["Template Benchmark 0"])], imports
+    finally:
+        shutil.rmtree(folder)
+
+def archive_members(folder, name):
+    with tarfile.open(os.path.join(folder, name)) as archive:
+        return sorted(archive.getnames())
+
+def check_backup_restore():
+    folder = tempfile.mkdtemp()
+    backups = os.path.join(folder, "backup")
+    try:
+        zabbix = fake_zabbix(folder, templates=4)
+        os.environ["ZBX_BACKUP_CHUNK_SIZE"] = "1"
+        reconcile(False)
+        templates = sorted(item["host"] for item in zabbix.objects["template"])
+        app = benchmark.BenchmarkConfigurator()
+        app.backup(backups)
+        first = json.load(open(os.path.join(backups, "manifest.json")))
+        buckets = sorted(member["name"] for member in first["members"])
+        assert archive_members(backups, first["archive"]) == sorted(buckets + ["manifest.json"]), buckets
+        assert len([name for name in buckets if name.startswith("templates-")]) > 1 and "hosts-000.xml" in buckets and "maps-000.xml" in buckets, buckets
+        # Archive names have resolution of seconds
+        time.sleep(1.1)
+        zabbix.objects["host"][0]["status"] = "1"
+        app.backup(backups)
+        second = json.load(open(os.path.join(backups, "manifest.json")))
+        assert second["archive"] != first["archive"]
+        # Only the bucket of the changed host is written, other buckets refer to the first archive
+        assert archive_members(backups, second["archive"]) == ["hosts-000.xml", "manifest.json"], archive_members(backups, second["archive"])
+        assert dict((member["name"], member["archive"]) for member in second["members"]) == \
+            dict((name, second["archive"] if name == "hosts-000.xml" else first["archive"]) for name in buckets), second["members"]
+        zabbix.reset()
+        imports = record_imports(zabbix)
+        app.restore(os.path.join(backups, second["archive"]))
+        # Templates are imported before hosts which link them, and hosts before maps which show them
+        kinds = [kind for kind, names in imports]
+        assert kinds == ["templates"] * (len(kinds) - 2) + ["hosts", "maps"], imports
+        assert sorted(sum([names for kind, names in imports if kind == "templates"], [])) == templates, imports
+        assert ("maps", ["Local network"]) in imports, imports
+    finally:
+        del os.environ["ZBX_BACKUP_CHUNK_SIZE"]
+        shutil.rmtree(folder)
+
+def write_later(delay, path, data):
+    """Replaces file by rename after delay seconds, as editors and deployment tools do."""
+    def write():
+        time.sleep(delay)
+        with open(path + ".tmp", "w") as f:
+            f.write(data)
+        os.rename(path + ".tmp", path)
+    thread = threading.Thread(target=write)
+    thread.start()
+    return thread
+
+class FailingLibc:
+    def inotify_init(self):
+        configurator.ctypes.set_errno(24)
+        return -1
+
+def watch_once(polling):
+    """Drives one burst of changes through the watch loop and returns arguments of the run it started."""
+    folder = tempfile.mkdtemp()
+    try:
+        configuration, state = os.path.join(folder, "configuration"), os.path.join(folder, "state.json")
+        os.mkdir(configuration)
+        with open(state, "w") as f:
+            json.dump({"url_list": []}, f)
+        app = types.InstanceType(Configurator)
+        app.configuration_folder, app.desired_state_file, app.desired_state_fields = configuration, state, {"url_list": []}
+        app.web_check_mode, app.watch_debounce = "list", 0.5
+        runs = []
+        app.watch_run = lambda status, names, changes: runs.append((names, changes))
+        targets = {"configuration": configuration, "desired state": state}
+        if polling:
+            # inotify_init fails as when fs.inotify.max_user_instances is reached
+            cdll, configurator.ctypes.CDLL = configurator.ctypes.CDLL, lambda name, use_errno: FailingLibc()
+            try:
+                watcher = Watcher(targets, poll_interval=0.1)
+            finally:
+                configurator.ctypes.CDLL = cdll
+            assert watcher.fd is None
+        else:
+            watcher = Watcher(targets, poll_interval=0.1)
+            assert watcher.fd is not None, "inotify is not available"
+        # The second edit comes within debounce period, both are applied by one run
+        threads = [write_later(0.2, state, json.dumps({"url_list": ["http://example.com/"]})),
+            write_later(0.4, os.path.join(configuration, "template.xml"), "<zabbix_export/>")]
+        signal.alarm(10)
+        try:
+            app.watch_changes(watcher, {})
+        finally:
+            signal.alarm(0)
+            for thread in threads:
+                thread.join()
+        assert app.url_list == ["http://example.com/"], app.url_list
+        return runs
+    finally:
+        shutil.rmtree(folder)
+
+def check_watch(polling):
+    runs = watch_once(polling)
+    assert runs == [(set(["web", "web_cleanup", "custom_config", "templates", "assign_templates"]), ["configuration", "desired state"])], runs
+
+check("Parsing retention periods", check_parse_period)
+check("Splitting time into partitions", check_ranges)
+check("Partitioning table", check_initial)
+check("Dropping expired partitions", check_retention)
+check("Keeping the last partition", check_last_partition)
+check("Assigning keys to nodes", check_ring_stable)
+check("Removing node from ring", check_ring_remove)
+check("Adding node to ring", check_ring_add)
+check("Loading only hosts which are looked up", check_resolver_hosts)
+check("Creating API transport on first use", check_lazy_transport)
+check("Retiring web scenarios of probed URLs", check_web_migration)
+check("Planning changes of fresh server", check_plan)
+check("Applying changes in order", check_apply)
+check("Planning changes of desired state file", check_desired_state_plan)
+check("Running steps in order of prerequisites", check_step_order)
+check("Reporting failed and skipped steps", check_step_errors)
+check("Skipping import of unchanged configuration", check_import_skipped)
+check("Restoring incremental backup", check_backup_restore)
+check("Applying changes noticed by inotify", lambda: check_watch(False))
+check("Applying changes noticed by polling", lambda: check_watch(True))
+sys.exit(exit_code)
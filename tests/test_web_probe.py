@@ -0,0 +1,218 @@
+#!/usr/bin/python
+
+import BaseHTTPServer, json, os, shutil, socket, SocketServer, struct, subprocess, sys, tempfile, threading, time
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "zabbix_web.py")
+client = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "zabbix_web_client.py")
+
+class WebHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.connections.add(self.client_address)
+        if self.path == "/redirect":
+            self.send_response(302)
+            self.send_header("Location", "/ok")
+            body = ""
+        elif self.path == "/ok":
+            self.send_response(200)
+            body = "OK"
+        else:
+            self.send_response(500)
+            body = "Error"
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TrapperHandler(SocketServer.BaseRequestHandler):
+    """Stand-in for Zabbix server trapper, stores received sender requests."""
+    def handle(self):
+        header = self.request.recv(13, socket.MSG_WAITALL)
+        length = struct.unpack("<Q", header[5:])[0]
+        payload = ""
+        while len(payload) < length:
+            payload += self.request.recv(length - len(payload))
+        data = json.loads(payload)["data"]
+        self.server.requests.append(json.loads(payload))
+        # Values of hosts which do not exist are failed like by Zabbix server
+        failed = len([item for item in data if item["host"] not in self.server.hosts])
+        response = json.dumps({"response": "success", "info": "processed: %d; failed: %d; total: %d; seconds spent: 0.000100"%(len(data) - failed, failed, len(data))})
+        self.request.sendall("ZBXD\x01" + struct.pack("<Q", len(response)) + response)
+
+def start(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+web = start(SocketServer.ThreadingTCPServer(("127.0.0.1", 0), WebHandler))
+web.connections = set()
+trapper = start(SocketServer.TCPServer(("127.0.0.1", 0), TrapperHandler))
+trapper.requests = []
+trapper.hosts = set(["web-host"])
+
+base_url = "http://127.0.0.1:%d"%(web.server_address[1])
+config = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+json.dump({"web": [
+    {"name": "ok", "url": base_url + "/ok", "priority": 1},
+    {"name": "redirect", "url": base_url + "/redirect", "priority": 1},
+    {"name": "error", "url": base_url + "/error", "priority": 2},
+    {"name": "closed", "url": "http://127.0.0.1:1/", "priority": 2}
+]}, config)
+config.close()
+
+exit_code = 0
+print "Running probe mode -",
+index_folder = tempfile.mkdtemp()
+code = subprocess.call([sys.executable, script, "probe", "--config", config.name, "--index-folder", index_folder, "--server", "127.0.0.1", "--port", str(trapper.server_address[1]), "--host", "web-host", "--host-concurrency", "1"])
+print "SUCCESS." if code == 0 else "FAILED (exit code %d)."%(code)
+exit_code = exit_code or code
+
+print "Checking results are sent in one request -",
+try:
+    assert len(trapper.requests) == 1
+    assert trapper.requests[0]["request"] == "sender data"
+    print "SUCCESS."
+except AssertionError:
+    print "FAILED (%d requests)."%(len(trapper.requests))
+    exit_code = 1
+
+print "Checking status codes -",
+values = dict((item["key"], item["value"]) for request in trapper.requests for item in request["data"])
+try:
+    assert all(item["host"] == "web-host" for request in trapper.requests for item in request["data"])
+    assert values['web.probe.status["%s/ok"]'%(base_url)] == "200"
+    assert values['web.probe.status["%s/redirect"]'%(base_url)] == "200"
+    assert values['web.probe.status["%s/error"]'%(base_url)] == "500"
+    assert values['web.probe.status["http://127.0.0.1:1/"]'] == "0"
+    print "SUCCESS."
+except (AssertionError, KeyError):
+    print "FAILED (%s)."%(values)
+    exit_code = 1
+
+print "Checking timings -",
+try:
+    for path in ["/ok", "/redirect", "/error"]:
+        assert 0 <= float(values['web.probe.ttfb["%s%s"]'%(base_url, path)]) <= float(values['web.probe.time["%s%s"]'%(base_url, path)])
+    assert 'web.probe.time["http://127.0.0.1:1/"]' not in values
+    print "SUCCESS."
+except (AssertionError, KeyError):
+    print "FAILED (%s)."%(values)
+    exit_code = 1
+
+print "Checking connection is reused for the same host -",
+try:
+    assert len(web.connections) == 1
+    print "SUCCESS."
+except AssertionError:
+    print "FAILED (%d connections)."%(len(web.connections))
+    exit_code = 1
+
+print "Checking values of unknown host fail the probe -",
+code = subprocess.call([sys.executable, script, "probe", "--config", config.name, "--index-folder", index_folder, "--server", "127.0.0.1", "--port", str(trapper.server_address[1]), "--host", "unknown-host"])
+if code == 1:
+    print "SUCCESS."
+else:
+    print "FAILED (exit code %d)."%(code)
+    exit_code = 1
+
+print "Checking index of url list is saved into index folder -",
+if len(os.listdir(index_folder)) == 1 and not os.path.exists(config.name + ".index"):
+    print "SUCCESS."
+else:
+    print "FAILED (%s)."%(os.listdir(index_folder))
+    exit_code = 1
+
+print "Discovering urls without priority -",
+plain = tempfile.NamedTemporaryFile(suffix=".json", delete=False)
+json.dump({"web": [{"name": "plain", "url": "https://plain.local/"}, {"name": "urgent", "url": "https://urgent.local/", "priority": 5}]}, plain)
+plain.close()
+try:
+    output = subprocess.check_output([sys.executable, script, "discovery", "--config", plain.name, "--index-folder", index_folder, "--priority", "1"])
+    assert [item["{#DESCRIPTION}"] for item in json.loads(output)["data"]] == ["plain"], output
+    print "SUCCESS."
+except (AssertionError, ValueError, subprocess.CalledProcessError) as e:
+    print "FAILED (%s)."%(e)
+    exit_code = 1
+
+def write_urls(path, names):
+    """Replaces url list by rename, as configurator does."""
+    with open(path + ".tmp", "w") as f:
+        f.write(json.dumps({"web": [{"name": name, "url": "http://%s.local/"%(name), "priority": 1} for name in names]}) if names is not None else "{broken")
+    os.rename(path + ".tmp", path)
+
+def query(sock, *args):
+    environment = dict(os.environ, ZBX_WEB_SOCKET=sock)
+    return json.loads(subprocess.check_output([sys.executable, client] + list(args), env=environment))
+
+def names(response):
+    return [item["{#DESCRIPTION}"] for item in response["data"]]
+
+serve_folder = tempfile.mkdtemp()
+serve_config, sock = os.path.join(serve_folder, "url_list.json"), os.path.join(serve_folder, "web.sock")
+write_urls(serve_config, ["first"])
+with open(os.path.join(serve_folder, "stderr"), "w") as stderr:
+    daemon = subprocess.Popen([sys.executable, script, "serve", "--config", serve_config, "--index-folder", serve_folder, "--socket", sock], stderr=stderr)
+try:
+    for i in range(0, 100):
+        if os.path.exists(sock):
+            break
+        time.sleep(0.05)
+
+    print "Answering discovery query over socket -",
+    try:
+        assert names(query(sock, "discovery", "--priority", "1")) == ["first"]
+        assert names(query(sock, "discovery", "--priority", "2")) == []
+        print "SUCCESS."
+    except (AssertionError, KeyError, ValueError, subprocess.CalledProcessError) as e:
+        print "FAILED (%s)."%(e)
+        exit_code = 1
+
+    print "Reloading url list after config is changed -",
+    try:
+        write_urls(serve_config, ["first", "second"])
+        assert names(query(sock, "discovery", "--priority", "1")) == ["first", "second"]
+        # Broken config is reported as error, the next valid config is loaded again
+        write_urls(serve_config, None)
+        assert "error" in query(sock, "discovery")
+        write_urls(serve_config, ["third"])
+        assert names(query(sock, "discovery")) == ["third"]
+        print "SUCCESS."
+    except (AssertionError, KeyError, ValueError, subprocess.CalledProcessError) as e:
+        print "FAILED (%s)."%(e)
+        exit_code = 1
+
+    print "Answering invalid query by JSON error -",
+    try:
+        response = query(sock, "discovery", "--priority", "high")
+        assert "error" in response and "data" not in response, response
+        assert "error" in query(sock, "--help")
+        assert names(query(sock, "discovery")) == ["third"]
+        with open(os.path.join(serve_folder, "stderr")) as f:
+            assert "usage:" not in f.read()
+        print "SUCCESS."
+    except (AssertionError, KeyError, ValueError, subprocess.CalledProcessError) as e:
+        print "FAILED (%s)."%(e)
+        exit_code = 1
+
+    print "Running script when daemon is not available -",
+    try:
+        assert names(query(os.path.join(serve_folder, "missing.sock"), "discovery", "--config", serve_config, "--index-folder", serve_folder)) == ["third"]
+        print "SUCCESS."
+    except (AssertionError, KeyError, ValueError, subprocess.CalledProcessError) as e:
+        print "FAILED (%s)."%(e)
+        exit_code = 1
+finally:
+    daemon.terminate()
+    daemon.wait()
+
+os.unlink(config.name)
+os.unlink(plain.name)
+shutil.rmtree(index_folder)
+shutil.rmtree(serve_folder)
+web.shutdown()
+trapper.shutdown()
+sys.exit(exit_code)
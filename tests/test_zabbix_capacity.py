@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+import os, sqlite3, sys, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from zabbix_capacity import GB, MB, LIMITS, format_size, gather, memory_total, parse_delay, parse_size, recommend, render_env
+
+SCHEMA = """
+CREATE TABLE hosts (hostid INTEGER PRIMARY KEY, host TEXT, status INTEGER, flags INTEGER);
+CREATE TABLE items (itemid INTEGER PRIMARY KEY, hostid INTEGER, type INTEGER, delay TEXT, status INTEGER, flags INTEGER, master_itemid INTEGER);
+CREATE TABLE triggers (triggerid INTEGER PRIMARY KEY, status INTEGER, flags INTEGER);
+CREATE TABLE functions (functionid INTEGER PRIMARY KEY, itemid INTEGER, triggerid INTEGER);
+CREATE TABLE httptest (httptestid INTEGER PRIMARY KEY, hostid INTEGER, delay TEXT, status INTEGER);
+"""
+
+def schema(hosts=0, items_per_host=0, delay="1m", triggers_per_host=0, httptests_per_host=0, dependent_per_host=0):
+    """Returns in-memory database with monitored hosts, a disabled host and a template whose objects must not be counted."""
+    db = sqlite3.connect(":memory:")
+    db.executescript(SCHEMA)
+    ids = {"item": 0, "trigger": 0, "function": 0, "httptest": 0}
+    def add(table, kind, row):
+        ids[kind] += 1
+        db.execute("INSERT INTO %s VALUES (%s)"%(table, ",".join(["?"] * (len(row) + 1))), [ids[kind]] + row)
+        return ids[kind]
+    hostids = range(1, hosts + 1)
+    for hostid in hostids:
+        db.execute("INSERT INTO hosts VALUES (?, ?, 0, 0)", [hostid, "host%d"%(hostid)])
+    db.execute("INSERT INTO hosts VALUES (1000, 'disabled', 1, 0)")
+    db.execute("INSERT INTO hosts VALUES (1001, 'Template OS Linux', 3, 0)")
+    for hostid in hostids + [1000, 1001]:
+        itemids = [add("items", "item", [hostid, 0, delay, 0, 0, None]) for i in range(0, items_per_host)]
+        # Disabled item, trapper, item prototype and discovery rule
+        add("items", "item", [hostid, 0, delay, 1, 0, None])
+        trapper = add("items", "item", [hostid, 2, "0", 0, 0, None])
+        add("items", "item", [hostid, 0, delay, 0, 2, None])
+        add("items", "item", [hostid, 0, "1h", 0, 1, None])
+        # Dependent items of the first item, half of them depend on another dependent item, and a dependent item of trapper
+        for i in range(0, dependent_per_host):
+            add("items", "item", [hostid, 18, "0", 0, 0, itemids[0] if i % 2 == 0 or i == 1 else ids["item"]])
+        if dependent_per_host > 0:
+            add("items", "item", [hostid, 18, "0", 0, 0, trapper])
+        for i in range(0, triggers_per_host):
+            triggerid = add("triggers", "trigger", [0, 0])
+            add("functions", "function", [itemids[i % len(itemids)], triggerid])
+        for i in range(0, httptests_per_host):
+            add("httptest", "httptest", [hostid, "5m", 0])
+        add("httptest", "httptest", [hostid, "1m", 1])
+    db.commit()
+    return db
+
+exit_code = 0
+
+def check(title, function):
+    global exit_code
+    print "%s -"%(title),
+    try:
+        function()
+        print "SUCCESS."
+    except (AssertionError, KeyError, ValueError) as e:
+        print "FAILED (%s)."%(e)
+        exit_code = 1
+
+def check_parsing():
+    assert parse_delay("30") == 30 and parse_delay(30) == 30
+    assert parse_delay("1m") == 60 and parse_delay("2h") == 7200
+    assert parse_delay("5m;10s/1-5,09:00-18:00") == 300
+    assert parse_delay("{$INTERVAL}") == 60 and parse_delay("0;wd1-5h9") == 60
+    assert parse_size("512M") == 512 * MB and parse_size("16g") == 16 * GB and parse_size("1024") == 1024
+    assert format_size(512 * MB) == "512M" and format_size(2 * GB) == "2G" and format_size(MB + 1) == "2M"
+    try:
+        parse_size("lots")
+        assert False, "error was not raised"
+    except ValueError:
+        pass
+
+def check_memory():
+    path = tempfile.mktemp()
+    with open(path, "w") as f:
+        f.write("MemTotal:       16318412 kB\nMemFree:         1234 kB\n")
+    try:
+        assert memory_total(path) == 16318412 * 1024
+    finally:
+        os.remove(path)
+
+def check_gather():
+    counts = gather(schema(hosts=10, items_per_host=30, delay="30s", triggers_per_host=5, httptests_per_host=2))
+    assert counts["hosts"] == 10, counts
+    # Trapper items are in configuration cache, but they are not polled
+    assert counts["items"] == 10 * 31, counts
+    assert counts["lld_rules"] == 10, counts
+    assert counts["triggers"] == 10 * 5 and counts["trigger_items"] == 10 * 5, counts
+    assert counts["httptests"] == 10 * 2, counts
+    assert abs(counts["nvps"] - 10.0) < 0.001 and abs(counts["polled_nvps"] - 10.0) < 0.001, counts
+    assert abs(counts["http_rate"] - 20 / 300.0) < 0.001, counts
+
+def check_dependent():
+    counts = gather(schema(hosts=10, items_per_host=30, delay="30s", dependent_per_host=6))
+    # Dependent items of agent item write values at its rate, dependent item of trapper has no interval
+    assert counts["items"] == 10 * 38, counts
+    assert abs(counts["nvps"] - 10 * 36 / 30.0) < 0.001, counts
+    assert abs(counts["polled_nvps"] - 10.0) < 0.001, counts
+
+def check_empty():
+    counts = gather(schema())
+    assert counts["hosts"] == 0 and counts["items"] == 0 and counts["nvps"] == 0, counts
+    settings, warnings = recommend(counts, 2, 4 * GB)
+    # Zabbix defaults are the lower bounds
+    for name in ["CacheSize", "HistoryCacheSize", "HistoryIndexCacheSize", "ValueCacheSize", "StartPollers", "StartHTTPPollers", "innodb_log_file_size"]:
+        assert settings[name] == LIMITS[name][0], (name, settings[name])
+    assert warnings == [], warnings
+
+def check_scaling():
+    small = recommend(gather(schema(hosts=10, items_per_host=50, triggers_per_host=20, httptests_per_host=1)), 8, 32 * GB)[0]
+    large = recommend(gather(schema(hosts=400, items_per_host=500, delay="30s", triggers_per_host=200, httptests_per_host=5)), 8, 32 * GB)[0]
+    for name in ["CacheSize", "HistoryCacheSize", "HistoryIndexCacheSize", "ValueCacheSize", "StartPollers", "StartHTTPPollers", "innodb_log_file_size"]:
+        assert large[name] > small[name], (name, small[name], large[name])
+    # 200000 items with 30s delay are 6667 values per second, 134 pollers and 200 with headroom
+    assert large["StartPollers"] == 200, large["StartPollers"]
+    for name, value in large.items():
+        assert LIMITS[name][0] <= value <= LIMITS[name][1], (name, value)
+
+def check_cpu_limit():
+    counts = gather(schema(hosts=100, items_per_host=500, delay="10s"))
+    settings, warnings = recommend(counts, 2, 32 * GB)
+    assert settings["StartPollers"] == 100, settings["StartPollers"]
+    assert len(warnings) == 1 and "StartPollers" in warnings[0], warnings
+
+def check_buffer_pool():
+    counts = gather(schema(hosts=10, items_per_host=50))
+    settings = recommend(counts, 4, 16 * GB, database_size=GB)[0]
+    assert settings["innodb_buffer_pool_size"] == 1536 * MB, format_size(settings["innodb_buffer_pool_size"])
+    settings = recommend(counts, 4, 16 * GB)[0]
+    caches = sum([settings[name] for name in ["CacheSize", "HistoryCacheSize", "HistoryIndexCacheSize", "ValueCacheSize"]])
+    assert settings["innodb_buffer_pool_size"] + caches <= 16 * GB * 0.6, format_size(settings["innodb_buffer_pool_size"])
+    assert settings["innodb_buffer_pool_size"] % (128 * MB) == 0
+    settings, warnings = recommend(counts, 4, 256 * MB, database_size=10 * GB)
+    assert settings["innodb_buffer_pool_size"] == 128 * MB and len(warnings) == 1, warnings
+
+def check_overlay():
+    counts = gather(schema(hosts=10, items_per_host=50))
+    overlay = render_env(recommend(counts, 4, 16 * GB)[0], counts, 4, 16 * GB)
+    lines = [line for line in overlay.splitlines() if not line.startswith("#")]
+    variables = dict(line.split("=", 1) for line in lines)
+    assert sorted(variables.keys()) == ["INNODB_BUFFER_POOL_SIZE", "INNODB_LOG_FILE_SIZE", "ZBX_CACHESIZE", "ZBX_HISTORYCACHESIZE",
+        "ZBX_HISTORYINDEXCACHESIZE", "ZBX_STARTHTTPPOLLERS", "ZBX_STARTPOLLERS", "ZBX_VALUECACHESIZE"], variables
+    assert variables["ZBX_CACHESIZE"] == "8M" and variables["ZBX_STARTPOLLERS"] == "5", variables
+    assert "Hosts: 10, items: 510" in overlay
+
+check("Parsing delays and sizes", check_parsing)
+check("Reading total memory", check_memory)
+check("Counting enabled objects of monitored hosts", check_gather)
+check("Counting dependent items at interval of master", check_dependent)
+check("Recommending defaults for empty server", check_empty)
+check("Scaling settings with count of objects", check_scaling)
+check("Limiting pollers by CPUs", check_cpu_limit)
+check("Fitting buffer pool into memory", check_buffer_pool)
+check("Rendering env overlay", check_overlay)
+sys.exit(exit_code)
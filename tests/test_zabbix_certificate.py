@@ -0,0 +1,69 @@
+#!/usr/bin/python
+
+import calendar, os, shutil, subprocess, sys, tempfile, time
+
+scripts = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts")
+sys.path.insert(0, scripts)
+# Script parses its arguments when it is imported
+sys.argv = [os.path.join(scripts, "zabbix_certificate.py"), "check"]
+from zabbix_certificate import certificate_end_time, der_elements
+
+folder = tempfile.mkdtemp()
+
+def openssl(*args):
+    with open(os.devnull, "w") as devnull:
+        return subprocess.check_output(["openssl"] + list(args), stderr=devnull)
+
+def certificate(name, days, version=3):
+    """Returns DER of a self-signed certificate and its notAfter reported by openssl, version 1 certificates have no version field."""
+    key, pem = os.path.join(folder, name + ".key"), os.path.join(folder, name + ".pem")
+    if version == 3:
+        openssl("req", "-x509", "-newkey", "rsa:1024", "-nodes", "-keyout", key, "-out", pem, "-days", str(days), "-subj", "/CN=%s"%(name))
+    else:
+        request = os.path.join(folder, name + ".csr")
+        openssl("req", "-new", "-newkey", "rsa:1024", "-nodes", "-keyout", key, "-out", request, "-subj", "/CN=%s"%(name))
+        openssl("x509", "-req", "-in", request, "-signkey", key, "-days", str(days), "-out", pem)
+    der = openssl("x509", "-in", pem, "-outform", "DER")
+    end_date = openssl("x509", "-in", pem, "-noout", "-enddate").strip().split("=", 1)[1]
+    return der, calendar.timegm(time.strptime(end_date, "%b %d %H:%M:%S %Y GMT"))
+
+exit_code = 0
+
+def check(title, function):
+    global exit_code
+    print "%s -"%(title),
+    try:
+        function()
+        print "SUCCESS."
+    except (AssertionError, IndexError, ValueError, subprocess.CalledProcessError) as e:
+        print "FAILED (%s)."%(e)
+        exit_code = 1
+
+def check_lengths():
+    # Short form, one and two bytes of long form
+    data = "\x04\x02ab" + "\x04\x81\x80" + "c" * 128 + "\x04\x82\x01\x00" + "d" * 256
+    assert der_elements(data, 0, len(data)) == [(4, 2, 4), (4, 7, 135), (4, 139, 395)], der_elements(data, 0, len(data))
+
+def check_utc_time():
+    der, expected = certificate("utc", 30)
+    # Dates before 2050 are encoded as UTCTime
+    assert "\x18\x0f" not in der and time.gmtime(expected).tm_year < 2050
+    assert certificate_end_time(der) == expected, (certificate_end_time(der), expected)
+
+def check_generalized_time():
+    der, expected = certificate("generalized", 10000)
+    assert "\x18\x0f" in der and time.gmtime(expected).tm_year >= 2050
+    assert certificate_end_time(der) == expected, (certificate_end_time(der), expected)
+
+def check_version_1():
+    der, expected = certificate("v1", 30, version=1)
+    assert certificate_end_time(der) == expected, (certificate_end_time(der), expected)
+
+try:
+    check("Parsing DER lengths", check_lengths)
+    check("Reading UTCTime notAfter", check_utc_time)
+    check("Reading GeneralizedTime notAfter", check_generalized_time)
+    check("Reading notAfter of certificate without version", check_version_1)
+finally:
+    shutil.rmtree(folder)
+sys.exit(exit_code)
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+
+import BaseHTTPServer, json, os, shutil, SocketServer, subprocess, sys, tempfile, threading
+
+script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "zabbix_docker.py")
+
+WEB_ID = "a" * 64
+DB_ID = "b" * 64
+STOPPED_ID = "c" * 64
+CONTAINERS = [
+    {"Id": WEB_ID, "Names": ["/web"], "State": "running"},
+    {"Id": DB_ID, "Names": ["/db"], "State": "running"},
+    {"Id": STOPPED_ID, "Names": ["/stopped"], "State": "exited"}
+]
+
+class DockerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Stand-in for Docker API, it answers only requests used by the collector."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith("/containers/json"):
+            body = [item for item in CONTAINERS if "all=1" in self.path or item["State"] == "running"]
+        elif self.path.startswith("/containers/"):
+            item = [item for item in CONTAINERS if item["Id"] == self.path.split("/")[2]][0]
+            body = {
+                "Id": item["Id"],
+                "Created": "2019-01-01T00:00:00.000000000Z",
+                "RestartCount": 2 if item["Id"] == DB_ID else 0,
+                "State": {"Running": item["State"] == "running", "StartedAt": "2019-01-02T00:00:00.000000000Z"}
+            }
+        elif self.path.startswith("/images/json"):
+            body = [{"Id": "sha256:1"}]
+        elif self.path.startswith("/volumes"):
+            body = {"Volumes": [{"Name": "v1"}, {"Name": "v2"}], "Warnings": None}
+        else:
+            body = {"message": "page not found"}
+        data = json.dumps(body)
+        self.send_response(200 if "message" not in body else 404)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+def write(path, content):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, "w") as f:
+        f.write(content)
+
+def cgroup_v1(root):
+    write(os.path.join(root, "cpuacct", "docker", WEB_ID, "cpuacct.stat"), "user 150\nsystem 50\n")
+    write(os.path.join(root, "memory", "docker", WEB_ID, "memory.stat"), "cache 1\nrss 2\ntotal_cache 4096\ntotal_rss 8192\n")
+    # Nested cgroups of container have to be skipped
+    write(os.path.join(root, "memory", "docker", WEB_ID, "child", "memory.stat"), "total_rss 1\n")
+    write(os.path.join(root, "cpuacct", "system.slice", "docker-%s.scope"%(DB_ID), "cpuacct.stat"), "user 10\nsystem 5\n")
+    write(os.path.join(root, "memory", "system.slice", "docker-%s.scope"%(DB_ID), "memory.stat"), "total_cache 100\ntotal_rss 200\n")
+
+def cgroup_v2(root):
+    write(os.path.join(root, "cgroup.controllers"), "cpu memory\n")
+    write(os.path.join(root, "system.slice", "docker-%s.scope"%(WEB_ID), "cpu.stat"), "usage_usec 2000000\nuser_usec 1500000\nsystem_usec 500000\n")
+    write(os.path.join(root, "system.slice", "docker-%s.scope"%(WEB_ID), "memory.stat"), "anon 8192\nfile 4096\n")
+    write(os.path.join(root, "docker", DB_ID, "cpu.stat"), "usage_usec 150000\nuser_usec 100000\nsystem_usec 50000\n")
+    write(os.path.join(root, "docker", DB_ID, "memory.stat"), "anon 200\nfile 100\n")
+
+folder = tempfile.mkdtemp()
+docker = SocketServer.ThreadingUnixStreamServer(os.path.join(folder, "docker.sock"), DockerHandler)
+docker.daemon_threads = True
+docker.requests = []
+docker.connections = 0
+thread = threading.Thread(target=docker.serve_forever)
+thread.daemon = True
+thread.start()
+
+def run(command, cgroup_root):
+    output = subprocess.check_output([sys.executable, script, command, "--socket", os.path.join(folder, "docker.sock"), "--cgroup-root", cgroup_root])
+    return json.loads(output)
+
+exit_code = 0
+
+def check(title, function):
+    global exit_code
+    print "%s -"%(title),
+    try:
+        function()
+        print "SUCCESS."
+    except (AssertionError, KeyError, subprocess.CalledProcessError, ValueError) as e:
+        print "FAILED (%s)."%(e)
+        exit_code = 1
+
+def check_discovery():
+    result = run("discovery", folder)
+    assert result["data"] == [
+        {"{#FCONTAINERID}": WEB_ID, "{#SCONTAINERID}": WEB_ID[:12], "{#HCONTAINERID}": "web"},
+        {"{#FCONTAINERID}": DB_ID, "{#SCONTAINERID}": DB_ID[:12], "{#HCONTAINERID}": "db"}
+    ], result
+
+def check_v1():
+    root = os.path.join(folder, "v1")
+    cgroup_v1(root)
+    result = run("stats", root)
+    containers = result["containers"]
+    assert containers["web"]["cpu"] == {"user": 150, "system": 50, "total": 200}, containers["web"]
+    assert containers["web"]["mem"] == {"total_rss": 8192, "total_cache": 4096}, containers["web"]
+    assert containers["db"]["cpu"]["total"] == 15 and containers["db"]["mem"]["total_rss"] == 200, containers["db"]
+    assert containers["db"]["inspect"]["RestartCount"] == 2
+    assert containers["web"]["inspect"]["State"]["StartedAt"] == "2019-01-02T00:00:00.000000000Z"
+    assert containers["web"]["up"] == 1 and containers["stopped"]["up"] == 0
+    assert "cpu" not in containers["stopped"]
+    assert result["images"]["dangling"] == 1 and result["volumes"]["dangling"] == 2, result
+
+def check_v2():
+    root = os.path.join(folder, "v2")
+    cgroup_v2(root)
+    containers = run("stats", root)["containers"]
+    assert containers["web"]["cpu"] == {"user": 150.0, "system": 50.0, "total": 200.0}, containers["web"]
+    assert containers["web"]["mem"] == {"total_rss": 8192, "total_cache": 4096}, containers["web"]
+    assert containers["db"]["cpu"]["total"] == 15.0 and containers["db"]["mem"]["total_cache"] == 100, containers["db"]
+
+def check_connection():
+    docker.connections = 0
+    run("stats", folder)
+    assert docker.connections == 1, "%d connections"%(docker.connections)
+
+check("Discovering running containers", check_discovery)
+check("Collecting metrics from cgroup v1", check_v1)
+check("Collecting metrics from cgroup v2", check_v2)
+check("Using one Docker API connection", check_connection)
+
+docker.shutdown()
+docker.server_close()
+shutil.rmtree(folder)
+sys.exit(exit_code)
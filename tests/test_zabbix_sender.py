@@ -0,0 +1,126 @@
+#!/usr/bin/python
+
+import json, os, socket, SocketServer, struct, sys, threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+from zabbix_sender import Sender, SenderError, item_key, parse_info, value
+
+class TrapperHandler(SocketServer.BaseRequestHandler):
+    """Stand-in for Zabbix trapper, it answers requests until client or keep_alive setting closes the connection."""
+    def handle(self):
+        self.server.connections += 1
+        while True:
+            header = self.request.recv(13, socket.MSG_WAITALL)
+            if len(header) < 13:
+                break
+            length = struct.unpack("<Q", header[5:])[0]
+            request = json.loads(self.request.recv(length, socket.MSG_WAITALL))
+            self.server.requests.append(request)
+            failed = len([item for item in request["data"] if item["key"].startswith("missing")])
+            response = json.dumps({"response": self.server.response, "info": "processed: %d; failed: %d; total: %d; seconds spent: 0.000100"%(len(request["data"]) - failed, failed, len(request["data"]))})
+            self.request.sendall("ZBXD\x01" + struct.pack("<Q", len(response)) + response)
+            if not self.server.keep_alive:
+                break
+
+def trapper(keep_alive=True, response="success"):
+    server = SocketServer.ThreadingTCPServer(("127.0.0.1", 0), TrapperHandler)
+    server.daemon_threads = True
+    server.connections = 0
+    server.requests = []
+    server.keep_alive = keep_alive
+    server.response = response
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+exit_code = 0
+
+def check(title, function):
+    global exit_code
+    print "%s -"%(title),
+    try:
+        function()
+        print "SUCCESS."
+    except (AssertionError, SenderError) as e:
+        print "FAILED (%s)."%(e)
+        exit_code = 1
+
+def check_parse_info():
+    assert parse_info("processed: 3; failed: 1; total: 4; seconds spent: 0.000055") == {"processed": 3, "failed": 1, "total": 4, "seconds": 0.000055}
+    try:
+        parse_info("unexpected")
+        assert False, "error was not raised"
+    except SenderError:
+        pass
+
+def check_item_key():
+    assert item_key("web.probe.status", "http://host.local/") == 'web.probe.status["http://host.local/"]'
+    assert item_key("web.probe.status", 'http://host.local/?q="a,b"') == 'web.probe.status["http://host.local/?q=\\"a,b\\""]'
+    assert item_key("net.tcp.service", "http", "host.local") == 'net.tcp.service["http","host.local"]'
+
+def check_chunks():
+    server = trapper()
+    sender = Sender("127.0.0.1", server.server_address[1], chunk_size=2, connections=1)
+    summary = sender.send([value("host", "key%d"%(i), i, 1500000000) for i in range(0, 5)])
+    sender.close()
+    server.shutdown()
+    assert [len(request["data"]) for request in server.requests] == [2, 2, 1], server.requests
+    assert server.requests[0]["data"][0] == {"host": "host", "key": "key0", "value": "0", "clock": 1500000000}
+    assert summary["processed"] == 5 and summary["total"] == 5 and summary["failed"] == 0, summary
+
+def check_connection_reuse():
+    server = trapper()
+    sender = Sender("127.0.0.1", server.server_address[1], chunk_size=1, connections=1)
+    sender.send([value("host", "key", 1)])
+    sender.send([value("host", "key", 2)])
+    sender.close()
+    server.shutdown()
+    assert len(server.requests) == 2 and server.connections == 1, "%d connections"%(server.connections)
+
+def check_reconnect():
+    server = trapper(keep_alive=False)
+    sender = Sender("127.0.0.1", server.server_address[1], connections=1)
+    sender.send([value("host", "key", 1)])
+    sender.send([value("host", "key", 2)])
+    sender.close()
+    server.shutdown()
+    assert len(server.requests) == 2 and server.connections == 2, "%d connections"%(server.connections)
+
+def check_failed_values():
+    server = trapper()
+    sender = Sender("127.0.0.1", server.server_address[1], chunk_size=2, connections=2)
+    summary = sender.send([value("host", "missing%d"%(i) if i % 2 else "key%d"%(i), i) for i in range(0, 6)])
+    sender.close()
+    server.shutdown()
+    assert summary["processed"] == 3 and summary["failed"] == 3 and summary["total"] == 6, summary
+
+def check_rejected():
+    server = trapper(response="failed")
+    sender = Sender("127.0.0.1", server.server_address[1])
+    try:
+        sender.send([value("host", "key", 1)])
+        assert False, "error was not raised"
+    except SenderError:
+        pass
+    finally:
+        sender.close()
+        server.shutdown()
+
+def check_unreachable():
+    sender = Sender("127.0.0.1", 1, timeout=1)
+    try:
+        sender.send([value("host", "key", 1)])
+        assert False, "error was not raised"
+    except SenderError:
+        pass
+
+check("Parsing response info", check_parse_info)
+check("Building item keys", check_item_key)
+check("Splitting values into chunks", check_chunks)
+check("Reusing connection", check_connection_reuse)
+check("Reconnecting after server closed connection", check_reconnect)
+check("Counting failed values", check_failed_values)
+check("Raising error on rejected request", check_rejected)
+check("Raising error on unreachable server", check_unreachable)
+sys.exit(exit_code)
@@ -17,10 +17,11 @@ ENABLE_DOCKER_MODULE=false
 ENABLE_WEB_MODULE=false
 CONFIG_FOLDER=/etc/zabbix
 CUSTOM_CONFIG=${CONFIG_FOLDER}/custom.json
-MODULE_FOLDER=/var/lib/modules/zabbix
 SCRIPTS_FOLDER=/usr/local/bin
-MODULE_FILENAME=zabbix_module_docker.so
 WEB_DISCOVERY_CONFIG=${CONFIG_FOLDER}/web_list.json
+WEB_DISCOVERY_SOCKET=/var/run/zabbix/zabbix_web.sock
+# Results of web probe belong to the host with Template Web Check, configurator links it to "Zabbix server"
+WEB_PROBE_HOST=${ZBX_WEB_PROBE_HOST:-Zabbix server}
 OS=$(lsb_release -is | tr '[:upper:]' '[:lower:]')
 OSV=$(lsb_release -rs | cut -d"." -f1)
 
@@ -33,10 +34,13 @@ Options:
     -m, --meta [string]         String to use for auto registration.
     -s, --server [zabbix.local] Set zabbix server to connect by agent. This option is required.
     --hostname [agent.local]    Set agent hostname.
-    --enable-docker-module      Download and enable docker module for agent. Is compartible with Template App Docker.
+    --web-probe-host [name]     Set Zabbix host which receives results of web probe, \"Zabbix server\" by default.
+    --enable-docker-module      Install docker metrics collector for agent. Is compartible with Template App Docker.
     --enable-web-module         Enable custom web parameters:
                                     1) certificate.enddate[host,port] - returns datetime of expiration the certificate.
                                     2) certificate.endtimestamp[host,port] - returns datetime of expiration the certificate.
+                                    3) certificate.check - returns expiration of certificates of all discovered https urls.
+                                    4) web.probe.* - trapper items with results of checking all urls every minute.
     -h, --help                  Show help.
 
 Examples:
@@ -64,6 +68,10 @@ do
                     HOSTNAME="Hostname=$2";
                     shift
                 ;;
+                --web-probe-host)
+                    WEB_PROBE_HOST="$2";
+                    shift
+                ;;
                 -h|--help)
                     SHOW_HELP=true
                 ;;
@@ -86,7 +94,6 @@ if [ "${SHOW_HELP}" == "true" ] || [ -z "${SERVER}" ]; then
   exit 0
 fi
 
-mkdir -p ${MODULE_FOLDER}
 printf "Checking OS compartible with script. "
 if [ ! -e "/etc/debian_version" ]; then
   echo "Failed."
@@ -105,14 +112,13 @@ printf "Installing zabbix-agent. "
 apt-get install -y zabbix-agent=1:3.4.15-1+bionic > /dev/null
 echo "Done."
 
-printf "Downloading docker module."
+printf "Installing docker metrics collector. "
 if [ "${ENABLE_DOCKER_MODULE}" == true ]; then
     docker version &> /dev/null
-    if [ "${OS}" == "ubuntu" -a "${OSV}" == "18" ]; then
-        OSV="16"
-    fi
-    cp ./lib/${OSV}/zabbix_module_docker.so ${MODULE_FOLDER}/${MODULE_FILENAME}
+    cp -f ./scripts/zabbix_docker.py ${SCRIPTS_FOLDER}/zabbix_docker.py
+    chmod +x ${SCRIPTS_FOLDER}/zabbix_docker.py
     usermod -aG docker zabbix
+    echo "Done."
 else
     echo "Skipped."
 fi
@@ -127,7 +133,6 @@ cat << EOF > ${CONFIG_FILE}
 Server=${SERVER}
 ${LISTEN_IP}
 ${HOSTNAME}
-LoadModulePath=${MODULE_FOLDER}
 EOF
 
 if [ ! -z "${META}" ]; then
@@ -139,19 +144,24 @@ fi
 
 if [ "${ENABLE_DOCKER_MODULE}" == true ]; then
 cat << EOF >> ${CONFIG_FILE}
-LoadModule=${MODULE_FILENAME}
+UserParameter=docker.discovery,zabbix_docker.py discovery
+UserParameter=docker.stats,zabbix_docker.py stats
 EOF
 fi
 
 if [ "${ENABLE_WEB_MODULE}" == true ]; then
 
 cp -f ./scripts/zabbix_web.py ${SCRIPTS_FOLDER}/zabbix_web.py
-chmod +x ${SCRIPTS_FOLDER}/zabbix_web.py
+cp -f ./scripts/zabbix_web_client.py ${SCRIPTS_FOLDER}/zabbix_web_client.py
+cp -f ./scripts/zabbix_certificate.py ${SCRIPTS_FOLDER}/zabbix_certificate.py
+cp -f ./scripts/zabbix_sender.py ${SCRIPTS_FOLDER}/zabbix_sender.py
+chmod +x ${SCRIPTS_FOLDER}/zabbix_web.py ${SCRIPTS_FOLDER}/zabbix_web_client.py ${SCRIPTS_FOLDER}/zabbix_certificate.py
 
 cat << EOF >> ${CONFIG_FILE}
 UserParameter=certificate.endtimestamp[*],date --date "\$(echo | openssl s_client -showcerts -servername \$1 -connect \$1:\$2 2>/dev/null | openssl x509 -inform pem -noout -enddate | cut -d= -f2)" +%s
 UserParameter=certificate.enddate[*],date --date "\$(echo | openssl s_client -showcerts -servername \$1 -connect \$1:\$2 2>/dev/null | openssl x509 -inform pem -noout -enddate | cut -d= -f2)"
-UserParameter=web.discovery[*],zabbix_web.py discovery --config ${CUSTOM_CONFIG} --protocol \$1 --priority \$2 \$3
+UserParameter=certificate.check,zabbix_certificate.py check --config ${CUSTOM_CONFIG} --timeout 2 --deadline 2.5
+UserParameter=web.discovery[*],zabbix_web_client.py discovery --config ${CUSTOM_CONFIG} --protocol \$1 --priority \$2 \$3
 EOF
 
 fi
@@ -185,6 +195,54 @@ printf "Restarting zabbix agent. "
 service zabbix-agent restart > /dev/null
 echo "Done."
 
+if [ "${ENABLE_WEB_MODULE}" == true ]; then
+printf "Starting web discovery daemon. "
+cat << EOF > /etc/systemd/system/zabbix-web.service
+[Unit]
+Description=Zabbix web discovery daemon
+After=zabbix-agent.service
+
+[Service]
+User=zabbix
+ExecStart=${SCRIPTS_FOLDER}/zabbix_web.py serve --config ${CUSTOM_CONFIG} --socket ${WEB_DISCOVERY_SOCKET}
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+EOF
+cat << EOF > /etc/systemd/system/zabbix-web-probe.service
+[Unit]
+Description=Zabbix web probe
+After=zabbix-agent.service
+
+[Service]
+Type=oneshot
+User=zabbix
+ExecStart=${SCRIPTS_FOLDER}/zabbix_web.py probe --config ${CUSTOM_CONFIG} --server ${SERVER%%,*} --host "${WEB_PROBE_HOST}"
+EOF
+cat << EOF > /etc/systemd/system/zabbix-web-probe.timer
+[Unit]
+Description=Checking web urls every minute
+
+[Timer]
+OnBootSec=1min
+OnUnitActiveSec=1min
+
+[Install]
+WantedBy=timers.target
+EOF
+systemctl daemon-reload
+systemctl enable zabbix-web zabbix-web-probe.timer &> /dev/null
+systemctl restart zabbix-web zabbix-web-probe.timer
+echo "Done."
+printf "Checking web probe results are accepted by server for host ${WEB_PROBE_HOST}. "
+if systemctl start zabbix-web-probe.service; then
+    echo "Done."
+else
+    echo "Failed. See: journalctl -u zabbix-web-probe"
+fi
+fi
+
 printf "Removing dangling data. "
 rm -f /tmp/zabbix-release.deb
 echo "Done."